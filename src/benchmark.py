@@ -0,0 +1,169 @@
+import sys
+import getopt
+import json
+import logging
+import multiprocessing
+import resource
+import time
+from dataminion.agent import Serf
+from dataminion.coordination import Memory
+from dataminion import workload
+
+logger = logging.getLogger(__name__)
+
+def usage():
+    print "Usage: %s [-s <sourcetypes>] [-n <events>] [-m filter|directive|all] [-w <workers>] [-e thread|process] [-b <batch_size>] [-q <queue_depth>] [-l <bulk_latency_ms>] [-j] [-o <result_file>]" % sys.argv[0]
+
+def _get_class_by_name(cl):
+    d = cl.rfind(".")
+    classname = cl[d+1:len(cl)]
+    m = __import__(cl[0:d], globals(), locals(), [classname])
+    return getattr(m, classname)
+
+def _percentiles(latencies):
+    if not latencies:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "p50": latencies[int(n * 0.50)],
+        "p90": latencies[min(n - 1, int(n * 0.90))],
+        "p99": latencies[min(n - 1, int(n * 0.99))],
+        "max": latencies[-1]
+    }
+
+def _rss():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"rss_kb": own.ru_maxrss, "children_rss_kb": children.ru_maxrss, "cpu": own.ru_utime + own.ru_stime, "children_cpu": children.ru_utime + children.ru_stime}
+
+def bench_filter(sourcetype, options):
+    """Drives the sourcetype's filter alone, timing every process call (or
+    every process_batch call, spread over it's events)"""
+    events = list(workload.GENERATORS[sourcetype](events=options["events"]))
+    produced = [0]
+    def on_filter(data):
+        produced[0] += 1
+    def on_filter_batch(data):
+        produced[0] += len(data)
+    _filter = _get_class_by_name(workload.FILTERS[sourcetype])
+    instance = _filter(config={"coordinator_root": "/benchmark"}, on_filter=on_filter, on_filter_batch=on_filter_batch, coordinator=Memory({}))
+    latencies = []
+    batch_size = options["batch_size"]
+    start = time.time()
+    if batch_size > 1:
+        for i in range(0, len(events), batch_size):
+            batch = events[i:i + batch_size]
+            t = time.time()
+            instance.process_batch(batch)
+            per_event = (time.time() - t) / len(batch)
+            latencies.extend([per_event] * len(batch))
+    else:
+        for data in events:
+            t = time.time()
+            instance.process(data)
+            latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    result = {"mode": "filter", "sourcetype": sourcetype, "events": len(events), "produced": produced[0], "elapsed": elapsed, "events_per_sec": len(events) / elapsed, "latency": _percentiles(latencies)}
+    result.update(_rss())
+    return result
+
+def bench_directive(sourcetype, options):
+    """Runs a full in-process directive, memory input -> filter -> memory
+    output, until every event went through"""
+    events = list(workload.GENERATORS[sourcetype](events=options["events"]))
+    serf = Serf(config={"identification": {"uuid": "benchmark"}, "coordination": {"classname": "dataminion.coordination.Memory"}, "metrics": {"publish_interval": 0}})
+    node = "/benchmark/" + sourcetype
+    directive = {
+        "queue_depth": options["queue_depth"],
+        "input": {"classname": "dataminion.input.memory.Memory", "events": events, "batch_size": options["batch_size"]},
+        "filter": {"classname": workload.FILTERS[sourcetype], "coordinator_root": "/benchmark", "workers": options["workers"], "engine": options["engine"], "encode": options["encode"]},
+        "output": {"classname": "dataminion.output.memory.Memory", "bulkactions": 500, "bulk_latency": options["bulk_latency"] / 1000.0, "encode": options["encode"]}
+    }
+    start = time.time()
+    serf._setup_directive(node, directive)
+    serf._directive[node]["thread"].finished.wait()
+    serf.stop()
+    elapsed = time.time() - start
+    snapshot = serf._metrics.snapshot()["directives"][node]
+    stages = {}
+    for name in snapshot["histograms"]:
+        stages[name] = dict([(p, snapshot["histograms"][name][p]) for p in ("p50", "p90", "p99", "max")])
+    result = {"mode": "directive", "sourcetype": sourcetype, "events": len(events), "produced": serf._directive[node]["output"].written, "elapsed": elapsed, "events_per_sec": len(events) / elapsed, "latency": stages, "counters": snapshot["counters"]}
+    result.update(_rss())
+    return result
+
+def _run_isolated(fn, sourcetype, options):
+    """Runs a scenario in it's own process so peak RSS is it's own"""
+    results = multiprocessing.Queue()
+    def target():
+        results.put(fn(sourcetype, options))
+    worker = multiprocessing.Process(target=target)
+    worker.start()
+    result = results.get()
+    worker.join()
+    return result
+
+def report(result):
+    print "%-9s %-9s %8d events %9d out %8.2fs %10.0f ev/s  rss %7d KB  cpu %.2fs + %.2fs workers" % (result["mode"], result["sourcetype"], result["events"], result["produced"], result["elapsed"], result["events_per_sec"], max(result["rss_kb"], result["children_rss_kb"]), result["cpu"], result["children_cpu"])
+    if result["mode"] == "filter":
+        print "          latency per event p50 %.1fus p90 %.1fus p99 %.1fus max %.1fus" % tuple([result["latency"][p] * 1000000 for p in ("p50", "p90", "p99", "max")])
+    else:
+        for name in sorted(result["latency"]):
+            print "          %-20s p50 %.2fms p90 %.2fms p99 %.2fms max %.2fms" % tuple([name] + [result["latency"][name][p] * 1000 for p in ("p50", "p90", "p99", "max")])
+
+def main():
+    options = {"events": 20000, "workers": 1, "engine": "thread", "batch_size": 1, "queue_depth": 1000, "bulk_latency": 0.0, "encode": False}
+    sourcetypes = sorted(workload.GENERATORS.keys())
+    modes = ["filter", "directive"]
+    result_file = None
+    level = logging.ERROR
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hvjs:n:m:w:e:b:q:l:o:", ["help"])
+    except getopt.GetoptError as err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-v":
+            level = logging.INFO
+        elif o == "-s":
+            sourcetypes = a.split(",")
+        elif o == "-n":
+            options["events"] = int(a)
+        elif o == "-m":
+            if a != "all":
+                modes = [a]
+        elif o == "-w":
+            options["workers"] = int(a)
+        elif o == "-e":
+            options["engine"] = a
+        elif o == "-b":
+            options["batch_size"] = int(a)
+        elif o == "-q":
+            options["queue_depth"] = int(a)
+        elif o == "-l":
+            options["bulk_latency"] = float(a)
+        elif o == "-j":
+            options["encode"] = True
+        elif o == "-o":
+            result_file = a
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit()
+    logging.basicConfig(level=level, format='%(asctime)s %(name)-14s %(levelname)-8s %(message)s')
+    results = []
+    for sourcetype in sourcetypes:
+        for mode in modes:
+            if mode == "filter":
+                result = _run_isolated(bench_filter, sourcetype, options)
+            else:
+                result = _run_isolated(bench_directive, sourcetype, options)
+            report(result)
+            results.append(result)
+    if result_file:
+        with open(result_file, "w") as json_file:
+            json_file.write(json.dumps({"options": options, "results": results}, indent=4, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
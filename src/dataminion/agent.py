@@ -5,6 +5,9 @@ import platform
 import json
 import uuid
 import threading
+from dataminion.metrics import Registry, StatsServer
+from dataminion.coordination import Subscriptions
+from dataminion.pipeline import Stage, KeyedPool, ProcessPool, Batch, Checkpoint, dispatch, dispatcher
 
 class Agent(object):
     """An agent for data aquisition and dispatch supporting alternate 
@@ -49,6 +52,12 @@ class Serf(Agent):
     def _initialize(self):
         """Initializes self configuration and updates if needed. When finished
         starts it's function"""
+        self._metrics = Registry()
+        #coordination node (prefix): directives whose filter wants it
+        self._subscriptions = Subscriptions()
+        self._stats_server = None
+        self._publisher = None
+        self._stopping = threading.Event()
         if "identification" not in self._configuration:
             self._configuration["identification"] = {}
         if "uuid" not in self._configuration["identification"]:
@@ -74,31 +83,155 @@ class Serf(Agent):
             self._coordination = obj(coordinator, on_node_update=self._handle_coordination_message)
 
         self.register()
+        self._setup_metrics()
         self._coordination.setup_watches()
 
+    def _setup_metrics(self):
+        """Serves directive metrics over HTTP when "metrics" has a "port" and
+        publishes them every "publish_interval" seconds under the serf's
+        registry node"""
+        config = {}
+        if "metrics" in self._configuration:
+            config = self._configuration["metrics"]
+        if "port" in config:
+            if "bind" not in config:
+                config["bind"] = "127.0.0.1"
+            self._stats_server = StatsServer(self._metrics, bind=config["bind"], port=config["port"])
+            self._stats_server.start()
+        if "publish_interval" not in config:
+            config["publish_interval"] = 60
+        if config["publish_interval"] > 0:
+            self._publisher = threading.Thread(target=self._publish_metrics, args=(config["publish_interval"],), name="metrics")
+            self._publisher.daemon = True
+            self._publisher.start()
+
+    def _publish_metrics(self, interval):
+        node = "/registry/" + self._configuration["identification"]["uuid"] + "/metrics"
+        previous = None
+        while not self._stopping.wait(interval):
+            try:
+                previous = self._metrics.snapshot(previous)
+                self._coordination.update(node, previous)
+            except Exception:
+                self.logger.exception("Failed publishing metrics to %s", node)
+
     def _make_reader_fn(self, node):
         """"""
-        #self.logger.info("GOT DATA from input: %s", data)
-        #TODO: Consider try catch block here to handle failure in filter
         #TODO: Failure, use "discard" directive key to handle info fail 
+        #TODO: Consider try catch block here to handle failure in filter
+        filter_fn = self._make_filter_fn(node)
         def reader_fn(data):
             self.logger.debug("READ DATA %s ||| %s", node, data)
-            if "filter" in self._directive[node]:
-                self._directive[node]["filter"].process(data)
-            elif "output" in self._directive[node]:
-                self._directive[node]["output"].process(data)
+            directive = self._directive[node]
+            if isinstance(data, Batch):
+                directive["metrics"].incr("input.events", len(data))
+            elif not isinstance(data, Checkpoint):
+                directive["metrics"].incr("input.events")
+            if "stages" in directive:
+                #inputs call in from their IO loop, which must not block,
+                #the first stage pauses them instead
+                if "filter" in directive["stages"]:
+                    directive["stages"]["filter"].put(data, False)
+                elif "output" in directive["stages"]:
+                    directive["stages"]["output"].put(data, False)
+            elif "filter" in directive:
+                dispatch(directive["filter"], data, forward=filter_fn)
+            elif "output" in directive:
+                dispatch(directive["output"], data)
+            elif isinstance(data, Checkpoint):
+                data.commit()
         return reader_fn
-        #send to filter
-        #get from filter, write to output
+
+    def _make_batch_reader_fn(self, node):
+        """Inputs hand over lists of events here, they travel the pipeline as
+        one Batch"""
+        reader_fn = self._make_reader_fn(node)
+        def batch_reader_fn(data):
+            reader_fn(Batch(data))
+        return batch_reader_fn
 
     def _make_filter_fn(self, node):
         """"""
         def filter_fn(data):
             self.logger.debug("FILTERED DATA %s ||| %s", node, data)
-            if "output" in self._directive[node]:
-                self._directive[node]["output"].process(data)
+            directive = self._directive[node]
+            if isinstance(data, Batch):
+                directive["metrics"].incr("filter.out", len(data))
+            elif not isinstance(data, Checkpoint):
+                directive["metrics"].incr("filter.out")
+            if "stages" in directive and "output" in directive["stages"]:
+                directive["stages"]["output"].put(data)
+            elif "output" in directive:
+                dispatch(directive["output"], data)
+            elif isinstance(data, Checkpoint):
+                data.commit()
         return filter_fn
 
+    def _make_filter_batch_fn(self, node):
+        """"""
+        filter_fn = self._make_filter_fn(node)
+        def filter_batch_fn(data):
+            filter_fn(Batch(data))
+        return filter_batch_fn
+
+    def _make_pause_fn(self, node):
+        """Stops the directive input from consuming while it's first stage is
+        above it's high watermark"""
+        def pause_fn():
+            if "thread" in self._directive[node]:
+                self.logger.info("Pausing input for %s", node)
+                self._directive[node]["thread"].pause()
+        return pause_fn
+
+    def _make_resume_fn(self, node):
+        """"""
+        def resume_fn():
+            if "thread" in self._directive[node]:
+                self.logger.info("Resuming input for %s", node)
+                self._directive[node]["thread"].resume()
+        return resume_fn
+
+    def _setup_stages(self, node, directive):
+        """Joins filter and output by bounded queues so that each runs on it's
+        own thread and the input (pika IO loop) never waits on them. The first
+        stage throttles the input, later stages block the one before."""
+        stages = {}
+        depth = directive["queue_depth"]
+        metrics = self._directive[node]["metrics"]
+        if isinstance(self._directive[node].get("filter"), (KeyedPool, ProcessPool)):
+            stages["filter"] = self._directive[node]["filter"]
+        elif "filter" in self._directive[node]:
+            stages["filter"] = Stage(name=node + ":filter", handler=dispatcher(self._directive[node]["filter"], forward=self._make_filter_fn(node)), depth=depth, on_full=self._make_pause_fn(node), on_drain=self._make_resume_fn(node), metrics=metrics, label="filter")
+        if "output" in self._directive[node]:
+            if "filter" in stages:
+                stages["output"] = Stage(name=node + ":output", handler=dispatcher(self._directive[node]["output"]), depth=depth, metrics=metrics, label="output")
+            else:
+                stages["output"] = Stage(name=node + ":output", handler=dispatcher(self._directive[node]["output"]), depth=depth, on_full=self._make_pause_fn(node), on_drain=self._make_resume_fn(node), metrics=metrics, label="output")
+        for stage in stages.values():
+            if isinstance(stage, Stage):
+                stage.start()
+        self._directive[node]["stages"] = stages
+
+    def _setup_filter_pool(self, node, directive, _filter):
+        """Spreads the directive filter over "workers" instances keyed by the
+        filter's partition key, on threads or, with "engine": "process", on
+        worker processes"""
+        self.logger.info("Setting up %d %s workers for %s", directive["filter"]["workers"], directive["filter"]["engine"], node)
+        if directive["filter"]["engine"] == "process":
+            if "batch_size" not in directive["filter"]:
+                directive["filter"]["batch_size"] = 100
+            if "batch_timeout" not in directive["filter"]:
+                directive["filter"]["batch_timeout"] = 0.05
+            #encode: workers ship events as JSON, outputs get RawEvents
+            if "encode" not in directive["filter"]:
+                directive["filter"]["encode"] = False
+            return ProcessPool(name=node + ":filter", _filter=_filter, config=directive["filter"], workers=directive["filter"]["workers"], depth=directive["queue_depth"], batch_size=directive["filter"]["batch_size"], batch_timeout=directive["filter"]["batch_timeout"], on_filter=self._make_filter_fn(node), on_filter_batch=self._make_filter_batch_fn(node), on_checkpoint=self._make_filter_fn(node), coordinator=self._coordination, on_full=self._make_pause_fn(node), on_drain=self._make_resume_fn(node), encode=directive["filter"]["encode"], metrics=self._directive[node]["metrics"])
+        if directive["filter"]["engine"] != "thread":
+            self.logger.warning("Unknown filter engine %s, using threads", directive["filter"]["engine"])
+        def factory():
+            return _filter(config=directive["filter"], on_filter=self._make_filter_fn(node), on_filter_batch=self._make_filter_batch_fn(node), coordinator=self._coordination, metrics=self._directive[node]["metrics"])
+        return KeyedPool(name=node + ":filter", factory=factory, workers=directive["filter"]["workers"], depth=directive["queue_depth"], on_full=self._make_pause_fn(node), on_drain=self._make_resume_fn(node), on_checkpoint=self._make_filter_fn(node), metrics=self._directive[node]["metrics"])
+
     def _make_write_fn(self, node):
         """"""
         def filter_fn(data):
@@ -107,14 +240,33 @@ class Serf(Agent):
             #    self._directive[node]["output"].process(data)
         return filter_fn
 
+    def _subscribe(self, node, _filter, config):
+        """Indexes the coordination nodes the directive's filter wants, all
+        of them unless the filter class says otherwise (memory_prefixes)"""
+        prefixes = None
+        if hasattr(_filter, "memory_prefixes"):
+            prefixes = _filter.memory_prefixes(config)
+        if prefixes is None:
+            self._subscriptions.subscribe(None, node)
+        else:
+            for prefix in prefixes:
+                self._subscriptions.subscribe(prefix, node)
+
+    def _filters_for(self, key):
+        """Filters of the directives subscribed to key"""
+        filters = []
+        for n in self._subscriptions.match(key):
+            if n in self._directive and "filter" in self._directive[n]:
+                filters.append(self._directive[n]["filter"])
+        return filters
+
     def _handle_coordination_message(self, node, value):
         self.logger.debug("Got coordination data from node %s with value %s", node, value)
         element = None
         if value is None:
-            for n in self._directive:
-                self.logger.debug("Preparing to unset node %s/%s", n, node)
-                if "filter" in self._directive[n]:
-                    self._directive[n]["filter"].unset_memory(node)
+            for _filter in self._filters_for(node):
+                self.logger.debug("Preparing to unset node %s", node)
+                _filter.unset_memory(node)
         else:
             try:
                 element = json.loads(value)
@@ -125,16 +277,9 @@ class Serf(Agent):
         if element:
             if "header" in element:
                 self.logger.info("%s node reports header with value: %s", node, value)
-                for n in self._directive:
-                    if "thread" in self._directive[n]:
-                        if self._directive[n]["thread"].is_alive():
-                            self.logger.info("Thread %s is alive", n)
-                        else:
-                            self.logger.info("Thread %s looks dead", n)
-                    if "filter" in self._directive[n]:
-                        if "header" in element and "key" in element:
-                            #self.logger.info("Header %s", self._directive[n]["filter"].set_memory("a","b"))
-                            self._directive[n]["filter"].set_memory(element["key"], element)
+                if "key" in element:
+                    for _filter in self._filters_for(element["key"]):
+                        _filter.set_memory(element["key"], element)
             elif "input" in element or "output" in element:
                 #stop current directive
                 #setup changes on directive
@@ -148,21 +293,34 @@ class Serf(Agent):
         if node in self._directive:
             raise KeyboardInterrupt
         #TODO (): evaluate directive status before reassignment
+        if "queue_depth" not in directive:
+            directive["queue_depth"] = 1000
         self._directive[node] = {}
+        self._directive[node]["metrics"] = self._metrics.directive(node)
         if "filter" in directive:
             self.logger.info("Setting up filter: %s", directive["filter"]["classname"])
             _filter     = self._get_class_by_name(directive["filter"]["classname"])
-            self._directive[node]["filter"] = _filter(config=directive["filter"], on_filter=self._make_filter_fn(node), coordinator=self._coordination)
+            if "workers" not in directive["filter"]:
+                directive["filter"]["workers"] = 1
+            if "engine" not in directive["filter"]:
+                directive["filter"]["engine"] = "thread"
+            if directive["filter"]["workers"] > 1 and directive["queue_depth"] > 0:
+                self._directive[node]["filter"] = self._setup_filter_pool(node, directive, _filter)
+            else:
+                self._directive[node]["filter"] = _filter(config=directive["filter"], on_filter=self._make_filter_fn(node), on_filter_batch=self._make_filter_batch_fn(node), coordinator=self._coordination, metrics=self._directive[node]["metrics"])
+            self._subscribe(node, _filter, directive["filter"])
         if "output" in directive:
             self.logger.info("Setting up input: %s", directive["output"]["classname"])
             _output     = self._get_class_by_name(directive["output"]["classname"])
-            self._directive[node]["output"] = _output(config=directive["output"], on_write=self._make_write_fn(node))
+            self._directive[node]["output"] = _output(config=directive["output"], on_write=self._make_write_fn(node), metrics=self._directive[node]["metrics"])
+        if directive["queue_depth"] > 0:
+            self._setup_stages(node, directive)
         if "input" in directive:
             self.logger.info("Setting up input: %s", directive["input"]["classname"])
             _input      = self._get_class_by_name(directive["input"]["classname"])
             #self._directive[node]["input"]  = _input(config=directive["input"], on_data=self._make_reader_fn(node))
             #self._directive[node]["input"].run()
-            self._directive[node]["thread"] = _input(config=directive["input"], on_data=self._make_reader_fn(node))
+            self._directive[node]["thread"] = _input(config=directive["input"], on_data=self._make_reader_fn(node), on_data_batch=self._make_batch_reader_fn(node), metrics=self._directive[node]["metrics"])
             self._directive[node]["thread"].start()
             self.logger.info("Started up input: %s", directive["input"]["classname"])
 
@@ -187,8 +345,19 @@ class Serf(Agent):
                     self.logger.info("Thread %s is alive", node)
                 else:
                     self.logger.info("Thread %s looks dead", node)
+            if "stages" in self._directive[node]:
+                for name in ("filter", "output"):
+                    if name in self._directive[node]["stages"]:
+                        self._directive[node]["stages"][name].stop()
+            _filter = self._directive[node].get("filter")
+            if _filter is not None and not isinstance(_filter, (KeyedPool, ProcessPool)) and hasattr(_filter, "stop"):
+                #pools stop their filters as a stage
+                _filter.stop()
             if "output" in self._directive[node]:
                 self._directive[node]["output"].stop()
+        self._stopping.set()
+        if self._stats_server:
+            self._stats_server.stop()
         self._coordination.stop()
 
     def register(self):
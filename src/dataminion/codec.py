@@ -0,0 +1,235 @@
+"""Message body codecs shared by the AMQP input and output, named like
+"json", "json_lines+gzip" or "raw" (RawEvents outputs pass on as they are)"""
+import json
+import zlib
+
+#the fastest json decoder around, encoding stays with the stdlib (it has
+#C speedups too) since ujson rounds floats to fewer digits. ujson decodes
+#them like the stdlib only with precise_float
+try:
+    import ujson as _fastjson
+except ImportError:
+    try:
+        import simplejson as _fastjson
+    except ImportError:
+        _fastjson = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+loads = _fastjson.loads
+if _fastjson.__name__ == "ujson":
+    def loads(body):
+        return _fastjson.loads(body, precise_float=True)
+
+dumps = json.dumps
+
+#json.dumps sets up a new encoder on every call, for lots of small events
+#the C one is built once instead, same output
+try:
+    from json.encoder import c_make_encoder as _c_make_encoder
+except ImportError:
+    _c_make_encoder = None
+if _c_make_encoder is not None:
+    _c_encoder = _c_make_encoder(None, json.JSONEncoder().default, json.encoder.encode_basestring_ascii, None, ": ", ", ", False, False, True)
+    def dumps(event):
+        return "".join(_c_encoder(event, 0))
+
+class RawEvent(str):
+    """A JSON object kept as the bytes it came in"""
+
+def fields(add_field):
+    """Precomputes add_field as the bytes splice() inserts, e.g.
+    ',"env":"prod"'"""
+    return "".join([",%s:%s" % (dumps(key), dumps(add_field[key])) for key in add_field])
+
+def splice(raw, spliced):
+    """Appends precomputed fields() to the raw JSON object, bodies not ending
+    in "}" are left alone. A key already in the object ends up twice and
+    parsers keep the last one, so add_field still wins"""
+    body = raw.rstrip()
+    if not spliced or not body.endswith("}"):
+        return raw
+    body = body[:-1].rstrip()
+    if body.endswith("{"):
+        return RawEvent(body + spliced[1:] + "}")
+    return RawEvent(body + spliced + "}")
+
+def _line(raw):
+    """A raw event on one line, newlines in JSON can only be whitespace"""
+    if "\n" in raw or "\r" in raw:
+        return raw.replace("\r", " ").replace("\n", " ")
+    return raw
+
+class Raw(object):
+    """One JSON object per message, left undecoded"""
+    content_type = "application/json"
+
+    def decode(self, body):
+        return [RawEvent(body)]
+
+    def encode(self, events):
+        if len(events) == 1:
+            return events[0]
+        return "[" + ",".join(events) + "]"
+
+class RawLines(object):
+    """Newline delimited JSON, each line left undecoded"""
+    content_type = "application/x-ndjson"
+
+    def decode(self, body):
+        return [RawEvent(line) for line in body.splitlines() if line.strip()]
+
+    def encode(self, events):
+        return "\n".join([_line(event) for event in events])
+
+class Plain(object):
+    """Bodies are events as they are, several events are joined by newlines
+    which decode leaves alone"""
+    content_type = "text/plain"
+
+    def decode(self, body):
+        return [body]
+
+    def encode(self, events):
+        if len(events) == 1:
+            return events[0]
+        return "\n".join(events)
+
+class Json(object):
+    """One JSON document per message, an array is a list of events"""
+    content_type = "application/json"
+
+    def decode(self, body):
+        data = loads(body)
+        if isinstance(data, list):
+            return data
+        return [data]
+
+    def encode(self, events):
+        if len(events) == 1:
+            return dumps(events[0])
+        return dumps(events)
+
+class JsonLines(object):
+    """Newline delimited JSON, one event per line"""
+    content_type = "application/x-ndjson"
+
+    def decode(self, body):
+        return [loads(line) for line in body.splitlines() if line.strip()]
+
+    def encode(self, events):
+        """Raw events go in as they are"""
+        return "\n".join([_line(event) if isinstance(event, RawEvent) else dumps(event) for event in events])
+
+class Msgpack(object):
+    """One or more msgpack objects back to back"""
+    content_type = "application/msgpack"
+
+    def decode(self, body):
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(body)
+        return list(unpacker)
+
+    def encode(self, events):
+        """Raw events are decoded first, to go in as objects"""
+        return "".join([msgpack.packb(loads(event) if isinstance(event, RawEvent) else event, use_bin_type=True) for event in events])
+
+def _gunzip(body):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+def _gzip(body):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+def _lz4_compress(body):
+    return lz4.compress(body)
+
+def _lz4_decompress(body):
+    return lz4.decompress(body)
+
+FORMATS = {
+    "plain": Plain,
+    "json": Json,
+    "json_lines": JsonLines,
+    "msgpack": Msgpack,
+    "raw": Raw,
+    "raw_lines": RawLines
+}
+
+#name: (compress, decompress)
+COMPRESSIONS = {
+    "gzip": (_gzip, _gunzip),
+    "zlib": (zlib.compress, zlib.decompress),
+    "deflate": (zlib.compress, zlib.decompress),
+    "lz4": (_lz4_compress, _lz4_decompress)
+}
+
+class Codec(object):
+    """A format with an optional compression, see get()"""
+    def __init__(self, name):
+        self.name = name
+        if "+" in name:
+            fmt, compression = name.split("+", 1)
+        else:
+            fmt, compression = name, None
+        if fmt not in FORMATS:
+            raise ValueError("Unknown codec %s" % fmt)
+        if fmt == "msgpack" and msgpack is None:
+            raise ValueError("Codec msgpack needs the msgpack module")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %s" % compression)
+        if compression == "lz4" and lz4 is None:
+            raise ValueError("Compression lz4 needs the lz4 module")
+        self.format = FORMATS[fmt]()
+        self.content_type = self.format.content_type
+        self.content_encoding = compression
+        #framed content types decoded regardless of the format, raw codecs
+        #keep newline delimited JSON raw
+        self._framed = {"application/x-ndjson": JsonLines()}
+        if msgpack is not None:
+            self._framed["application/msgpack"] = Msgpack()
+        if fmt in ("raw", "raw_lines"):
+            self._framed["application/x-ndjson"] = RawLines()
+        #whether a body can hold several events decode() splits again
+        self.framed = self.content_type in self._framed
+
+    def decode(self, body, content_encoding=None, content_type=None):
+        """Returns the list of events in body, content_encoding wins over the
+        configured compression when it's a known one"""
+        encoding = self.content_encoding
+        if content_encoding in COMPRESSIONS:
+            encoding = content_encoding
+        if encoding is not None:
+            if encoding == "lz4" and lz4 is None:
+                raise ValueError("Compression lz4 needs the lz4 module")
+            body = COMPRESSIONS[encoding][1](body)
+        if content_type is not None and content_type != self.content_type and content_type in self._framed:
+            return self._framed[content_type].decode(body)
+        return self.format.decode(body)
+
+    def encode(self, events):
+        """Returns events as one body"""
+        return self.compress(self.format.encode(events))
+
+    def compress(self, body):
+        """Applies the compression (if any) to an already encoded body"""
+        if self.content_encoding is not None:
+            body = COMPRESSIONS[self.content_encoding][0](body)
+        return body
+
+_codecs = {}
+
+def get(name):
+    """Returns the (shared, stateless) codec for name, e.g. "json_lines+gzip",
+    raises ValueError for unknown formats, compressions or missing modules"""
+    if name not in _codecs:
+        _codecs[name] = Codec(name)
+    return _codecs[name]
@@ -1,6 +1,8 @@
 import logging
 import sys
+import os
 import json
+import threading
 
 class Coordination(object):
     """Configuration maintenance class, keeps it up to date, detects changes,
@@ -11,6 +13,7 @@ class Coordination(object):
         log = logging.getLogger(__name__)
         self.logger = logger or log
         self._coordinator = coordinator
+        self._on_update = None
         self.add_on_update_callback(on_node_update)
         self._initialize()
         #getattr(sys.modules[__name__], "Zookeeper")
@@ -38,6 +41,47 @@ class Coordination(object):
         self.logger.warning("Sorry, don't know how to update....")
         """"""
 
+    def update_many(self, updates):
+        """Writes a list of (node, data), one by one unless the backend can
+        do better"""
+        for node, data in updates:
+            self.update(node, data)
+
+class Subscriptions(object):
+    """Who wants updates of which coordination nodes. Targets subscribe to a
+    node, to a prefix (ending in "/", everything below it) or, with None, to
+    every node. match() costs the depth of the node, not the number of
+    subscriptions"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self._prefixes = {}
+        self._everything = set()
+
+    def subscribe(self, prefix, target):
+        with self._lock:
+            if prefix is None:
+                self._everything.add(target)
+            elif prefix.endswith("/"):
+                self._prefixes.setdefault(prefix, set()).add(target)
+            else:
+                self._nodes.setdefault(prefix, set()).add(target)
+
+    def match(self, node):
+        """Targets interested in node"""
+        with self._lock:
+            targets = set(self._everything)
+            if node in self._nodes:
+                targets.update(self._nodes[node])
+            if self._prefixes:
+                i = node.find("/")
+                while i >= 0:
+                    prefix = node[0:i + 1]
+                    if prefix in self._prefixes:
+                        targets.update(self._prefixes[prefix])
+                    i = node.find("/", i + 1)
+        return targets
+
 class Zookeeper(Coordination):
     """Configuration maintenance class, keeps it up to date, detects changes
        and persist them on it's backend
@@ -49,6 +93,8 @@ class Zookeeper(Coordination):
         if "parameters" not in self._coordinator:
             self.logger.error("No \"parameters\" key in configuration for Zookeeper object")
         self.zk = KazooClient(**self._coordinator["parameters"])
+        #parents known to exist, see update_many
+        self._paths = set()
         event = self.zk.start()
         self.zk.add_listener(self.zk_listener)
         self.logger.info("Got config")
@@ -112,6 +158,38 @@ class Zookeeper(Coordination):
             self.logger.info("Creating %s node.", node)
             self.zk.create(node, bytes(value))
 
+    def update_many(self, updates):
+        """Writes a list of (node, data) in one multi-op transaction, existence
+        checks are pipelined. When the transaction fails (e.g. someone
+        created a node in between) nodes are written one by one"""
+        if len(updates) == 1:
+            return self.update(*updates[0])
+        writes = []
+        for node, data in updates:
+            if isinstance(data, dict):
+                value = json.dumps(data)
+            else:
+                value = data
+            parent = node[0:node.rfind("/")]
+            if parent and parent not in self._paths:
+                self.zk.ensure_path(parent)
+                self._paths.add(parent)
+            writes.append((node, value, self.zk.exists_async(node)))
+        transaction = self.zk.transaction()
+        for node, value, exists in writes:
+            if exists.get():
+                transaction.set_data(node, bytes(value))
+            else:
+                transaction.create(node, bytes(value))
+        results = transaction.commit()
+        failed = [result for result in results if isinstance(result, Exception)]
+        if failed:
+            self.logger.warning("Transaction of %d updates failed (%s), updating one by one", len(writes), failed[0])
+            for node, data in updates:
+                self.update(node, data)
+        else:
+            self.logger.info("Updated %d nodes in one transaction", len(writes))
+
     def get(self, node):
         """"""
         if self.zk.exists(node):
@@ -137,7 +215,224 @@ class Zookeeper(Coordination):
     def stop(self):
         self.zk.stop()
 
-class File(Coordination):
-    """Configuration maintenance class, keeps it up to date, detects changes
-       and persist them on it's backend
+class Memory(Coordination):
+    """Configuration maintenance class keeping nodes in memory, for single
+       node deployments and tests. Behaves like the Zookeeper class: watched
+       nodes are created empty, watches fire once when set up and then on
+       every change, recursive watches pick up new children
     """
+
+    def _initialize(self):
+        self._lock = threading.RLock()
+        self._nodes = {}
+        self._watches = set()
+        self._recursive = set()
+        if "watch" not in self._coordinator:
+            self._coordinator["watch"] = []
+        self._load()
+
+    def _load(self):
+        """"""
+
+    def _persist(self, node, value):
+        """"""
+
+    def _erase(self, node):
+        """"""
+
+    def _parent(self, node):
+        return node[0:node.rfind("/")]
+
+    def _store(self, node, value):
+        """Sets a node value, creating missing parents, returns whether the
+        node was created"""
+        with self._lock:
+            parent = self._parent(node)
+            if parent and parent not in self._nodes:
+                self._store(parent, "")
+            created = node not in self._nodes
+            self._nodes[node] = value
+            self._persist(node, value)
+        return created
+
+    def _changed(self, node, value, created):
+        """Fires watches for a node that was just stored"""
+        if created and self._parent(node) in self._recursive:
+            self.watch_node(node)
+        elif node in self._watches:
+            self.node_updated(node, value)
+
+    def setup_watches(self):
+        for node in self._coordinator['watch']:
+            self.watch_node(node)
+
+    def watch_node(self, node):
+        with self._lock:
+            if node not in self._nodes:
+                self.logger.info("Creating empty node: %s", node)
+                self._store(node, "{}")
+            if node in self._watches:
+                return
+            self._watches.add(node)
+            value = self._nodes[node]
+        self.node_updated(node, value)
+
+    def watch_node_recursive(self, node):
+        with self._lock:
+            if node not in self._nodes:
+                self._store(node, "{}")
+            self._recursive.add(node)
+            children = [child for child in self._nodes if self._parent(child) == node]
+        self.logger.debug("Children are now: %s", children)
+        for child in children:
+            self.watch_node(child)
+        self.watch_node(node)
+
+    def update(self, node, data):
+        """"""
+        if isinstance(data, dict):
+            value = json.dumps(data)
+        else:
+            value = data
+        created = self._store(node, value)
+        self._changed(node, value, created)
+
+    def get(self, node):
+        """"""
+        with self._lock:
+            if node not in self._nodes:
+                return None
+            data_json = self._nodes[node]
+        data_dict = None
+        try:
+            data_dict = json.loads(data_json)
+        except ValueError:
+            self.logger.error("Error parsing json from node %s", node)
+        except TypeError:
+            self.logger.error("No data found in node %s", node)
+        if data_dict != None:
+            return data_dict
+        else:
+            return data_json
+
+    def set(self, node, data):
+        """"""
+        return self.update(node, data)
+
+    def delete(self, node):
+        """Removes a node and it's children"""
+        with self._lock:
+            nodes = [n for n in self._nodes if n == node or n.startswith(node + "/")]
+            for n in nodes:
+                del self._nodes[n]
+                self._erase(n)
+        for n in nodes:
+            if n in self._watches:
+                self.node_updated(n, None)
+
+    def stop(self):
+        """"""
+
+class File(Memory):
+    """Configuration maintenance class, keeps nodes in memory and persists
+       them under "directory", one "<directory>/<node>/.data" file per node.
+       With "poll_interval" (seconds) the directory is rescanned so that
+       files edited by hand fire watches like any other change
+    """
+
+    DATA = ".data"
+
+    def _initialize(self):
+        if "directory" not in self._coordinator:
+            self._coordinator["directory"] = "coordination"
+        if "poll_interval" not in self._coordinator:
+            self._coordinator["poll_interval"] = 0
+        self._directory = os.path.abspath(self._coordinator["directory"])
+        self._mtimes = {}
+        self._stopped = threading.Event()
+        self._poller = None
+        Memory._initialize(self)
+        if self._coordinator["poll_interval"] > 0:
+            self._poller = threading.Thread(target=self._poll, name="coordination")
+            self._poller.daemon = True
+            self._poller.start()
+
+    def _path(self, node):
+        return os.path.join(self._directory + node, self.DATA)
+
+    def _scan(self):
+        """Nodes found on disk with their modification time"""
+        found = {}
+        for root, dirs, files in os.walk(self._directory):
+            if self.DATA in files:
+                node = root[len(self._directory):]
+                if node:
+                    found[node] = os.path.getmtime(os.path.join(root, self.DATA))
+        return found
+
+    def _read(self, node):
+        with open(self._path(node)) as data_file:
+            return data_file.read()
+
+    def _load(self):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        found = self._scan()
+        for node in found:
+            self._nodes[node] = self._read(node)
+            self._mtimes[node] = found[node]
+        self.logger.info("Loaded %d nodes from %s", len(found), self._directory)
+
+    def _persist(self, node, value):
+        path = self._path(node)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + ".tmp", "w") as data_file:
+            data_file.write(value)
+        os.rename(path + ".tmp", path)
+        self._mtimes[node] = os.path.getmtime(path)
+
+    def _erase(self, node):
+        try:
+            os.remove(self._path(node))
+        except OSError:
+            self.logger.warning("Node %s had no file", node)
+        if node in self._mtimes:
+            del self._mtimes[node]
+
+    def _poll(self):
+        while not self._stopped.wait(self._coordinator["poll_interval"]):
+            try:
+                self.refresh()
+            except Exception:
+                self.logger.exception("Failed scanning %s", self._directory)
+
+    def refresh(self):
+        """Picks up nodes changed on disk by someone else"""
+        found = self._scan()
+        changed = []
+        removed = []
+        with self._lock:
+            for node in found:
+                if self._mtimes.get(node) != found[node]:
+                    value = self._read(node)
+                    created = node not in self._nodes
+                    self._mtimes[node] = found[node]
+                    if self._nodes.get(node) != value:
+                        self._nodes[node] = value
+                        changed.append((node, value, created))
+            for node in self._nodes.keys():
+                if node not in found:
+                    del self._nodes[node]
+                    if node in self._mtimes:
+                        del self._mtimes[node]
+                    removed.append(node)
+        for node, value, created in changed:
+            self.logger.info("Node %s changed on disk", node)
+            self._changed(node, value, created)
+        for node in removed:
+            if node in self._watches:
+                self.node_updated(node, None)
+
+    def stop(self):
+        self._stopped.set()
@@ -5,22 +5,39 @@ import sys
 
 import re
 from datetime import datetime
+from dataminion.metrics import NULL
 
 class Filter(object):
-    def __init__(self, config={}, logger=None, on_filter=None, coordinator=None, **kwargs):
+    def __init__(self, config={}, logger=None, on_filter=None, on_filter_batch=None, coordinator=None, metrics=None, **kwargs):
         log = logging.getLogger(__name__)
         self.logger = logger or log
         self._configuration = config
         self._coordinator = coordinator
         self._on_filter = on_filter
+        self._on_filter_batch = None
+        if hasattr(on_filter_batch, '__call__'):
+            self._on_filter_batch = on_filter_batch
+        self._batch = None
+        self._metrics = metrics or NULL
         self._mem = {}
         self._initialize()
         #getattr(sys.modules[__name__], "Zookeeper")
 
     def process(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
-            self.logger.debug("Filter has data: %s", data)
-            self._on_filter(data)
+        self.send_data(data)
+
+    def process_batch(self, data):
+        """Processes a list of events, everything they produce is handed over
+        as one list by send_batch"""
+        self._batch = []
+        for event in data:
+            try:
+                self.process(event)
+            except Exception:
+                self.logger.exception("Failed processing event %s", event)
+        batch = self._batch
+        self._batch = None
+        self.send_batch(batch)
 
     def get_memory(self, key):
         if key in self._mem:
@@ -31,16 +48,33 @@ class Filter(object):
         self.logger.info("Setting %s with data: %s", key, data)
         self._mem[key] = data
 
+    def partition_key(self, data):
+        """Key of the state an event depends on, events with the same key must
+        be processed in order by the same filter instance"""
+        return None
+
     def send_data(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
+        if self._batch is not None:
+            self._batch.append(data)
+        elif self._on_filter and hasattr(self._on_filter, '__call__'):
             self.logger.debug("Filter has data ready: %s", data)
             self._on_filter(data)
 
+    def send_batch(self, data):
+        if not data:
+            return
+        if self._on_filter_batch is not None:
+            self._on_filter_batch(data)
+        elif self._on_filter and hasattr(self._on_filter, '__call__'):
+            for event in data:
+                self._on_filter(event)
+
 class Passthrough(Filter):
     def _initialize(self):
         self.logger.info("Filter initialized")
 
     def process(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
-            self.logger.debug("Filter has data: %s", data)
-            self._on_filter(data)
+        self.send_data(data)
+
+    def process_batch(self, data):
+        self.send_batch(data)
@@ -1,4 +1,3 @@
-import pika
 import time
 
 import logging
@@ -8,21 +7,39 @@ import cStringIO
 import csv
 import re
 from datetime import datetime
+from dataminion.metrics import NULL
+from dataminion import timestamp
 
 class Filter(object):
-    def __init__(self, config={}, logger=None, on_filter=None, coordinator=None, **kwargs):
+    def __init__(self, config={}, logger=None, on_filter=None, on_filter_batch=None, coordinator=None, metrics=None, **kwargs):
         log = logging.getLogger(__name__)
         self.logger = logger or log
         self._configuration = config
         self._coordinator = coordinator
         self._on_filter = on_filter
+        self._on_filter_batch = None
+        if hasattr(on_filter_batch, '__call__'):
+            self._on_filter_batch = on_filter_batch
+        self._batch = None
+        self._metrics = metrics or NULL
         self._mem = {}
         self._initialize()
 
     def process(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
-            self.logger.debug("Filter has data: %s", data)
-            self._on_filter(data)
+        self.send_data(data)
+
+    def process_batch(self, data):
+        """Processes a list of events, everything they produce is handed over
+        as one list by send_batch"""
+        self._batch = []
+        for event in data:
+            try:
+                self.process(event)
+            except Exception:
+                self.logger.exception("Failed processing event %s", event)
+        batch = self._batch
+        self._batch = None
+        self.send_batch(batch)
 
     def get_memory(self, key):
         if key in self._mem:
@@ -33,19 +50,47 @@ class Filter(object):
         self.logger.info("Setting %s with data: %s", key, data)
         self._mem[key] = data
 
+    def partition_key(self, data):
+        """Key of the state an event depends on, events with the same key must
+        be processed in order by the same filter instance"""
+        return None
+
     def send_data(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
+        if self._batch is not None:
+            self._batch.append(data)
+        elif self._on_filter and hasattr(self._on_filter, '__call__'):
             self.logger.debug("Filter has data ready: %s", data)
             self._on_filter(data)
 
+    def send_batch(self, data):
+        if not data:
+            return
+        if self._on_filter_batch is not None:
+            self._on_filter_batch(data)
+        elif self._on_filter and hasattr(self._on_filter, '__call__'):
+            for event in data:
+                self._on_filter(event)
+
 class Harbour(Filter):
     def _initialize(self):
         self._required_fields = ('sourcetype', 'serviceid')
+        if "timestamp_format" not in self._configuration:
+            self._configuration["timestamp_format"] = timestamp.ISO
+        if self._configuration["timestamp_format"] not in timestamp.FORMATS:
+            raise ValueError("Unknown timestamp_format %s" % self._configuration["timestamp_format"])
+        self._stamp = timestamp.graphite
+        if self._configuration["timestamp_format"] == timestamp.EPOCH_MILLIS:
+            self._stamp = timestamp.epoch_millis
         self.logger.info("Filter initialized")
 
     def process(self, data):
+        if not isinstance(data, dict):
+            self._metrics.incr("filter.discard.not_dict")
+            self.logger.debug("Discarding non dict data: %s", data)
+            return None
         for key in self._required_fields:
             if key not in data:
+                self._metrics.incr("filter.discard.missing_field")
                 return None
         if data["sourcetype"] == "graphite":
             document = {}
@@ -54,12 +99,12 @@ class Harbour(Filter):
             components = data["message"].split(" ")
             metric_composite = components[0]
             value = components[1]
-            timestamp = components[2]
+            epoch = components[2]
             if len(components) > 2:
                 for i in range(3, len(components)):
                     (key, val) = components[i].split("=")
                     document[key] = val
-            document["@timestamp"] = datetime.utcfromtimestamp(float(timestamp)).strftime('%Y-%m-%dT%H:%M:%S.%f+0000')
+            document["@timestamp"] = self._stamp(float(epoch))
             metric_parts = metric_composite.split(".") 
             document["hostname"] = metric_parts[0]
             document["metric_name"] = ".".join(metric_parts[1:])
@@ -70,6 +115,7 @@ class Harbour(Filter):
                 document["metric_string"] = value
             self.send_data(document)
         else:
+            self._metrics.incr("filter.discard.sourcetype")
             self.logger.debug("Discarding data: %s", data)
             return None
         return None
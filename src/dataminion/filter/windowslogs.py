@@ -1,4 +1,3 @@
-import pika
 import time
 
 import logging
@@ -8,59 +7,396 @@ import cStringIO
 import csv
 import re
 from datetime import datetime
+from dataminion.metrics import NULL
+from dataminion import timestamp
+from dataminion.headers import HeaderMemory, HeaderWriter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Filter(object):
-    def __init__(self, config={}, logger=None, on_filter=None, coordinator=None, **kwargs):
+    def __init__(self, config={}, logger=None, on_filter=None, on_filter_batch=None, coordinator=None, metrics=None, **kwargs):
         log = logging.getLogger(__name__)
         self.logger = logger or log
         self._configuration = config
         self._coordinator = coordinator
         self._on_filter = on_filter
-        self._mem = {}
+        self._on_filter_batch = None
+        if hasattr(on_filter_batch, '__call__'):
+            self._on_filter_batch = on_filter_batch
+        self._batch = None
+        self._metrics = metrics or NULL
+        if "memory_size" not in self._configuration:
+            self._configuration["memory_size"] = 10000
+        if "memory_ttl" not in self._configuration:
+            self._configuration["memory_ttl"] = 0
+        if "memory_negative_ttl" not in self._configuration:
+            self._configuration["memory_negative_ttl"] = 30
+        if "memory_prefetch" not in self._configuration:
+            self._configuration["memory_prefetch"] = True
+        if "memory_write_window" not in self._configuration:
+            self._configuration["memory_write_window"] = 0.5
+        self._mem = HeaderMemory(coordinator=coordinator, size=self._configuration["memory_size"], ttl=self._configuration["memory_ttl"], negative_ttl=self._configuration["memory_negative_ttl"], prefetch=self._configuration["memory_prefetch"], metrics=self._metrics, on_evict=self.forget_memory, logger=self.logger)
+        self._writer = HeaderWriter(coordinator=coordinator, window=self._configuration["memory_write_window"], size=self._configuration["memory_size"], metrics=self._metrics, logger=self.logger)
         self._initialize()
 
     def process(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
-            self.logger.debug("Filter has data: %s", data)
-            self._on_filter(data)
+        self.send_data(data)
+
+    def process_batch(self, data):
+        """Processes a list of events, everything they produce is handed over
+        as one list by send_batch"""
+        self._batch = []
+        for event in data:
+            try:
+                self.process(event)
+            except Exception:
+                self.logger.exception("Failed processing event %s", event)
+        batch = self._batch
+        self._batch = None
+        self.send_batch(batch)
 
     def get_memory(self, key):
-        if key in self._mem:
-            return self._mem[key]
-        else:
-            if self._coordinator != None:
-                self._coordinator.watch_node(key)
-                value = self._coordinator.get(key)
-                if value != None:
-                    self.set_memory(key, value)
-                return value
-        return None
+        """Header known for key, None while it's unknown or being looked up,
+        see HeaderMemory"""
+        return self._mem.get(key)
 
     def set_memory(self, key, data):
         self.logger.info("Setting %s with data: %s", key, data)
-        self._mem[key] = data
+        self._mem.set(key, data)
+        self._writer.known(key, data)
 
     def unset_memory(self, key):
         self.logger.debug("Unsetting %s", key)
-        if key in self._mem:
-            del self._mem[key]
+        self._mem.unset(key)
+
+    def forget_memory(self, key):
+        """Called for keys the header memory dropped for lack of room"""
+
+    def stop(self):
+        """Writes headers still waiting to go to the coordinator"""
+        self._writer.stop()
+
+    def store_memory(self, key, data):
+        """Shares a header found in the stream through the coordinator and
+        remembers it, see HeaderWriter"""
+        self._writer.set(key, data)
+        self.set_memory(key, data)
+
+    def partition_key(self, data):
+        """Key of the state an event depends on, events with the same key must
+        be processed in order by the same filter instance"""
+        return None
 
     def send_data(self, data):
-        if self._on_filter and hasattr(self._on_filter, '__call__'):
+        if self._batch is not None:
+            self._batch.append(data)
+        elif self._on_filter and hasattr(self._on_filter, '__call__'):
             self.logger.debug("Filter has data ready: %s", data)
             self._on_filter(data)
 
+    def send_batch(self, data):
+        if not data:
+            return
+        if self._batch is not None:
+            self._batch.extend(data)
+        elif self._on_filter_batch is not None:
+            self._on_filter_batch(data)
+        elif self._on_filter and hasattr(self._on_filter, '__call__'):
+            for event in data:
+                self._on_filter(event)
+
+def _split_csv(line, width):
+    """Splits a perfmon CSV row, every value is quoted so a row without
+    quotes inside values splits on '","', anything else goes to csv"""
+    if line.count('"') == 2 * width and line[:1] == '"' and line[-1:] == '"':
+        return line[1:-1].split('","')
+    return csv.reader([line]).next()
+
+def _floats(cells):
+    """Converts a block of cells to floats in one go, None for cells that
+    aren't numbers"""
+    if numpy is not None:
+        try:
+            return numpy.array(cells, dtype=str).astype(numpy.float64).tolist()
+        except ValueError:
+            pass
+    converted = []
+    for cell in cells:
+        try:
+            converted.append(float(cell))
+        except ValueError:
+            converted.append(None)
+    return converted
+
+class _PerfmonRows(object):
+    """A perfmon header compiled into a row parser"""
+    sourcetype = "perfmon"
+
+    def __init__(self, header, required_fields, timestamp_format=timestamp.ISO):
+        self.header = header
+        self.required_fields = required_fields
+        self.stamp = timestamp.perfmon
+        if timestamp_format == timestamp.EPOCH_MILLIS:
+            self.stamp = timestamp.perfmon_millis
+        self.components = [(component["metric"], "resource" in component, component.get("resource")) for component in header["components"]]
+        self.width = len(self.components)
+        self.offset = header.get("timeoffset", "+0000")
+
+    def parse(self, data, send):
+        """Sends one document per counter, returns False when the row
+        doesn't match the header"""
+        values = _split_csv(data["perfmon_msg"], self.width + 1)
+        if len(values) - 1 != self.width:
+            return False
+        base = {}
+        for key in self.required_fields:
+            base[key] = data[key]
+        base["@timestamp"] = self.stamp(values[0], self.offset)
+        i = 1
+        for metric, has_resource, resource in self.components:
+            value = values[i]
+            i += 1
+            #a document per counter, they're queued and batched downstream
+            metric_document = dict(base)
+            try:
+                value = float(value)
+                metric_document["metric_value"] = value
+            except:
+                metric_document["metric_string"] = value
+            if has_resource:
+                metric_document["resource"] = resource
+            metric_document["metric_name"] = metric
+            send(metric_document)
+        return True
+
+    def records(self, rows):
+        """Columnar take on parse() for rows sharing this header: rows are
+        split into a block of cells converted to float at once, every
+        counter becomes it's own compact record. Returns the records, the
+        rows that don't match the header and the rows with a bad timestamp"""
+        stamps = []
+        cells = []
+        mismatched = []
+        failed = []
+        for data in rows:
+            values = _split_csv(data["perfmon_msg"], self.width + 1)
+            if len(values) - 1 != self.width:
+                mismatched.append(data)
+                continue
+            try:
+                stamp = self.stamp(values[0], self.offset)
+            except ValueError:
+                failed.append(data)
+                continue
+            base = {"@timestamp": stamp}
+            for key in self.required_fields:
+                base[key] = data[key]
+            stamps.append(base)
+            cells.extend(values[1:])
+        converted = _floats(cells)
+        records = []
+        i = 0
+        for base in stamps:
+            for metric, has_resource, resource in self.components:
+                value = converted[i]
+                if value is None:
+                    record = dict(base, metric_name=metric, metric_string=cells[i])
+                else:
+                    record = dict(base, metric_name=metric, metric_value=value)
+                if has_resource:
+                    record["resource"] = resource
+                records.append(record)
+                i += 1
+        return records, mismatched, failed
+
+class _W3CRows(object):
+    """An iis or tmg header compiled into a row parser: column names, the
+    indices of numeric columns and, for tmg, how date and time columns
+    make up the timestamp"""
+    def __init__(self, header, required_fields, numeric_fields, sourcetype, timestamp_format=timestamp.ISO):
+        self.header = header
+        self.sourcetype = sourcetype
+        self.millis = timestamp_format == timestamp.EPOCH_MILLIS
+        self.required_fields = required_fields
+        self.metric_name = sourcetype + ".request"
+        self.separator = " " if sourcetype == "iis" else "\t"
+        names = [component["metric"] for component in header["components"]]
+        self.width = len(names)
+        self.stamp_columns = []
+        if sourcetype == "tmg":
+            for i in range(0, self.width):
+                if names[i] in numeric_fields:
+                    continue
+                if names[i] == "date" or names[i] == "time":
+                    self.stamp_columns.append((names[i] == "date", i))
+        stamped = set([i for is_date, i in self.stamp_columns])
+        self.columns = [(names[i], i) for i in range(0, self.width) if i not in stamped]
+        self.numeric = [(names[i], i) for i in range(0, self.width) if names[i] in numeric_fields]
+        self.resource = None
+        if "resource" in header and self.width:
+            self.resource = header["components"][-1]["resource"]
+
+    def parse(self, data, send):
+        values = data[self.sourcetype + "_raw_msg"].split(self.separator)
+        if len(values) != self.width:
+            return False
+        document = {}
+        for key in self.required_fields:
+            document[key] = data[key]
+        stamp = values[0] + "T" + values[1] + "Z"
+        for is_date, i in self.stamp_columns:
+            if is_date:
+                stamp = values[i] + "T"
+            else:
+                stamp = stamp + values[i] + "Z"
+        if self.millis:
+            stamp = timestamp.w3c_millis(stamp)
+        document["@timestamp"] = stamp
+        document["metric_name"] = self.metric_name
+        document["metric_value"] = self.width
+        for name, i in self.columns:
+            document[name] = values[i]
+        for name, i in self.numeric:
+            document[name] = int(values[i])
+        if self.resource is not None:
+            document["resource"] = self.resource
+        if 'time_taken' in document:
+            document["metric_value"] = document["time_taken"]
+        send(document)
+        return True
+
 class MouraoMagic(Filter):
     def _initialize(self):
         self._required_fields = ('sourcetype', 'hostname', 'filename', 'serviceid')
+        if "columnar" not in self._configuration:
+            self._configuration["columnar"] = True
+        if "timestamp_format" not in self._configuration:
+            self._configuration["timestamp_format"] = timestamp.ISO
+        if self._configuration["timestamp_format"] not in timestamp.FORMATS:
+            raise ValueError("Unknown timestamp_format %s" % self._configuration["timestamp_format"])
+        #memokey: row parser compiled from the header in memory
+        self._parsers = {}
         self._numeric_fields = {'bytes_sent', 'bytes_sent_intermediate', 'bytes_received', 'bytes_received_intermediate', 'malwareinspectionduration', 'internal_service_info', 'r_port', 'cs_bytes', 'sc_bytes', 'sc_status', 'sc_substatus', 'sc_win32_status', 's_port', 'time_taken'}#{'time_taken', 'sc_win32_status', 'sc_substatus', 'sc_status', 's_port', 'sc_bytes', 'cs_bytes'}
         self.logger.info("Filter initialized")
 
+    def set_memory(self, key, data):
+        Filter.set_memory(self, key, data)
+        self._parsers.pop(key, None)
+
+    def unset_memory(self, key):
+        Filter.unset_memory(self, key)
+        self._parsers.pop(key, None)
+
+    def forget_memory(self, key):
+        self._parsers.pop(key, None)
+
+    def _parser(self, memokey, sourcetype):
+        """Returns the row parser for the header known for memokey, None when
+        there's no header yet"""
+        headers = self.get_memory(memokey)
+        if not headers:
+            return None
+        parser = self._parsers.get(memokey)
+        if parser is not None and parser.header is headers and parser.sourcetype == sourcetype:
+            return parser
+        if sourcetype == "perfmon":
+            parser = _PerfmonRows(headers, self._required_fields, self._configuration["timestamp_format"])
+        else:
+            parser = _W3CRows(headers, self._required_fields, self._numeric_fields, sourcetype, self._configuration["timestamp_format"])
+        self._parsers[memokey] = parser
+        return parser
+
+    def _perfmon_row(self, data):
+        """Whether data is a perfmon data row, the ones columnar mode batches"""
+        return data.get("sourcetype") == "perfmon" and "perfmon_msg" in data and not data["perfmon_msg"].startswith('"(PDH-CSV 4.0)')
+
+    def _perfmon_records(self, memokey, rows):
+        """Sends the records of perfmon data rows sharing memokey as one batch"""
+        parser = self._parser(memokey, "perfmon")
+        if not parser:
+            self._metrics.incr("filter.discard.no_header", len(rows))
+            self.logger.debug("Unknown perfmon form, no headers yet, discarding %s", self._mem)
+            return
+        records, mismatched, failed = parser.records(rows)
+        for data in mismatched:
+            self._metrics.incr("filter.discard.column_mismatch")
+            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(_split_csv(data["perfmon_msg"], parser.width + 1)) - 1, parser.width, memokey)
+        for data in failed:
+            self.logger.error("Bad timestamp in perfmon row, discarding %s", data)
+        self.send_batch(records)
+
+    def _flush_run(self, memokey, rows):
+        try:
+            self._perfmon_records(memokey, rows)
+        except Exception:
+            self.logger.exception("Failed processing %d perfmon rows of %s", len(rows), memokey)
+
+    def process_batch(self, data):
+        """Like Filter.process_batch, consecutive perfmon data rows of the
+        same file are parsed together in columnar mode"""
+        if not self._configuration["columnar"]:
+            return Filter.process_batch(self, data)
+        self._batch = []
+        run = []
+        runkey = None
+        for event in data:
+            try:
+                if self.partition_key(event) is not None and self._perfmon_row(event):
+                    memokey = self._memokey(event)
+                    if run and memokey != runkey:
+                        self._flush_run(runkey, run)
+                        run = []
+                    runkey = memokey
+                    run.append(event)
+                    continue
+            except Exception:
+                self.logger.exception("Failed processing event %s", event)
+                continue
+            if run:
+                self._flush_run(runkey, run)
+                run = []
+            try:
+                self.process(event)
+            except Exception:
+                self.logger.exception("Failed processing event %s", event)
+        if run:
+            self._flush_run(runkey, run)
+        batch = self._batch
+        self._batch = None
+        self.send_batch(batch)
+
+    @classmethod
+    def memory_prefixes(cls, config):
+        """Coordination nodes whose updates the filter wants, headers live
+        under the memo key prefix"""
+        if "coordinator_root" not in config:
+            return None
+        return [config["coordinator_root"] + "/" + __name__ + "/"]
+
+    def _memokey(self, data):
+        return self._configuration["coordinator_root"] + "/" + __name__ + "/_" + data["hostname"] + "_" + data["filename"]
+
+    def partition_key(self, data):
+        if not isinstance(data, dict):
+            return None
+        for key in self._required_fields:
+            if key not in data:
+                return None
+        return self._memokey(data)
+
     def process(self, data):
+        if not isinstance(data, dict):
+            self._metrics.incr("filter.discard.not_dict")
+            self.logger.debug("Discarding non dict data: %s", data)
+            return None
         for key in self._required_fields:
             if key not in data:
+                self._metrics.incr("filter.discard.missing_field")
                 return None
-        memokey = self._configuration["coordinator_root"] + "/" + __name__ + "/_" + data["hostname"] + "_" + data["filename"]
+        memokey = self._memokey(data)
         if data["sourcetype"] == "perfmon":
             if "perfmon_msg" in data:
                 if re.match('\"\(PDH-CSV 4.0\)', data["perfmon_msg"]):
@@ -99,41 +435,17 @@ class MouraoMagic(Filter):
                             metric = metric_group
                         header_msg["components"].append({ "metric": metric, "resource": resource })
                     self.logger.debug("Ended perfmon header processing %s", header_msg)
-                    self._coordinator.set(memokey, header_msg)
-                    self.set_memory(memokey, header_msg)
+                    self.store_memory(memokey, header_msg)
+                elif self._configuration["columnar"]:
+                    self._perfmon_records(memokey, [data])
                 else:
-                    headers = self.get_memory(memokey)
-                    if headers:
-                        document = {}
-                        metric_document = {}
-                        for key in self._required_fields:
-                            document[key] = data[key]
-                            metric_document[key] = data[key]
-                        values = csv.reader(cStringIO.StringIO(data["perfmon_msg"])).next()
-                        if len(values) - 1 == len(headers["components"]):
-                            if "timeoffset" in headers:
-                                offset = headers["timeoffset"]
-                            else:
-                                offset = "+0000"
-                            document["@timestamp"] = datetime.strptime(values[0], '%m/%d/%Y %H:%M:%S.%f').strftime('%Y-%m-%dT%H:%M:%S.%f') + offset
-                            document["metric_name"] = "all"
-                            document["metric_value"] = len(headers["components"])
-                            metric_document["@timestamp"] = document["@timestamp"]
-                            for i in range(0, len(headers["components"])):
-                                value = values[i + 1]
-                                try:
-                                    value = float(value)
-                                    metric_document["metric_value"] = value
-                                except:
-                                    metric_document["metric_string"] = value
-                                if "resource" in headers["components"][i]:
-                                    #document["resource"] = headers["components"][i]["resource"]
-                                    metric_document["resource"] = headers["components"][i]["resource"]
-                                metric_document["metric_name"] = headers["components"][i]["metric"]
-                                self.send_data(metric_document)
-                        else:
-                            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(values) - 1, len(headers["components"]), memokey)
+                    parser = self._parser(memokey, "perfmon")
+                    if parser:
+                        if not parser.parse(data, self.send_data):
+                            self._metrics.incr("filter.discard.column_mismatch")
+                            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(_split_csv(data["perfmon_msg"], parser.width + 1)) - 1, parser.width, memokey)
                     else:
+                        self._metrics.incr("filter.discard.no_header")
                         self.logger.debug("Unknown perfmon form, no headers yet, discarding %s", self._mem)
             else:
                 self.logger.warning("Assumed perfmon data was comming but found no message")
@@ -152,36 +464,19 @@ class MouraoMagic(Filter):
                         for i in range(1, len(components)):
                             if re.match('[a-zA-Z0-9._]', components[i]):
                                 header_msg["components"].append({ "metric": components[i].lower() })
-                        self._coordinator.set(memokey, header_msg)
-                        self.set_memory(memokey, header_msg)
+                        self.store_memory(memokey, header_msg)
                         self.logger.warning("Processed iis header")
                 elif len(data["iis_raw_msg"]) > 0:
-                    headers = self.get_memory(memokey)
-                    if headers:
-                        document = {}
-                        for key in self._required_fields:
-                            document[key] = data[key]
-                        values = data["iis_raw_msg"].split(" ")
-                        if len(values) == len(headers["components"]):
-                            document["@timestamp"] = values[0] + "T" + values[1] + "Z"
-                            document["metric_name"] = "iis.request"
-                            document["metric_value"] = len(headers["components"])
-                            for i in range(0, len(headers["components"])):
-                                if headers["components"][i]["metric"] in self._numeric_fields:
-                                    value = int(values[i])
-                                else:
-                                    value = values[i]
-                                document[headers["components"][i]["metric"]] = value
-                                if "resource" in headers:
-                                    document["resource"] = headers["components"][i]["resource"]
-                            if 'time_taken' in document:
-                                document["metric_value"] = document["time_taken"]
-                            self.send_data(document)
-                        else:
-                            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(values) - 1, len(headers["components"]), memokey)
+                    parser = self._parser(memokey, "iis")
+                    if parser:
+                        if not parser.parse(data, self.send_data):
+                            values = data["iis_raw_msg"].split(parser.separator)
+                            self._metrics.incr("filter.discard.column_mismatch")
+                            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(values) - 1, parser.width, memokey)
                             self.logger.warning("%s", values)
-                            self.logger.warning("%s", headers["components"])
+                            self.logger.warning("%s", parser.header["components"])
                     else:
+                        self._metrics.incr("filter.discard.no_header")
                         self.logger.debug("Unknown iis form, no headers yet, discarding %s", self._mem)
                 else:
                     self.logger.warning("Empty iis message? %s", data)
@@ -200,46 +495,24 @@ class MouraoMagic(Filter):
                         for i in range(0, len(components)):
                             if re.match('[a-zA-Z0-9._]', components[i]):
                                 header_msg["components"].append({ "metric": components[i].lower() })
-                        self._coordinator.set(memokey, header_msg)
-                        self.set_memory(memokey, header_msg)
+                        self.store_memory(memokey, header_msg)
                         self.logger.warning("Processed tmg header: %s", header_msg)
                 elif len(data["tmg_raw_msg"]) > 0:
-                    headers = self.get_memory(memokey)
-                    if headers:
-                        document = {}
-                        for key in self._required_fields:
-                            document[key] = data[key]
-                        values = data["tmg_raw_msg"].split("\t")
-                        if len(values) == len(headers["components"]):
-                            document["@timestamp"] = values[0] + "T" + values[1] + "Z"
-                            document["metric_name"] = "tmg.request"
-                            document["metric_value"] = len(headers["components"])
-                            for i in range(0, len(headers["components"])):
-                                if headers["components"][i]["metric"] in self._numeric_fields:
-                                    value = int(values[i])
-                                    document[headers["components"][i]["metric"]] = value
-                                elif headers["components"][i]["metric"] == 'date':
-                                    document["@timestamp"] = values[i] + "T"
-                                elif headers["components"][i]["metric"] == 'time':
-                                    document["@timestamp"] = document["@timestamp"] + values[i] + "Z"
-                                else:
-                                    value = values[i]
-                                    document[headers["components"][i]["metric"]] = value
-                                if "resource" in headers:
-                                    document["resource"] = headers["components"][i]["resource"]
-                            if 'time_taken' in document:
-                                document["metric_value"] = document["time_taken"]
-                            self.send_data(document)
-                            self.logger.debug("TMG Document: %s", document)
-                        else:
-                            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(values) - 1, len(headers["components"]), memokey)
+                    parser = self._parser(memokey, "tmg")
+                    if parser:
+                        if not parser.parse(data, self.send_data):
+                            values = data["tmg_raw_msg"].split(parser.separator)
+                            self._metrics.incr("filter.discard.column_mismatch")
+                            self.logger.warning("Different number of columns vs known header (%d/%d): %s", len(values) - 1, parser.width, memokey)
                             self.logger.warning("%s", values)
-                            self.logger.warning("%s", headers["components"])
+                            self.logger.warning("%s", parser.header["components"])
                     else:
+                        self._metrics.incr("filter.discard.no_header")
                         self.logger.debug("Unknown tmg form, no headers yet, discarding %s", data)
                 else:
                     self.logger.warning("Empty tmg message? %s", data)
         else:
+            self._metrics.incr("filter.discard.sourcetype")
             self.logger.debug("Discarding data: %s", data)
             return None
         return None
@@ -0,0 +1,274 @@
+"""Header memory of the filters, headers read from and written to the
+coordinator keyed by the node they're stored at"""
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+import Queue
+from collections import OrderedDict
+from dataminion.metrics import NULL
+
+class Prefetcher(threading.Thread):
+    """Runs coordinator lookups off the event path"""
+    def __init__(self):
+        threading.Thread.__init__(self, name="header-prefetch")
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self._queue = Queue.Queue()
+
+    def call(self, fn, *args):
+        self._queue.put((fn, args))
+
+    def run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception:
+                self.logger.exception("Header lookup failed")
+
+_prefetcher = None
+_prefetcher_pid = None
+_prefetcher_lock = threading.Lock()
+
+def prefetcher():
+    """The process wide prefetch thread, started on first use and again in
+    forked processes (ProcessPool workers), which don't inherit the thread"""
+    global _prefetcher, _prefetcher_pid
+    with _prefetcher_lock:
+        if _prefetcher is None or _prefetcher_pid != os.getpid():
+            _prefetcher = Prefetcher()
+            _prefetcher_pid = os.getpid()
+            _prefetcher.start()
+    return _prefetcher
+
+#negative cache entries
+_MISSING = object()
+
+class HeaderMemory(object):
+    """LRU/TTL bounded header cache in front of a coordinator, unknown keys
+    are remembered as missing for "negative_ttl" seconds"""
+    def __init__(self, coordinator=None, size=10000, ttl=0, negative_ttl=30, prefetch=True, metrics=None, on_evict=None, logger=None):
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self._coordinator = coordinator
+        self._size = size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._prefetch = prefetch
+        self._metrics = metrics or NULL
+        self._on_evict = None
+        if hasattr(on_evict, '__call__'):
+            self._on_evict = on_evict
+        self._lock = threading.Lock()
+        #key: (value, expires), expires 0 is never
+        self._entries = OrderedDict()
+        #key: token of the lookup in flight, set/unset void it
+        self._pending = {}
+        self._watched = set()
+        self._metrics.gauge("filter.header.size", self.__len__)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] is not _MISSING
+
+    def __repr__(self):
+        return "<HeaderMemory %d headers>" % len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return [key for key in self._entries if self._entries[key][0] is not _MISSING]
+
+    def _expires(self, ttl):
+        if ttl > 0:
+            return time.time() + ttl
+        return 0
+
+    def _store(self, key, value, expires):
+        """Inserts as most recently used, returns the keys evicted, caller
+        holds the lock"""
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires)
+        evicted = []
+        while len(self._entries) > self._size:
+            evicted.append(self._entries.popitem(last=False)[0])
+        return evicted
+
+    def _evicted(self, evicted):
+        if not evicted:
+            return
+        self._metrics.incr("filter.header.evicted", len(evicted))
+        if self._on_evict is not None:
+            for key in evicted:
+                self._on_evict(key)
+
+    def get(self, key):
+        """Returns the header for key, None when unknown (yet)"""
+        now = time.time()
+        refresh = False
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                value, expires = entry
+                self._entries[key] = entry
+                if not expires or expires > now:
+                    if value is _MISSING:
+                        self._metrics.incr("filter.header.negative")
+                        return None
+                    self._metrics.incr("filter.header.hit")
+                    return value
+                self._metrics.incr("filter.header.expired")
+                if value is not _MISSING and self._prefetch:
+                    #stale while it's looked up again
+                    refresh = True
+            else:
+                self._metrics.incr("filter.header.miss")
+            if self._coordinator is None:
+                return None
+            if self._prefetch:
+                if key not in self._pending:
+                    token = object()
+                    self._pending[key] = token
+                    prefetcher().call(self._lookup, key, token)
+                if refresh:
+                    return value
+                return None
+        return self._lookup(key, None)
+
+    def _lookup(self, key, token):
+        """Fetches key from the coordinator (watching it the first time) and
+        caches what's found, unless set/unset got there first"""
+        self._metrics.incr("filter.header.lookup")
+        try:
+            if key not in self._watched:
+                self._coordinator.watch_node(key)
+                self._watched.add(key)
+            value = self._coordinator.get(key)
+        except Exception:
+            with self._lock:
+                if token is not None and self._pending.get(key) is token:
+                    del self._pending[key]
+            raise
+        with self._lock:
+            if token is not None:
+                if self._pending.get(key) is not token:
+                    return None
+                del self._pending[key]
+            if value:
+                evicted = self._store(key, value, self._expires(self._ttl))
+            else:
+                evicted = self._store(key, _MISSING, self._expires(self._negative_ttl))
+        self._evicted(evicted)
+        if value:
+            return value
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._pending.pop(key, None)
+            evicted = self._store(key, value, self._expires(self._ttl))
+        self._evicted(evicted)
+
+    def unset(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._entries.pop(key, None)
+
+class HeaderWriter(object):
+    """Coalesces writes within "window" seconds and skips the ones the
+    coordinator already holds"""
+    def __init__(self, coordinator=None, window=0.5, size=10000, metrics=None, logger=None):
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self._coordinator = coordinator
+        self._window = window
+        self._size = size
+        self._metrics = metrics or NULL
+        self._lock = threading.Lock()
+        #node: content hash of it's last known value
+        self._hashes = OrderedDict()
+        #node: data waiting for the next flush
+        self._pending = OrderedDict()
+        self._timer = None
+        self._stopped = False
+
+    def _hash(self, data):
+        if isinstance(data, dict):
+            data = json.dumps(data, sort_keys=True)
+        return hashlib.md5(data.encode("utf-8") if isinstance(data, unicode) else data).digest()
+
+    def _remember(self, node, digest):
+        """Caller holds the lock"""
+        self._hashes.pop(node, None)
+        self._hashes[node] = digest
+        while len(self._hashes) > self._size:
+            self._hashes.popitem(last=False)
+
+    def known(self, node, data):
+        """Records a value the coordinator is known to hold for node, e.g.
+        one that came in through a watch"""
+        digest = self._hash(data)
+        with self._lock:
+            self._remember(node, digest)
+
+    def set(self, node, data):
+        """Writes data to node on the next flush, unless it's what the node
+        already holds"""
+        if self._coordinator is None:
+            return
+        digest = self._hash(data)
+        with self._lock:
+            if node not in self._pending and self._hashes.get(node) == digest:
+                self._metrics.incr("filter.header.unchanged")
+                return
+            if node in self._pending:
+                self._metrics.incr("filter.header.coalesced")
+            self._pending[node] = data
+            self._remember(node, digest)
+            if self._window <= 0 or self._stopped:
+                flush = True
+            else:
+                flush = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self._window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if flush:
+            self.flush()
+
+    def stop(self):
+        """Cancels the coalescing timer and writes whatever is pending, later
+        writes go out right away"""
+        with self._lock:
+            self._stopped = True
+            timer = self._timer
+            self._timer = None
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+    def flush(self):
+        """Writes whatever is pending"""
+        with self._lock:
+            self._timer = None
+            updates = self._pending.items()
+            self._pending = OrderedDict()
+        if not updates:
+            return
+        try:
+            if hasattr(self._coordinator, "update_many"):
+                self._coordinator.update_many(updates)
+            else:
+                for node, data in updates:
+                    self._coordinator.set(node, data)
+            self._metrics.incr("filter.header.written", len(updates))
+        except Exception:
+            self.logger.exception("Failed writing %d headers to the coordinator", len(updates))
+            with self._lock:
+                for node, data in updates:
+                    self._hashes.pop(node, None)
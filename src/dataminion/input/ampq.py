@@ -6,13 +6,81 @@ import sys
 
 import json
 import threading
+import Queue
+from pika.adapters.select_connection import IOLoop
+from dataminion.metrics import NULL
+from dataminion.pipeline import Checkpoint
+from dataminion import codec
 
 import traceback
 
+class SharedIOLoop(threading.Thread):
+    """A pika IO loop on it's own thread hosting the connections of any
+    number of inputs. pika isn't thread safe, other threads hand work over
+    with call() and it runs on the loop's next tick"""
+    def __init__(self, name="ioloop", interval=0.05, logger=None):
+        threading.Thread.__init__(self, name=name)
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self.daemon = True
+        self.ioloop = IOLoop()
+        self._interval = interval
+        self._calls = Queue.Queue()
+
+    def call(self, fn, *args):
+        self._calls.put((fn, args))
+
+    def _tick(self):
+        while True:
+            try:
+                fn, args = self._calls.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                fn(*args)
+            except Exception:
+                self.logger.exception("Failed running %s on %s", fn, self.name)
+        self.ioloop.add_timeout(self._interval, self._tick)
+
+    def run(self):
+        self.ioloop.add_timeout(0, self._tick)
+        self.ioloop.start()
+
+class SharedIOLoops(object):
+    """A fixed number of shared IO loops handed out round robin, started
+    on first use"""
+    def __init__(self, size=2):
+        self._lock = threading.Lock()
+        self._loops = []
+        self._size = size
+        self._next = 0
+
+    def get(self):
+        with self._lock:
+            if len(self._loops) < self._size:
+                loop = SharedIOLoop(name="ioloop-%d" % len(self._loops))
+                loop.start()
+                self._loops.append(loop)
+                return loop
+            loop = self._loops[self._next % self._size]
+            self._next += 1
+            return loop
+
+_ioloops = None
+_ioloops_lock = threading.Lock()
+
+def shared_ioloops(size=2):
+    """Returns the process wide loops, the first caller decides how many"""
+    global _ioloops
+    with _ioloops_lock:
+        if _ioloops is None:
+            _ioloops = SharedIOLoops(size)
+        return _ioloops
+
 class ampq(threading.Thread):
     """AMPQ wrapper class
     """
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, verbose=None, config={}, logger=None, on_data=None):
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, verbose=None, config={}, logger=None, on_data=None, on_data_batch=None, metrics=None):
         threading.Thread.__init__(self, group=group, target=target, name=name, verbose=verbose)
         self.args = args
         self.kwargs = kwargs
@@ -20,12 +88,27 @@ class ampq(threading.Thread):
         self.logger = logger or log
         self._configuration = config
         self._on_data = on_data
+        self._metrics = metrics or NULL
+        self._on_data_batch = None
+        if hasattr(on_data_batch, '__call__'):
+            self._on_data_batch = on_data_batch
+        self._batch = []
+        self._flow = threading.Event()
+        self._flow.set()
         if "add_field" not in self._configuration:
             self._configuration["add_field"] = {}
         self._initialize()
         return
         #getattr(sys.modules[__name__], "Zookeeper")
 
+    def pause(self):
+        """Asks the input to stop consuming, safe to call from any thread"""
+        self._flow.clear()
+
+    def resume(self):
+        """Asks the input to consume again, safe to call from any thread"""
+        self._flow.set()
+
     def stop(self):
         self.stopped = True
 
@@ -34,6 +117,9 @@ class RabbitMQ(ampq):
         #TODO (): consider less code, setup parameters with loops, less readable but less boring
         #TODO (): handle config variables:  enabled codec ssl tags verify_ssl
         self._closing = False
+        self._channel = None
+        self._consuming = False
+        self._paused = False
 
         C = None
         username = ""
@@ -44,6 +130,8 @@ class RabbitMQ(ampq):
             self._configuration["queue_bind"] = {}
         if "codec" not in self._configuration:
             self._configuration["codec"] = "plain"
+        self._codec = codec.get(self._configuration["codec"])
+        self._raw_fields = codec.fields(self._configuration["add_field"])
         if "ack" not in self._configuration:
             self._configuration["ack"] = True
         self._configuration["no_ack"] = not self._configuration["ack"]
@@ -53,6 +141,43 @@ class RabbitMQ(ampq):
             self._configuration["arguments"] = {}
         if "consumer_tag" not in self._configuration:
             self._configuration["consumer_tag"] = "DataminionXXX"
+        if "flow_interval" not in self._configuration:
+            self._configuration["flow_interval"] = 0.25
+        if "batch_size" not in self._configuration:
+            self._configuration["batch_size"] = 1
+        if "batch_timeout" not in self._configuration:
+            self._configuration["batch_timeout"] = 0.05
+        #ack_mode: "message" acks every message, "batch" acks "ack_batch"
+        #messages or whatever arrived in "ack_interval" ms at once, "commit"
+        #does the same but only once the output committed them
+        if "ack_mode" not in self._configuration:
+            self._configuration["ack_mode"] = "message"
+        if "ack_batch" not in self._configuration:
+            self._configuration["ack_batch"] = 500
+        if "ack_interval" not in self._configuration:
+            self._configuration["ack_interval"] = 200
+        if "prefetch_count" not in self._configuration and self._configuration["ack_mode"] != "message":
+            self._configuration["prefetch_count"] = 2 * self._configuration["ack_batch"]
+        self._ack_lock = threading.Lock()
+        self._reset_acks()
+        #consumers: connections consuming the same queue, each with it's own
+        #channel, prefetch and IO loop, all feeding the same pipeline
+        if "consumers" not in self._configuration:
+            self._configuration["consumers"] = 1
+        #engine: "thread" runs the input's own IO loop on it's thread, "loop"
+        #hosts the connection on one of "loops" IO loops shared by every
+        #input of the process and starts no thread at all
+        if "engine" not in self._configuration:
+            self._configuration["engine"] = "thread"
+        if "loops" not in self._configuration:
+            self._configuration["loops"] = 2
+        self._loop = None
+        self._detached = threading.Event()
+        if self._configuration["engine"] == "loop":
+            self._loop = shared_ioloops(self._configuration["loops"]).get()
+        self._siblings = []
+        for i in range(1, self._configuration["consumers"]):
+            self._siblings.append(self._sibling(i))
 
         if "user" in self._configuration:
             username = self._configuration["user"]
@@ -101,7 +226,10 @@ class RabbitMQ(ampq):
         self._channel.start_consuming()
     """
     def connect(self):
-        self._connection = pika.SelectConnection(pika.ConnectionParameters(**self._configuration["parameters"]), self._on_connection_open, stop_ioloop_on_close=False)
+        if self._loop is not None:
+            self._connection = pika.SelectConnection(pika.ConnectionParameters(**self._configuration["parameters"]), self._on_connection_open, stop_ioloop_on_close=False, custom_ioloop=self._loop.ioloop)
+        else:
+            self._connection = pika.SelectConnection(pika.ConnectionParameters(**self._configuration["parameters"]), self._on_connection_open, stop_ioloop_on_close=False)
         return self._connection
 
     def _on_connection_open(self, unused_connection):
@@ -113,13 +241,23 @@ class RabbitMQ(ampq):
 
     def _on_connection_closed(self, connection, reply_code, reply_text):
         self._channel = None
+        self._consuming = False
+        self._paused = False
+        self._reset_acks()
         if self._closing:
-            self._connection.ioloop.stop()
+            if self._loop is not None:
+                self._detached.set()
+            else:
+                self._connection.ioloop.stop()
         else:
             self.logger.warning('Connection closed, reopening in 5 seconds: (%s) %s', reply_code, reply_text)
             self._connection.add_timeout(5, self.reconnect)
 
     def reconnect(self):
+        if self._loop is not None:
+            # The loop is shared, just open a new connection on it
+            self._attach()
+            return
         # This is the old connection IOLoop instance, stop its ioloop
         self._connection.ioloop.stop()
         if not self._closing:
@@ -138,8 +276,25 @@ class RabbitMQ(ampq):
         else:
             self._channel.basic_qos(prefetch_count=1)
         self.add_on_channel_close_callback()
+        self.add_on_cancel_callback()
+        self._connection.add_timeout(self._configuration["flow_interval"], self._on_tick)
         self.setup_exchange()
 
+    def _on_tick(self):
+        """Runs periodically on the IO loop, pauses or resumes consumption as
+        asked by pause() and resume() from other threads"""
+        if self._channel is None or self._closing:
+            return
+        if self._flow.is_set():
+            if self._paused:
+                self.logger.info("Resuming consumption from %s", self._configuration["queue_bind"]["queue"])
+                self._paused = False
+                self.start_consuming()
+        elif self._consuming:
+            self.pause_consuming()
+        self._ack_committed()
+        self._connection.add_timeout(self._configuration["flow_interval"], self._on_tick)
+
     def add_on_channel_close_callback(self):
         self._channel.add_on_close_callback(self._on_channel_closed)
 
@@ -168,8 +323,8 @@ class RabbitMQ(ampq):
         self.start_consuming()
 
     def start_consuming(self):
-        self.add_on_cancel_callback()
-        self._consumer_tag = self._channel.basic_consume(consumer_callback=self._on_message, no_ack=self._configuration["ack"], exclusive=self._configuration["exclusive"], consumer_tag=self._configuration["consumer_tag"], queue=self._configuration["queue_bind"]["queue"])
+        self._consuming = True
+        self._consumer_tag = self._channel.basic_consume(consumer_callback=self._on_message, no_ack=self._configuration["no_ack"], exclusive=self._configuration["exclusive"], consumer_tag=self._configuration["consumer_tag"], queue=self._configuration["queue_bind"]["queue"])
 
     def add_on_cancel_callback(self):
         self._channel.add_on_cancel_callback(self._on_consumer_cancelled)
@@ -179,22 +334,129 @@ class RabbitMQ(ampq):
             self._channel.close()
 
     def _on_message(self, ch, method, properties, body):
-        data = None
-        if self._configuration["codec"] == "json":
-            try:
-                data = json.loads(body)
-                for key in self._configuration["add_field"]:
-                    data[key] = self._configuration["add_field"][key]
-                self._on_data(data)
-            except Exception, err:
-                self.logger.warning("Error processing message: %s", err)
-                print(sys.exc_info()[0])
-                print(traceback.format_exc())
-        else:
-            data = body
-        ch.basic_ack(delivery_tag = method.delivery_tag)
+        self._metrics.incr("input.messages")
+        try:
+            for data in self._codec.decode(body, properties.content_encoding, properties.content_type):
+                if isinstance(data, dict):
+                    for key in self._configuration["add_field"]:
+                        data[key] = self._configuration["add_field"][key]
+                elif self._raw_fields and isinstance(data, codec.RawEvent):
+                    data = codec.splice(data, self._raw_fields)
+                self._hand_over(data)
+        except Exception, err:
+            self._metrics.incr("input.errors")
+            self.logger.warning("Error processing message: %s", err)
+            print(sys.exc_info()[0])
+            print(traceback.format_exc())
+        if not self._configuration["no_ack"]:
+            self._acknowledge(ch, method.delivery_tag)
+        if self._consuming and not self._flow.is_set():
+            self.pause_consuming()
+
+    def _reset_acks(self):
+        """Delivery tags are per channel, forget them when it goes away"""
+        with self._ack_lock:
+            self._unacked = 0
+            self._last_tag = 0
+            self._acked_tag = 0
+            self._commit_tag = 0
+            self._commit_failed = False
+            self._ack_channel = None
+            self._ack_timer = None
+
+    def _acknowledge(self, channel, tag):
+        if self._configuration["ack_mode"] == "message":
+            channel.basic_ack(delivery_tag=tag)
+            return
+        self._unacked += 1
+        self._last_tag = tag
+        if self._unacked == 1:
+            self._ack_timer = self._connection.add_timeout(self._configuration["ack_interval"] / 1000.0, self._ack_window)
+        if self._unacked >= self._configuration["ack_batch"]:
+            self._ack_window()
+
+    def _ack_window(self):
+        """Acks everything delivered so far with one multiple ack or, in
+        "commit" mode, sends a checkpoint down the pipeline that gets it acked
+        once the output has committed what came before it"""
+        if self._ack_timer is not None:
+            self._connection.remove_timeout(self._ack_timer)
+            self._ack_timer = None
+        if self._unacked == 0 or self._channel is None:
+            return
+        tag = self._last_tag
+        channel = self._channel
+        self._unacked = 0
+        if self._configuration["ack_mode"] == "commit":
+            self._ack_channel = channel
+            self.flush_batch()
+            self._on_data(Checkpoint(on_commit=lambda: self._committed(channel, tag), on_fail=lambda: self._commit_fail(channel, tag)))
+            return
+        channel.basic_ack(delivery_tag=tag, multiple=True)
+        self._acked_tag = tag
+        self._metrics.incr("input.acks")
+
+    def _committed(self, channel, tag):
+        """Called by whichever thread committed the checkpoint, the ack itself
+        is sent from the IO loop on the next tick"""
+        with self._ack_lock:
+            if channel is self._ack_channel and tag > self._commit_tag and not self._commit_failed:
+                self._commit_tag = tag
+
+    def _commit_fail(self, channel, tag):
+        """The output lost events before tag, nothing from there on may be
+        acked. The channel is closed on the next tick so the broker requeues
+        every unacked message"""
+        with self._ack_lock:
+            if channel is self._ack_channel:
+                self._commit_failed = True
+
+    def _ack_committed(self):
+        with self._ack_lock:
+            tag = self._commit_tag
+            failed = self._commit_failed
+        if self._channel is None:
+            return
+        if tag > self._acked_tag:
+            self._channel.basic_ack(delivery_tag=tag, multiple=True)
+            self._acked_tag = tag
+            self._metrics.incr("input.acks")
+        if failed and self._channel.is_open:
+            self._metrics.incr("input.commit_failures")
+            self.logger.error("Output failed to commit after tag %d, closing the channel to get unacked messages redelivered", self._acked_tag)
+            self._channel.close()
+
+    def _hand_over(self, data):
+        """Passes decoded events on, one by one or, with "batch_size" above 1,
+        in lists of up to "batch_size" events or whatever arrived in
+        "batch_timeout" seconds"""
+        if self._on_data_batch is None or self._configuration["batch_size"] <= 1:
+            self._on_data(data)
+            return
+        self._batch.append(data)
+        if len(self._batch) == 1:
+            self._connection.add_timeout(self._configuration["batch_timeout"], self.flush_batch)
+        if len(self._batch) >= self._configuration["batch_size"]:
+            self.flush_batch()
+
+    def flush_batch(self):
+        if self._batch:
+            batch = self._batch
+            self._batch = []
+            self._on_data_batch(batch)
+
+    def pause_consuming(self):
+        """Cancels the consumer without closing the channel, messages already
+        delivered will still be handed over"""
+        self.logger.info("Pausing consumption from %s", self._configuration["queue_bind"]["queue"])
+        self._consuming = False
+        self._channel.basic_cancel(self._on_pauseok, self._consumer_tag)
+
+    def _on_pauseok(self, unused_frame):
+        self._paused = True
 
     def stop_consuming(self):
+        self._consuming = False
         self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
 
     def on_cancelok(self, unused_frame):
@@ -203,16 +465,82 @@ class RabbitMQ(ampq):
     def close_channel(self):
         self._channel.close()
 
+    def _sibling(self, i):
+        config = dict(self._configuration)
+        config["parameters"] = dict(self._configuration["parameters"])
+        config["queue_bind"] = dict(self._configuration["queue_bind"])
+        config["consumers"] = 1
+        config["consumer_tag"] = "%s-%d" % (self._configuration["consumer_tag"], i)
+        return self.__class__(name="%s-%d" % (self.name, i), config=config, logger=self.logger, on_data=self._on_data, on_data_batch=self._on_data_batch, metrics=self._metrics)
+
+    def pause(self):
+        ampq.pause(self)
+        for sibling in self._siblings:
+            sibling.pause()
+
+    def resume(self):
+        ampq.resume(self)
+        for sibling in self._siblings:
+            sibling.resume()
+
+    def start(self):
+        if self._loop is None:
+            return ampq.start(self)
+        for sibling in self._siblings:
+            sibling.start()
+        self.logger.info("Starting AMPQ input on %s", self._loop.name)
+        self._loop.call(self._attach)
+
+    def _attach(self):
+        """Opens the connection on the shared loop, retrying every 5 seconds
+        instead of taking the loop down when the broker can't be reached"""
+        if self._closing:
+            return
+        try:
+            self.connect()
+        except Exception, err:
+            self.logger.warning("Connection failed, retrying in 5 seconds: %s", err)
+            self._loop.ioloop.add_timeout(5, self._attach)
+
+    def is_alive(self):
+        if self._loop is None:
+            return ampq.is_alive(self)
+        return self._loop.is_alive() and not self._detached.is_set()
+
+    def join(self, timeout=None):
+        if self._loop is None:
+            return ampq.join(self, timeout)
+        self._detached.wait(timeout)
+
     def run(self):
+        for sibling in self._siblings:
+            sibling.start()
         self.logger.info("Starting AMPQ input")
         self._connection = self.connect()
         self._connection.ioloop.start()
 
     def stop(self):
         self._closing = True
-        self.stop_consuming()
-        self._connection.ioloop.start()
+        if self._loop is not None:
+            self._loop.call(self._shutdown)
+            self._detached.wait(5)
+        else:
+            self._shutdown()
+            if not self._detached.is_set():
+                self._connection.ioloop.start()
+        for sibling in self._siblings:
+            sibling.stop()
+            sibling.join(5)
         self.stopped = True
 
+    def _shutdown(self):
+        self.flush_batch()
+        if self._configuration["ack_mode"] == "batch":
+            self._ack_window()
+        if self._channel is None:
+            self._detached.set()
+            return
+        self.stop_consuming()
+
     def close_connection(self):
         self._connection.close()
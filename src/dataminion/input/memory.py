@@ -0,0 +1,75 @@
+#
+import time
+
+import logging
+import sys
+
+import threading
+from dataminion.metrics import NULL
+
+class memory(threading.Thread):
+    """In-memory input, stands in for a broker in benchmarks and tests
+    """
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, verbose=None, config={}, logger=None, on_data=None, on_data_batch=None, metrics=None):
+        threading.Thread.__init__(self, group=group, target=target, name=name, verbose=verbose)
+        self.args = args
+        self.kwargs = kwargs
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self._configuration = config
+        self._on_data = on_data
+        self._metrics = metrics or NULL
+        self._on_data_batch = None
+        if hasattr(on_data_batch, '__call__'):
+            self._on_data_batch = on_data_batch
+        self._flow = threading.Event()
+        self._flow.set()
+        self.finished = threading.Event()
+        self.stopped = False
+        if "add_field" not in self._configuration:
+            self._configuration["add_field"] = {}
+        self._initialize()
+
+    def pause(self):
+        self._flow.clear()
+
+    def resume(self):
+        self._flow.set()
+
+    def stop(self):
+        self.stopped = True
+        self._flow.set()
+
+class Memory(memory):
+    """Hands over every event of the "events" iterable once, as fast as the
+    pipeline takes them, and sets "finished" when done"""
+    def _initialize(self):
+        if "events" not in self._configuration:
+            self._configuration["events"] = []
+        if "batch_size" not in self._configuration:
+            self._configuration["batch_size"] = 1
+        self.daemon = True
+        self.sent = 0
+
+    def run(self):
+        self.logger.info("Starting memory input")
+        batch = []
+        for data in self._configuration["events"]:
+            if self.stopped:
+                break
+            if not self._flow.is_set():
+                self._flow.wait()
+            for key in self._configuration["add_field"]:
+                data[key] = self._configuration["add_field"][key]
+            self._metrics.incr("input.messages")
+            if self._on_data_batch is not None and self._configuration["batch_size"] > 1:
+                batch.append(data)
+                if len(batch) >= self._configuration["batch_size"]:
+                    self._on_data_batch(batch)
+                    batch = []
+            else:
+                self._on_data(data)
+            self.sent += 1
+        if batch:
+            self._on_data_batch(batch)
+        self.finished.set()
@@ -0,0 +1,208 @@
+#
+import logging
+import threading
+import time
+import json
+import BaseHTTPServer
+
+class Histogram(object):
+    """Latency histogram over fixed buckets (seconds), keeps count, sum and
+    max and estimates percentiles from bucket bounds"""
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.BUCKETS:
+            if value <= bound:
+                break
+            i += 1
+        self._counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i in range(0, len(self._counts)):
+            seen += self._counts[i]
+            if seen >= rank:
+                if i < len(self.BUCKETS):
+                    return min(self.BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        buckets = {}
+        for i in range(0, len(self.BUCKETS)):
+            buckets[str(self.BUCKETS[i])] = self._counts[i]
+        buckets["+Inf"] = self._counts[-1]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": buckets
+        }
+
+class Metrics(object):
+    """Counters, latency histograms and gauges of one directive.
+
+    Counters are named "<stage>.<what>" (e.g. "filter.in", "output.done",
+    "filter.discard.no_header"), histograms hold seconds, gauges are
+    callables read on snapshot (e.g. queue depth).
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            self._histograms[name].observe(value)
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def merge(self, counters):
+        """Adds counters collected elsewhere, e.g. in a worker process"""
+        with self._lock:
+            for name in counters:
+                self._counters[name] = self._counters.get(name, 0) + counters[name]
+
+    def drain(self):
+        """Returns counters and resets them"""
+        with self._lock:
+            counters = self._counters
+            self._counters = {}
+        return counters
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def snapshot(self):
+        gauges = {}
+        for name in self._gauges.keys():
+            try:
+                gauges[name] = self._gauges[name]()
+            except Exception:
+                gauges[name] = None
+        with self._lock:
+            histograms = {}
+            for name in self._histograms:
+                histograms[name] = self._histograms[name].snapshot()
+            return {"counters": dict(self._counters), "histograms": histograms, "gauges": gauges}
+
+class NullMetrics(object):
+    """Does nothing, used when no metrics are wanted"""
+    def incr(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def gauge(self, name, fn):
+        pass
+
+    def merge(self, counters):
+        pass
+
+NULL = NullMetrics()
+
+class Registry(object):
+    """All directive metrics of a serf, snapshots add per second rates of
+    every counter since the snapshot passed as "previous" or, without one,
+    since the registry started. Consumers keep their own previous snapshot
+    so they don't skew each other's rates"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._started = time.time()
+
+    def directive(self, name):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Metrics(name)
+            return self._metrics[name]
+
+    def remove(self, name):
+        with self._lock:
+            if name in self._metrics:
+                del self._metrics[name]
+
+    def snapshot(self, previous=None):
+        now = time.time()
+        with self._lock:
+            metrics = dict(self._metrics)
+        if previous is None:
+            elapsed = now - self._started
+            last = {}
+        else:
+            elapsed = now - previous["time"]
+            last = previous["directives"]
+        directives = {}
+        for name in metrics:
+            snapshot = metrics[name].snapshot()
+            before = {}
+            if name in last:
+                before = last[name]["counters"]
+            rates = {}
+            for counter in snapshot["counters"]:
+                if elapsed > 0:
+                    rates[counter] = (snapshot["counters"][counter] - before.get(counter, 0)) / elapsed
+            snapshot["rates"] = rates
+            directives[name] = snapshot
+        return {"time": now, "uptime": now - self._started, "interval": elapsed, "directives": directives}
+
+class _StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/stats"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.registry.snapshot(), sort_keys=True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+class StatsServer(threading.Thread):
+    """Serves the registry snapshot as JSON on http://<bind>:<port>/stats"""
+    def __init__(self, registry, bind="127.0.0.1", port=8765, logger=None):
+        threading.Thread.__init__(self, name="stats")
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self.daemon = True
+        self._server = BaseHTTPServer.HTTPServer((bind, port), _StatsHandler)
+        self._server.registry = registry
+
+    def run(self):
+        self.logger.info("Serving stats on %s:%d", *self._server.server_address)
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
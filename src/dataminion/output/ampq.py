@@ -4,22 +4,38 @@ import json
 
 import logging
 import sys
+import random
+import threading
+import collections
+from pika.adapters.select_connection import IOLoop
+from dataminion.metrics import NULL
+from dataminion.spool import Spool
+from dataminion.pipeline import Checkpoint
+from dataminion import codec
 
 class ampq(object):
     """AMPQ wrapper class
     """
 
-    def __init__(self, config={}, logger=None, on_write=None, **kwargs):
+    def __init__(self, config={}, logger=None, on_write=None, metrics=None, **kwargs):
         log = logging.getLogger(__name__)
         self.logger = logger or log
         self._configuration = config
         self._on_write = on_write
+        self._metrics = metrics or NULL
         if "add_field" not in self._configuration:
             self._configuration["add_field"] = {}
         self._initialize()
     def process(self, data):
         self.write(data)
 
+    def process_batch(self, data):
+        self.write_batch(data)
+
+    def write_batch(self, data):
+        for event in data:
+            self.write(event)
+
 class RabbitMQ(ampq):
     def _initialize(self):
         C = None
@@ -32,6 +48,37 @@ class RabbitMQ(ampq):
             self._configuration["queue_bind"] = {}
         if "arguments" not in self._configuration:
             self._configuration["arguments"] = {}
+        if "codec" not in self._configuration:
+            self._configuration["codec"] = "json"
+        self._codec = codec.get(self._configuration["codec"])
+        self._raw_fields = codec.fields(self._configuration["add_field"])
+        self._properties = pika.BasicProperties(content_type=self._codec.content_type, content_encoding=self._codec.content_encoding)
+        #spool: {"directory": ..., "max_bytes": ..., "segment_bytes": ...}
+        #keeps messages on disk while the broker is unreachable instead of
+        #dropping them, they're published again in order once it's back
+        if "spool" not in self._configuration:
+            self._configuration["spool"] = None
+        if "retry_backoff" not in self._configuration:
+            self._configuration["retry_backoff"] = 0.5
+        if "retry_max_backoff" not in self._configuration:
+            self._configuration["retry_max_backoff"] = 30
+        #frame_events: events packed in one message, sent when full or
+        #"frame_interval" ms after the first one. Use a codec the input can
+        #split, "json_lines", "raw_lines" or "msgpack", compressed or not
+        if "frame_events" not in self._configuration:
+            self._configuration["frame_events"] = 1
+        if self._configuration["frame_events"] > 1 and not self._codec.framed:
+            self.logger.warning("Codec %s can't frame events, ignoring frame_events", self._codec.name)
+            self._configuration["frame_events"] = 1
+        if "frame_interval" not in self._configuration:
+            self._configuration["frame_interval"] = 200
+        self._frame = []
+        self._frame_started = None
+        self._frame_lock = threading.Lock()
+        self._framer = None
+        #messages dropped since the last commit, checkpoints behind them fail
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
 
         if "user" in self._configuration:
             username = self._configuration["user"]
@@ -71,33 +118,178 @@ class RabbitMQ(ampq):
             self._configuration["type"] = None
         else:
             self._configuration["type"] = None
+        self._channel_lock = threading.RLock()
+        self._stopping = threading.Event()
+        self._spool = None
+        self._replayer = None
+        self.connect()
+        if self._configuration["spool"]:
+            spool = self._configuration["spool"]
+            self._spool = Spool(spool["directory"], max_bytes=spool.get("max_bytes", 1073741824), segment_bytes=spool.get("segment_bytes", 67108864), fsync=spool.get("fsync", False), metrics=self._metrics, logger=self.logger)
+            self._replayer = threading.Thread(target=self._replay_spool, name="ampq-spool")
+            self._replayer.daemon = True
+            self._replayer.start()
+        if self._configuration["frame_events"] > 1:
+            self._framer = threading.Thread(target=self._flush_frames, name="ampq-framer")
+            self._framer.daemon = True
+            self._framer.start()
+
+    def connect(self):
         self._connection = pika.BlockingConnection(pika.ConnectionParameters(**self._configuration["parameters"]))
         self._channel = self._connection.channel()
         self._channel.exchange_declare(exchange=self._configuration["queue_bind"]["exchange"], exchange_type=self._configuration["exchange_type"], passive=self._configuration["passive"], durable=self._configuration["durable"], auto_delete=self._configuration["auto_delete"], internal=self._configuration["internal"], arguments=self._configuration["arguments"])
 
-    def write(self, data):
-        self.logger.debug("Got some data to write: %s", data)
+    def _prepare(self, data):
+        """Returns the event with add_field applied"""
         if isinstance(data, dict):
             for key in self._configuration["add_field"]:
                 data[key] = self._configuration["add_field"][key]
-            message = json.dumps(data)
-        else:
-            message = data
-        try:
-            self._channel.basic_publish(exchange=self._configuration["queue_bind"]["exchange"], routing_key=self._configuration["queue_bind"]["routing_key"], body=message)
-        except:
-            self._failures += 1
-            if (self._failures % 4 == 0):
-                self.logger.error("Failure dispatching, trying to reconnect")
-                self.stop()
-                self._initialize()
-            else:
-                self.logger.error("Failure dispatching, waiting for %d failures to take action", self._failures % 4)
+        elif self._raw_fields and isinstance(data, codec.RawEvent):
+            data = codec.splice(data, self._raw_fields)
+        return data
+
+    def _encode(self, data):
+        """Returns the event with add_field applied and it's message body"""
+        data = self._prepare(data)
+        if isinstance(data, dict):
+            return data, self._codec.encode([data])
+        return data, self._codec.compress(data)
 
+    def write(self, data):
+        self.logger.debug("Got some data to write: %s", data)
+        if self._framer is not None:
+            self.write_batch([data])
+            return
+        data, message = self._encode(data)
+        self._send(message)
         if self._on_write and hasattr(self._on_write, '__call__'):
             self._on_write(data)
 
+    def write_batch(self, data):
+        if self._framer is None:
+            for event in data:
+                self.write(event)
+            return
+        frames = []
+        with self._frame_lock:
+            for event in data:
+                event = self._prepare(event)
+                if not self._frame:
+                    self._frame_started = time.time()
+                self._frame.append(event)
+                if len(self._frame) >= self._configuration["frame_events"]:
+                    frames.append(self._frame)
+                    self._frame = []
+        for frame in frames:
+            self._send_frame(frame)
+        if self._on_write and hasattr(self._on_write, '__call__'):
+            for event in data:
+                self._on_write(event)
+
+    def _send_frame(self, frame):
+        properties = pika.BasicProperties(content_type=self._codec.content_type, content_encoding=self._codec.content_encoding, headers={"x-dataminion-events": len(frame)})
+        self._send(self._codec.encode(frame), properties)
+        self._metrics.incr("output.frames")
+
+    def flush_frame(self):
+        with self._frame_lock:
+            frame = self._frame
+            self._frame = []
+        if frame:
+            self._send_frame(frame)
+
+    def _flush_frames(self):
+        interval = self._configuration["frame_interval"] / 1000.0
+        while not self._stopping.wait(interval / 2):
+            started = self._frame_started
+            if self._frame and started is not None and time.time() - started >= interval:
+                try:
+                    self.flush_frame()
+                except Exception:
+                    self.logger.exception("Failed sending frame")
+
+    def commit(self, checkpoint):
+        self.flush_frame()
+        with self._dropped_lock:
+            dropped = self._dropped
+            self._dropped = 0
+        if dropped:
+            self.logger.error("Dropped %d messages since the last commit, failing checkpoint", dropped)
+            checkpoint.fail()
+        else:
+            checkpoint.commit()
+
+    def _send(self, message, properties=None):
+        if self._spool is not None and not self._spool.empty() and self._spool.put([message]):
+            #still catching up, keep the order
+            self._metrics.incr("output.spooled")
+        else:
+            try:
+                self.publish(message, properties)
+            except:
+                self._metrics.incr("output.publish_failures")
+                if self._spool is not None and self._spool.put([message]):
+                    self._metrics.incr("output.spooled")
+                    self.logger.error("Failure dispatching, spooled the message")
+                else:
+                    self._metrics.incr("output.dropped")
+                    with self._dropped_lock:
+                        self._dropped += 1
+                    self._failures += 1
+                    if (self._failures % 4 == 0):
+                        self.logger.error("Failure dispatching, trying to reconnect")
+                        self.reconnect()
+                    else:
+                        self.logger.error("Failure dispatching, waiting for %d failures to take action", self._failures % 4)
+
+    def publish(self, message, properties=None):
+        with self._channel_lock:
+            self._channel.basic_publish(exchange=self._configuration["queue_bind"]["exchange"], routing_key=self._configuration["queue_bind"]["routing_key"], body=message, properties=properties or self._properties)
+        self._metrics.incr("output.published")
+
+    def reconnect(self):
+        with self._channel_lock:
+            self.close()
+            self.connect()
+
+    def _replay_spool(self):
+        """Publishes spooled messages in order, reconnecting and backing off
+        while the broker is away"""
+        attempt = 0
+        while not self._stopping.is_set():
+            if self._spool.empty():
+                self._stopping.wait(1.0)
+                continue
+            records, positions = self._spool.read(100)
+            sent = 0
+            try:
+                for message in records:
+                    self.publish(message)
+                    sent += 1
+                attempt = 0
+            except Exception:
+                self._metrics.incr("output.publish_failures")
+                attempt += 1
+                self._stopping.wait(random.uniform(0, min(self._configuration["retry_max_backoff"], self._configuration["retry_backoff"] * 2 ** attempt)))
+                try:
+                    self.reconnect()
+                except Exception, err:
+                    self.logger.warning("Failed reconnecting: %s", err)
+            if sent:
+                self._spool.ack(positions[sent - 1])
+                self._metrics.incr("output.unspooled", sent)
+
     def stop(self):
+        self._stopping.set()
+        if self._framer is not None:
+            self._framer.join()
+            self.flush_frame()
+        if self._replayer is not None:
+            self._replayer.join()
+            self._spool.close()
+        self.close()
+
+    def close(self):
         try:
             self._channel.close()
         except:
@@ -106,3 +298,250 @@ class RabbitMQ(ampq):
             self._connection.close()
         except:
             self.logger.error("Failure closing connection (stop)")
+
+class _Publisher(threading.Thread):
+    """A connection with a confirm mode channel on it's own IO loop thread,
+    shared by the PooledRabbitMQ outputs publishing to that broker.
+
+    Messages are queued by publish() from any thread and sent on the next
+    tick, they're kept until the broker confirms them: nacked ones are sent
+    again and so is everything unconfirmed after a reconnect, both back in
+    their original order. publish()
+    blocks while "max_unconfirmed" messages are queued or unconfirmed"""
+    def __init__(self, name, parameters, max_unconfirmed=1000, interval=0.02, logger=None):
+        threading.Thread.__init__(self, name=name)
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self.daemon = True
+        self._parameters = parameters
+        self._max_unconfirmed = max_unconfirmed
+        self._interval = interval
+        self._ioloop = IOLoop()
+        self._connection = None
+        self._channel = None
+        self._cond = threading.Condition()
+        #(sequence, message, metrics) waiting for the channel
+        self._pending = collections.deque()
+        self._declarations = []
+        self._declared = 0
+        #delivery tag: (sequence, message, metrics)
+        self._unconfirmed = collections.OrderedDict()
+        self._tag = 0
+        self._sequence = 0
+        self._outstanding = 0
+        #every sequence below _low is confirmed, _done holds confirmed ones above
+        self._low = 1
+        self._done = set()
+        self._checkpoints = collections.deque()
+
+    def declare(self, **kwargs):
+        with self._cond:
+            self._declarations.append(kwargs)
+
+    def publish(self, messages, metrics):
+        """Queues (exchange, routing_key, body, properties) messages"""
+        with self._cond:
+            while self._outstanding >= self._max_unconfirmed:
+                metrics.incr("output.backpressure")
+                self._cond.wait(1.0)
+            for message in messages:
+                self._sequence += 1
+                self._pending.append((self._sequence, message, metrics))
+            self._outstanding += len(messages)
+
+    def commit(self, checkpoint):
+        """Commits the checkpoint once everything queued before it has been
+        confirmed"""
+        with self._cond:
+            if self._low > self._sequence:
+                ready = True
+            else:
+                ready = False
+                self._checkpoints.append((self._sequence, checkpoint))
+        if ready:
+            checkpoint.commit()
+
+    def outstanding(self):
+        return self._outstanding
+
+    def run(self):
+        self._ioloop.add_timeout(0, self._connect)
+        self._ioloop.add_timeout(self._interval, self._tick)
+        self._ioloop.start()
+
+    def _connect(self):
+        try:
+            self._connection = pika.SelectConnection(self._parameters, self._on_connection_open, stop_ioloop_on_close=False, custom_ioloop=self._ioloop)
+        except Exception, err:
+            self.logger.warning("Connection to %s failed, retrying in 5 seconds: %s", self.name, err)
+            self._ioloop.add_timeout(5, self._connect)
+
+    def _on_connection_open(self, connection):
+        connection.add_on_close_callback(self._on_connection_closed)
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_confirm)
+        self._declared = 0
+        with self._cond:
+            #the broker numbers delivery tags from 1 again on every channel
+            self._requeue(self._unconfirmed.values())
+            self._unconfirmed.clear()
+            self._tag = 0
+        self._channel = channel
+        self.logger.info("Publishing to %s", self.name)
+
+    def _on_channel_closed(self, channel, reply_code, reply_text):
+        self.logger.warning("Channel to %s was closed: (%s) %s", self.name, reply_code, reply_text)
+        self._channel = None
+        self._connection.close()
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        self._channel = None
+        with self._cond:
+            #unconfirmed messages go out again, in order, on the next connection
+            self._requeue(self._unconfirmed.values())
+            self._unconfirmed.clear()
+        self.logger.warning("Connection to %s closed, reopening in 5 seconds: (%s) %s", self.name, reply_code, reply_text)
+        self._ioloop.add_timeout(5, self._connect)
+
+    def _requeue(self, entries):
+        """Puts (sequence, message, metrics) entries back in the pending queue
+        in sequence order, caller holds the lock"""
+        if not entries:
+            return
+        self._pending = collections.deque(sorted(list(self._pending) + list(entries), key=lambda entry: entry[0]))
+
+    def _tick(self):
+        try:
+            self._flush()
+        except Exception:
+            self.logger.exception("Failed publishing to %s", self.name)
+        self._ioloop.add_timeout(self._interval, self._tick)
+
+    def _flush(self):
+        if self._channel is None:
+            return
+        with self._cond:
+            declarations = self._declarations[self._declared:]
+            self._declared = len(self._declarations)
+            messages = list(self._pending)
+            self._pending.clear()
+        for declaration in declarations:
+            self._channel.exchange_declare(callback=None, **declaration)
+        for sequence, message, metrics in messages:
+            exchange, routing_key, body, properties = message
+            self._channel.basic_publish(exchange, routing_key, body, properties)
+            self._tag += 1
+            self._unconfirmed[self._tag] = (sequence, message, metrics)
+            metrics.incr("output.published")
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        ready = []
+        nacked = []
+        with self._cond:
+            for tag in tags:
+                if tag not in self._unconfirmed:
+                    continue
+                sequence, message, metrics = self._unconfirmed.pop(tag)
+                if not acked:
+                    metrics.incr("output.nacked")
+                    nacked.append((sequence, message, metrics))
+                    continue
+                metrics.incr("output.confirmed")
+                self._done.add(sequence)
+                self._outstanding -= 1
+            self._requeue(nacked)
+            while self._low in self._done:
+                self._done.remove(self._low)
+                self._low += 1
+            while self._checkpoints and self._checkpoints[0][0] < self._low:
+                ready.append(self._checkpoints.popleft()[1])
+            self._cond.notify_all()
+        for checkpoint in ready:
+            checkpoint.commit()
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+def publishers(parameters, size=2, max_unconfirmed=1000):
+    """Returns the process wide publishers to the broker of parameters,
+    starting "size" of them on first use"""
+    key = (parameters.host, parameters.port, parameters.virtual_host, parameters.credentials.username)
+    with _publishers_lock:
+        if key not in _publishers:
+            _publishers[key] = []
+            for i in range(0, size):
+                publisher = _Publisher("amqp://%s:%s%s#%d" % (parameters.host, parameters.port, parameters.virtual_host, i), parameters, max_unconfirmed=max_unconfirmed)
+                publisher.start()
+                _publishers[key].append(publisher)
+        return _publishers[key]
+
+class PooledRabbitMQ(RabbitMQ):
+    """Publishes through connections shared by every PooledRabbitMQ output
+    of the process going to the same broker ("pool_size" of them, each
+    output sticks to one so it's messages stay in order), asynchronously
+    and with publisher confirms. Writers block while the broker is
+    "max_unconfirmed" messages behind and commit() waits for confirms.
+
+    Messages never fail synchronously, they're kept until confirmed, so
+    "spool" doesn't apply."""
+    _counter = 0
+
+    def connect(self):
+        if self._configuration["spool"]:
+            self.logger.warning("PooledRabbitMQ keeps messages until confirmed, ignoring spool")
+            self._configuration["spool"] = None
+        if "pool_size" not in self._configuration:
+            self._configuration["pool_size"] = 2
+        if "max_unconfirmed" not in self._configuration:
+            self._configuration["max_unconfirmed"] = 1000
+        pool = publishers(pika.ConnectionParameters(**self._configuration["parameters"]), size=self._configuration["pool_size"], max_unconfirmed=self._configuration["max_unconfirmed"])
+        self._publisher = pool[PooledRabbitMQ._counter % len(pool)]
+        PooledRabbitMQ._counter += 1
+        self._publisher.declare(exchange=self._configuration["queue_bind"]["exchange"], exchange_type=self._configuration["exchange_type"], passive=self._configuration["passive"], durable=self._configuration["durable"], auto_delete=self._configuration["auto_delete"], internal=self._configuration["internal"], arguments=self._configuration["arguments"])
+        self._metrics.gauge("output.unconfirmed", self._publisher.outstanding)
+
+    def publish(self, message, properties=None):
+        self._publisher.publish([(self._configuration["queue_bind"]["exchange"], self._configuration["queue_bind"]["routing_key"], message, properties or self._properties)], self._metrics)
+
+    def write_batch(self, data):
+        if self._framer is not None:
+            return RabbitMQ.write_batch(self, data)
+        messages = []
+        for event in data:
+            event, message = self._encode(event)
+            messages.append((self._configuration["queue_bind"]["exchange"], self._configuration["queue_bind"]["routing_key"], message, self._properties))
+            if self._on_write and hasattr(self._on_write, '__call__'):
+                self._on_write(event)
+        self._publisher.publish(messages, self._metrics)
+
+    def commit(self, checkpoint):
+        self.flush_frame()
+        self._publisher.commit(checkpoint)
+
+    def reconnect(self):
+        pass
+
+    def stop(self):
+        """Waits (up to 30 seconds) for what this output queued to be
+        confirmed, the shared connections stay up"""
+        self._stopping.set()
+        if self._framer is not None:
+            self._framer.join()
+            self.flush_frame()
+        done = threading.Event()
+        self._publisher.commit(Checkpoint(on_commit=done.set))
+        if not done.wait(30):
+            self.logger.warning("Stopped with messages still unconfirmed by %s", self._publisher.name)
@@ -1,24 +1,73 @@
 import time
 import json
+import os
+import random
 
 import logging
 import sys
+import threading
+import Queue
 
 #import elasticsearch
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from dataminion.metrics import NULL
+from dataminion.spool import Spool
+from dataminion import codec
 #es = Elasticsearch()
 
 
+class BulkController(object):
+    """Additive increase, multiplicative decrease of the bulk size and of
+    the number of bulks in flight. A bulk slower than "target_latency" or
+    with rejections (429, es_rejected_execution) shrinks the size by
+    "decrease", rejections also drop one sender. A clean bulk under the
+    target grows the size by "increase" and, under half the target, adds a
+    sender"""
+    def __init__(self, size, min_size, max_size, concurrency, max_concurrency, target_latency, increase, decrease, metrics=None):
+        self._lock = threading.Lock()
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self._metrics = metrics or NULL
+        self._metrics.gauge("output.adaptive.bulkactions", lambda: self.size)
+        self._metrics.gauge("output.adaptive.concurrency", lambda: self.concurrency)
+
+    def record(self, latency, rejected):
+        with self._lock:
+            if rejected or latency > self.target_latency:
+                self.size = max(self.min_size, int(self.size * self.decrease))
+                if rejected:
+                    self.concurrency = max(1, self.concurrency - 1)
+                self._metrics.incr("output.adaptive.decrease")
+                return
+            if self.size < self.max_size:
+                self.size = min(self.max_size, self.size + self.increase)
+                self._metrics.incr("output.adaptive.increase")
+            if latency < self.target_latency / 2 and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._metrics.incr("output.adaptive.increase")
+
+def _rejected(result):
+    if result.get("status") == 429:
+        return True
+    return "es_rejected_execution" in str(result.get("error", ""))
+
 class es(object):
     """AMPQ wrapper class
     """
 
-    def __init__(self, config={}, logger=None, on_write=None, **kwargs):
+    def __init__(self, config={}, logger=None, on_write=None, metrics=None, **kwargs):
         log = logging.getLogger(__name__)
         self.logger = logger or log
         self._configuration = config
         self._on_write = on_write
+        self._metrics = metrics or NULL
         if "add_field" not in self._configuration:
             self._configuration["add_field"] = {}
         self._initialize()
@@ -26,6 +75,13 @@ class es(object):
     def process(self, data):
         self.write(data)
 
+    def process_batch(self, data):
+        self.write_batch(data)
+
+    def write_batch(self, data):
+        for event in data:
+            self.write(event)
+
 class StreamMinion(es):
     def _initialize(self):
         #for parameter in ('virtual_host', 'backpressure_detection', 'channel_max', 'connection_attempts', 'frame_max', 'heartbeat', 'host', 'locale', 'port', 'retry_delay', 'ssl', 'ssl_options', 'socket_timeout'):
@@ -82,22 +138,379 @@ class StreamMinion(es):
             self._configuration["raise_on_exception"] = True
         if "raise_on_error" not in self._configuration:
             self._configuration["raise_on_error"] = True
+        #items failing with a status in "retry_on" ("N/A" is a connection
+        #error) are sent again up to "retries" times, waiting a random time
+        #up to "retry_backoff" * 2^attempt seconds. What still fails is
+        #appended to the "dead_letter" file, see replay()
+        if "retries" not in self._configuration:
+            self._configuration["retries"] = 3
+        if "retry_on" not in self._configuration:
+            self._configuration["retry_on"] = [429, 503, "N/A"]
+        if "retry_backoff" not in self._configuration:
+            self._configuration["retry_backoff"] = 0.5
+        if "retry_max_backoff" not in self._configuration:
+            self._configuration["retry_max_backoff"] = 30
+        if "dead_letter" not in self._configuration:
+            self._configuration["dead_letter"] = None
+        if "replay_on_start" not in self._configuration:
+            self._configuration["replay_on_start"] = False
+        #spool: {"directory": ..., "max_bytes": ..., "segment_bytes": ...}
+        #keeps documents on disk while Elasticsearch is unreachable instead
+        #of failing the bulk, they're sent again in order once it's back
+        if "spool" not in self._configuration:
+            self._configuration["spool"] = None
+        #raw events (JSON strings, see codec "raw") are indexed as they are
+        #into "index", add_field is spliced in
+        if "index" not in self._configuration:
+            self._configuration["index"] = "dataminion"
+        raw_action = {"_index": self._configuration["index"]}
+        if "document_type" in self._configuration:
+            raw_action["_type"] = self._configuration["document_type"]
+        self._raw_action = json.dumps({"index": raw_action})
+        self._raw_fields = codec.fields(self._configuration["add_field"])
+        #seconds the oldest buffered action may wait before it's sent
+        if "flush_interval" not in self._configuration:
+            self._configuration["flush_interval"] = 5
+        #senders: threads sending bulks concurrently, 0 sends on the writer's
+        #thread. At most "max_outstanding" bulks wait for a sender, then
+        #writers block
+        if "senders" not in self._configuration:
+            self._configuration["senders"] = 0
+        if "max_outstanding" not in self._configuration:
+            self._configuration["max_outstanding"] = 2 * max(1, self._configuration["senders"])
+        if self._configuration["maxsize"] < self._configuration["senders"]:
+            self._configuration["maxsize"] = self._configuration["senders"]
+        #adaptive: let a BulkController move the bulk size between
+        #"min_bulkactions" and "max_bulkactions" and the senders in use
+        #between 1 and "senders", aiming at "target_latency" seconds a bulk
+        if "adaptive" not in self._configuration:
+            self._configuration["adaptive"] = False
+        if "min_bulkactions" not in self._configuration:
+            self._configuration["min_bulkactions"] = 50
+        if "max_bulkactions" not in self._configuration:
+            self._configuration["max_bulkactions"] = 5000
+        if "target_latency" not in self._configuration:
+            self._configuration["target_latency"] = 1.0
+        if "increase" not in self._configuration:
+            self._configuration["increase"] = 50
+        if "decrease" not in self._configuration:
+            self._configuration["decrease"] = 0.5
 
-        self.es = Elasticsearch(self._configuration["hosts"], sniff_on_start=self._configuration["sniff_on_start"], sniff_on_connection_fail=self._configuration["sniff_on_connection_fail"], sniffer_timeout=self._configuration["sniffer_timeout"], use_ssl=self._configuration["use_ssl"], verify_certs=self._configuration["verify_certs"], ca_certs=self._configuration["ca_certs"])
+        self.es = Elasticsearch(self._configuration["hosts"], sniff_on_start=self._configuration["sniff_on_start"], sniff_on_connection_fail=self._configuration["sniff_on_connection_fail"], sniffer_timeout=self._configuration["sniffer_timeout"], use_ssl=self._configuration["use_ssl"], verify_certs=self._configuration["verify_certs"], ca_certs=self._configuration["ca_certs"], maxsize=self._configuration["maxsize"])
         self.es.cluster.health(wait_for_status='yellow', request_timeout=5)
 
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
         self._actions = []
+        self._checkpoints = []
+        self._size = 0
+        self._oldest = None
+        self._stopping = threading.Event()
+        self._sequence = 0
+        self._next_commit = 0
+        self._completed = {}
+        self._commit_lock = threading.Lock()
+        self._bulks = Queue.Queue(self._configuration["max_outstanding"])
+        self._controller = None
+        if self._configuration["adaptive"]:
+            self._controller = BulkController(self._configuration["bulkactions"], self._configuration["min_bulkactions"], self._configuration["max_bulkactions"], max(1, self._configuration["senders"]), max(1, self._configuration["senders"]), self._configuration["target_latency"], self._configuration["increase"], self._configuration["decrease"], metrics=self._metrics)
+        self._slots = threading.Condition()
+        self._active = 0
+        self._dead_letter_lock = threading.Lock()
+        self._spool = None
+        self._replayer = None
+        if self._configuration["spool"]:
+            spool = self._configuration["spool"]
+            self._spool = Spool(spool["directory"], max_bytes=spool.get("max_bytes", 1073741824), segment_bytes=spool.get("segment_bytes", 67108864), fsync=spool.get("fsync", False), metrics=self._metrics, logger=self.logger)
+            self._replayer = threading.Thread(target=self._replay_spool, name="es-spool")
+            self._replayer.daemon = True
+            self._replayer.start()
+        self._senders = []
+        for i in range(0, self._configuration["senders"]):
+            sender = threading.Thread(target=self._send_bulks, name="es-sender-%d" % i)
+            sender.daemon = True
+            sender.start()
+            self._senders.append(sender)
+        self._metrics.gauge("output.bulk_queue", self._bulks.qsize)
+        self._flusher = None
+        if self._configuration["flush_interval"] > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name="es-flusher")
+            self._flusher.daemon = True
+            self._flusher.start()
+        if self._configuration["replay_on_start"]:
+            self.replay()
         #elasticsearch.helpers.streaming_bulk(client, actions, chunk_size=500, max_chunk_bytes=103833600, raise_on_error=True, expand_action_callback=<function expand_action>, raise_on_exception=True, **kwargs)
 
-    def index(self):
-        response = helpers.streaming_bulk(self.es, self._actions, chunk_size=self._configuration["chunk_size"], raise_on_error=self._configuration["raise_on_error"], raise_on_exception=self._configuration["raise_on_exception"])
-        for ok, result in response:
-            action, result = result.popitem()
-            doc_id = '/commits/%s' % (result['_id'])
-            if not ok:
-                self.logger.error("Failed to insert %s %s %s", action, doc_id, result)
+    def _estimate(self, document):
+        """Rough size of the document in a bulk body, strings count their
+        length and anything else a few bytes"""
+        if isinstance(document, basestring):
+            return len(document) + len(self._raw_action)
+        size = 16
+        for key in document:
+            value = document[key]
+            if isinstance(value, basestring):
+                size += len(key) + len(value) + 6
             else:
-                self.logger.warning("Success %d", ok)
+                size += len(key) + 16
+        return size
+
+    def _buffer(self, documents):
+        """Adds documents to the buffer and sends it once it holds
+        "bulkactions" actions or about "bulksize" bytes"""
+        size = 0
+        for document in documents:
+            size += self._estimate(document)
+        with self._lock:
+            if not self._actions:
+                self._oldest = time.time()
+            self._actions.extend(documents)
+            self._size += size
+            full = len(self._actions) >= self._bulkactions() or self._size >= self._configuration["bulksize"]
+        if full:
+            self.index()
+
+    def _bulkactions(self):
+        if self._controller is not None:
+            return self._controller.size
+        return self._configuration["bulkactions"]
+
+    def _flush_periodically(self):
+        interval = self._configuration["flush_interval"]
+        while not self._stopping.wait(min(interval / 2.0, 1.0)):
+            oldest = self._oldest
+            if oldest is not None and time.time() - oldest >= interval:
+                try:
+                    self.index()
+                except Exception:
+                    self.logger.exception("Failed flushing bulk buffer")
+
+    def index(self):
+        """Swaps the buffer out and sends it or, with "senders", queues it
+        for the sender threads. Either way checkpoints commit in order"""
+        with self._index_lock:
+            with self._lock:
+                actions = self._actions
+                checkpoints = self._checkpoints
+                self._actions = []
+                self._checkpoints = []
+                self._size = 0
+                self._oldest = None
+            if self._senders:
+                if actions or checkpoints:
+                    self._bulks.put((self._sequence, actions, checkpoints))
+                    self._sequence += 1
+                return
+            if actions:
+                try:
+                    self._send(actions)
+                except Exception:
+                    for checkpoint in checkpoints:
+                        checkpoint.fail()
+                    raise
+            for checkpoint in checkpoints:
+                checkpoint.commit()
+
+    def _send_bulks(self):
+        while True:
+            bulk = self._bulks.get()
+            if bulk is None:
+                break
+            sequence, actions, checkpoints = bulk
+            if self._controller is not None:
+                with self._slots:
+                    while self._active >= self._controller.concurrency:
+                        self._slots.wait(1.0)
+                    self._active += 1
+            failed = False
+            try:
+                if actions:
+                    self._send(actions)
+            except Exception:
+                self.logger.exception("Failed sending bulk of %d actions", len(actions))
+                failed = True
+            finally:
+                if self._controller is not None:
+                    with self._slots:
+                        self._active -= 1
+                        self._slots.notify_all()
+            self._complete(sequence, checkpoints, failed)
+
+    def _complete(self, sequence, checkpoints, failed=False):
+        """Bulks finish in any order, checkpoints are committed in the order
+        their bulks were queued. A failed bulk's checkpoints fail, so the
+        input doesn't ack what was lost"""
+        with self._commit_lock:
+            self._completed[sequence] = (checkpoints, failed)
+            while self._next_commit in self._completed:
+                checkpoints, failed = self._completed.pop(self._next_commit)
+                for checkpoint in checkpoints:
+                    if failed:
+                        checkpoint.fail()
+                    else:
+                        checkpoint.commit()
+                self._next_commit += 1
+
+    def _send(self, actions):
+        """Sends actions, retrying just the items that failed with a status
+        in "retry_on". Whatever is left goes to the dead letter file"""
+        if self._spool is not None and not self._spool.empty():
+            #still catching up, keep the order
+            if self._spool.put([json.dumps(action) for action in actions]):
+                return
+        failed = []
+        attempt = 0
+        while actions:
+            retry, errors = self._bulk(actions)
+            failed.extend(errors)
+            if not retry:
+                break
+            if attempt >= self._configuration["retries"]:
+                if self._spool is not None and self._spool.put([json.dumps(action) for action, result in retry]):
+                    self._metrics.incr("output.spooled", len(retry))
+                    self.logger.warning("Spooled %d documents", len(retry))
+                else:
+                    failed.extend(retry)
+                break
+            attempt += 1
+            self._metrics.incr("output.retries", len(retry))
+            self.logger.warning("Retrying %d of %d documents (attempt %d)", len(retry), len(actions), attempt)
+            time.sleep(random.uniform(0, min(self._configuration["retry_max_backoff"], self._configuration["retry_backoff"] * 2 ** attempt)))
+            actions = [action for action, result in retry]
+        if failed:
+            self._dead_letter(failed)
+
+    def _bulk(self, actions):
+        """One bulk request, returns the (action, result) pairs worth a retry
+        and the ones that failed for good"""
+        start = time.time()
+        rejected = 0
+        retry = []
+        errors = []
+        chunk_size = self._configuration["chunk_size"]
+        if self._controller is not None:
+            chunk_size = max(chunk_size, self._controller.size)
+        try:
+            response = helpers.streaming_bulk(self.es, actions, chunk_size=chunk_size, max_chunk_bytes=self._configuration["max_chunk_bytes"], raise_on_error=False, raise_on_exception=False, expand_action_callback=self._expand_action)
+            i = 0
+            for ok, result in response:
+                action, result = result.popitem()
+                doc_id = '/commits/%s' % (result.get('_id'))
+                if not ok:
+                    if _rejected(result):
+                        rejected += 1
+                    self._metrics.incr("output.bulk_failures")
+                    if result.get("status") in self._configuration["retry_on"]:
+                        retry.append((actions[i], result))
+                    else:
+                        self.logger.error("Failed to insert %s %s %s", action, doc_id, result)
+                        errors.append((actions[i], result))
+                else:
+                    self._metrics.incr("output.indexed")
+                    self.logger.warning("Success %d", ok)
+                i += 1
+        except Exception, err:
+            if getattr(err, "status_code", None) == 429 or "es_rejected_execution" in str(err):
+                rejected += 1
+            self._metrics.incr("output.bulk_errors")
+            raise
+        finally:
+            latency = time.time() - start
+            self._metrics.observe("output.bulk_latency", latency)
+            if rejected:
+                self._metrics.incr("output.rejected", rejected)
+            if self._controller is not None:
+                self._controller.record(latency, rejected)
+        return retry, errors
+
+    def _replay_spool(self):
+        """Sends spooled documents in order, backing off while they keep
+        failing. Items failing for good go to the dead letter file, ones
+        worth a retry go back to the end of the spool"""
+        attempt = 0
+        while not self._stopping.is_set():
+            if self._spool.empty():
+                self._stopping.wait(1.0)
+                continue
+            records, positions = self._spool.read(self._bulkactions())
+            if not records:
+                self._stopping.wait(1.0)
+                continue
+            actions = [json.loads(record) for record in records]
+            try:
+                retry, errors = self._bulk(actions)
+            except Exception:
+                self.logger.exception("Failed replaying spool")
+                retry, errors = [(action, None) for action in actions], []
+            if len(retry) == len(actions):
+                attempt += 1
+                self._stopping.wait(random.uniform(0, min(self._configuration["retry_max_backoff"], self._configuration["retry_backoff"] * 2 ** attempt)))
+                continue
+            attempt = 0
+            self._spool.ack(positions[-1])
+            self._metrics.incr("output.unspooled", len(actions) - len(retry))
+            if retry:
+                self._spool.put([json.dumps(action) for action, result in retry])
+            if errors:
+                try:
+                    self._dead_letter(errors)
+                except Exception:
+                    self.logger.exception("Dropped %d documents failing for good", len(errors))
+
+    def _expand_action(self, data):
+        """Raw events go into the bulk body untouched, the client's
+        serializer passes strings through"""
+        if isinstance(data, basestring):
+            return self._raw_action, data
+        return helpers.expand_action(data)
+
+    def _dead_letter(self, failed):
+        """Appends failed documents, one JSON line each with the error, to
+        the "dead_letter" file. Without one they're lost and, with
+        "raise_on_error", the bulk fails like it used to"""
+        if not self._configuration["dead_letter"]:
+            if self._configuration["raise_on_error"]:
+                raise helpers.BulkIndexError("%i document(s) failed to index." % len(failed), [result for action, result in failed])
+            return
+        with self._dead_letter_lock:
+            with open(self._configuration["dead_letter"], "a") as dead_letter:
+                for action, result in failed:
+                    error = dict(result)
+                    error.pop("data", None)
+                    error.pop("exception", None)
+                    dead_letter.write(json.dumps({"time": time.time(), "action": action, "error": error}, default=str) + "\n")
+        self._metrics.incr("output.dead_lettered", len(failed))
+        self.logger.error("Wrote %d failed documents to %s", len(failed), self._configuration["dead_letter"])
+
+    def replay(self, path=None):
+        """Indexes the documents of a dead letter file (by default
+        "dead_letter") again, on the caller's thread. The file is moved aside
+        while replaying, documents failing again land in a new dead letter
+        file. Returns how many documents were replayed"""
+        path = path or self._configuration["dead_letter"]
+        if not path or not os.path.exists(path):
+            return 0
+        replaying = path + ".replay"
+        with self._dead_letter_lock:
+            os.rename(path, replaying)
+        self.logger.info("Replaying dead letters from %s", path)
+        count = 0
+        actions = []
+        with open(replaying) as dead_letter:
+            for line in dead_letter:
+                if not line.strip():
+                    continue
+                actions.append(json.loads(line)["action"])
+                if len(actions) >= self._configuration["bulkactions"]:
+                    self._send(actions)
+                    count += len(actions)
+                    actions = []
+        if actions:
+            self._send(actions)
+            count += len(actions)
+        os.remove(replaying)
+        self._metrics.incr("output.replayed", count)
+        return count
 
     def write(self, data):
         self.logger.warning("Got some data to write: %s", data)
@@ -106,18 +519,58 @@ class StreamMinion(es):
                 data[key] = self._configuration["add_field"][key]
             if "_index" not in data:
                 data["_index"] = "dataminion"
-            self._actions.append(data)
-            if (len(self._actions) > self._configuration["bulkactions"]):
-                self.logger.warning("Sending: %s", data)
-                self.index()
+            self._buffer([data])
+        elif isinstance(data, codec.RawEvent):
+            data = codec.splice(data, self._raw_fields)
+            self._buffer([data])
         else:
             self.logger.warning("Can't index non dict data..")
             return None
         if self._on_write and hasattr(self._on_write, '__call__'):
             self._on_write(data)
 
+    def write_batch(self, data):
+        documents = []
+        for event in data:
+            if isinstance(event, dict):
+                for key in self._configuration["add_field"]:
+                    event[key] = self._configuration["add_field"][key]
+                if "_index" not in event:
+                    event["_index"] = "dataminion"
+                documents.append(event)
+            elif isinstance(event, codec.RawEvent):
+                documents.append(codec.splice(event, self._raw_fields))
+        if len(documents) < len(data):
+            self.logger.warning("Can't index %d non dict events", len(data) - len(documents))
+        self._buffer(documents)
+        if self._on_write and hasattr(self._on_write, '__call__'):
+            for event in documents:
+                self._on_write(event)
+
+    def commit(self, checkpoint):
+        """Ties the checkpoint to the buffered actions, it's committed once
+        their bulk request succeeded (a failed bulk leaves it uncommitted).
+        Without a "flush_interval" it forces a send, otherwise size and age
+        limits still apply"""
+        with self._lock:
+            if not self._actions and not self._checkpoints:
+                self._oldest = time.time()
+            self._checkpoints.append(checkpoint)
+        if self._flusher is None:
+            self.index()
+
     def stop(self):
         self.logger.debug("Stop called")
+        self._stopping.set()
+        if self._flusher is not None:
+            self._flusher.join()
         self.index()
+        for sender in self._senders:
+            self._bulks.put(None)
+        for sender in self._senders:
+            sender.join()
+        if self._replayer is not None:
+            self._replayer.join()
+            self._spool.close()
 
 #host=None, port=None, virtual_host=None, credentials=None, channel_max=None, frame_max=None, heartbeat_interval=None, ssl=None, ssl_options=None, connection_attempts=None, retry_delay=None, socket_timeout=None, locale=None, backpressure_detection=None
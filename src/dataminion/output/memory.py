@@ -0,0 +1,96 @@
+import time
+import json
+
+import logging
+import sys
+import threading
+from dataminion.metrics import NULL
+from dataminion import codec
+
+class memory(object):
+    """In-memory output wrapper class
+    """
+
+    def __init__(self, config={}, logger=None, on_write=None, metrics=None, **kwargs):
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self._configuration = config
+        self._on_write = on_write
+        self._metrics = metrics or NULL
+        if "add_field" not in self._configuration:
+            self._configuration["add_field"] = {}
+        self._initialize()
+
+    def process(self, data):
+        self.write(data)
+
+    def process_batch(self, data):
+        self.write_batch(data)
+
+    def write_batch(self, data):
+        for event in data:
+            self.write(event)
+
+class Memory(memory):
+    """Stands in for Elasticsearch or a downstream broker in benchmarks and
+    tests. Buffers "bulkactions" events and "flushes" them by sleeping
+    "bulk_latency" seconds, like a bulk request would take. With "encode"
+    it serializes the bulk body like Elasticsearch does, RawEvents as they
+    are. With "keep" the events are kept in "events"."""
+    def _initialize(self):
+        if "bulkactions" not in self._configuration:
+            self._configuration["bulkactions"] = 500
+        if "bulk_latency" not in self._configuration:
+            self._configuration["bulk_latency"] = 0.0
+        if "keep" not in self._configuration:
+            self._configuration["keep"] = False
+        if "encode" not in self._configuration:
+            self._configuration["encode"] = False
+        self._lock = threading.Lock()
+        self._actions = []
+        self.events = []
+        self.written = 0
+        self.bulks = 0
+
+    def write(self, data):
+        if isinstance(data, dict):
+            for key in self._configuration["add_field"]:
+                data[key] = self._configuration["add_field"][key]
+        self._actions.append(data)
+        if len(self._actions) >= self._configuration["bulkactions"]:
+            self.index()
+
+    def write_batch(self, data):
+        if self._configuration["add_field"]:
+            for event in data:
+                if isinstance(event, dict):
+                    for key in self._configuration["add_field"]:
+                        event[key] = self._configuration["add_field"][key]
+        self._actions.extend(data)
+        if len(self._actions) >= self._configuration["bulkactions"]:
+            self.index()
+
+    def index(self):
+        with self._lock:
+            actions = self._actions
+            self._actions = []
+        if not actions:
+            return
+        start = time.time()
+        if self._configuration["encode"]:
+            "\n".join([event if isinstance(event, codec.RawEvent) else codec.dumps(event) for event in actions])
+        if self._configuration["bulk_latency"] > 0:
+            time.sleep(self._configuration["bulk_latency"])
+        if self._configuration["keep"]:
+            self.events.extend(actions)
+        self.written += len(actions)
+        self.bulks += 1
+        self._metrics.incr("output.indexed", len(actions))
+        self._metrics.observe("output.bulk_latency", time.time() - start)
+
+    def commit(self, checkpoint):
+        self.index()
+        checkpoint.commit()
+
+    def stop(self):
+        self.index()
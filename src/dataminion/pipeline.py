@@ -0,0 +1,611 @@
+#
+import logging
+import threading
+import multiprocessing
+import Queue
+import time
+import zlib
+import collections
+from dataminion.metrics import Metrics, NULL
+from dataminion import codec
+
+_STOP = object()
+
+def partition(key, buckets):
+    """Stable bucket for a key, the same in every process"""
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return (zlib.crc32(key) & 0xffffffff) % buckets
+
+class Batch(list):
+    """A list of events travelling through the pipeline as one item"""
+
+class Checkpoint(object):
+    """Marks a position in the event stream, e.g. an AMQP delivery tag.
+
+    It travels the pipeline behind the events before it. Filters pass it on,
+    outputs commit it once everything before it is safely written (see
+    "commit" on outputs), and then "on_commit" is called. A pool handing it
+    to several workers forks it so that it commits after the last share.
+    Outputs that lost events before it call fail() instead, "on_fail" is
+    called once and the checkpoint never commits.
+    """
+    def __init__(self, on_commit=None, on_fail=None):
+        self._on_commit = on_commit
+        self._on_fail = on_fail
+        self._lock = threading.Lock()
+        self._pending = 1
+        self._failed = False
+
+    def fork(self, shares):
+        with self._lock:
+            self._pending += shares - 1
+
+    def commit(self):
+        with self._lock:
+            self._pending -= 1
+            done = self._pending == 0 and not self._failed
+        if done and self._on_commit and hasattr(self._on_commit, '__call__'):
+            self._on_commit()
+
+    def fail(self):
+        with self._lock:
+            self._pending -= 1
+            first = not self._failed
+            self._failed = True
+        if first and self._on_fail and hasattr(self._on_fail, '__call__'):
+            self._on_fail()
+
+def _count(item):
+    if isinstance(item, Batch):
+        return len(item)
+    if isinstance(item, Checkpoint):
+        return 0
+    return 1
+
+def _checkpoint(target, item, forward):
+    if forward is not None:
+        forward(item)
+    elif hasattr(target, "commit"):
+        target.commit(item)
+    else:
+        item.commit()
+
+def dispatch(target, item, forward=None):
+    """Hands a single event or a Batch to a filter or output. Batches go to
+    "process_batch" when the target has one and are otherwise split into
+    "process" calls. Checkpoints are passed to "forward" (filters) or
+    committed by the target (outputs)"""
+    if isinstance(item, Batch):
+        process_batch = getattr(target, "process_batch", None)
+        if process_batch is not None:
+            process_batch(item)
+        else:
+            for event in item:
+                target.process(event)
+    elif isinstance(item, Checkpoint):
+        _checkpoint(target, item, forward)
+    else:
+        target.process(item)
+
+def dispatcher(target, forward=None):
+    """Stage handler doing what dispatch does, with the target's methods
+    looked up only once"""
+    process = target.process
+    process_batch = getattr(target, "process_batch", None)
+    def dispatch_fn(item):
+        if isinstance(item, Batch):
+            if process_batch is not None:
+                process_batch(item)
+            else:
+                for event in item:
+                    process(event)
+        elif isinstance(item, Checkpoint):
+            _checkpoint(target, item, forward)
+        else:
+            process(item)
+    return dispatch_fn
+
+class Stage(threading.Thread):
+    """Pipeline stage, takes items from a bounded queue and hands them to
+    "handler" on it's own thread.
+
+    Producers are never expected to block: when the queue depth reaches the
+    high watermark "on_full" is called so whoever feeds the stage can stop
+    feeding it (e.g. pause an AMQP consumer), once it drains below the low
+    watermark "on_drain" is called so it can resume. Only when the queue is
+    completely full does "put" block, unless called with block=False (IO
+    loops feeding the first stage) which parks the item in an overflow list
+    the stage takes from before the queue.
+    """
+    def __init__(self, name=None, handler=None, depth=1000, high_watermark=None, low_watermark=None, on_full=None, on_drain=None, on_idle=None, idle_timeout=0.5, metrics=NULL, label="stage", logger=None):
+        threading.Thread.__init__(self, name=name)
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self.daemon = True
+        self._handler = handler
+        self._depth = max(1, int(depth))
+        if high_watermark is None:
+            high_watermark = max(1, self._depth * 3 / 4)
+        if low_watermark is None:
+            low_watermark = self._depth / 4
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._on_full = on_full
+        self._on_drain = on_drain
+        self._on_idle = on_idle
+        self._idle_timeout = idle_timeout
+        self._queue = Queue.Queue(maxsize=self._depth)
+        self._metrics = metrics
+        self._label = label
+        self._metrics.gauge(label + ".queue", self.qsize)
+        self._throttled = False
+        self._lock = threading.Lock()
+        #items put with block=False while the queue was full, in order
+        self._overflow = collections.deque()
+        self._overflow_lock = threading.Lock()
+        self.stopped = False
+
+    def qsize(self):
+        return self._queue.qsize() + len(self._overflow)
+
+    def put(self, item, block=True):
+        if block:
+            if self._queue.full():
+                self.logger.warning("Stage %s is full (%d), blocking producer", self.name, self._depth)
+            self._queue.put(item)
+        else:
+            with self._overflow_lock:
+                held = True
+                if not self._overflow:
+                    try:
+                        self._queue.put_nowait(item)
+                        held = False
+                    except Queue.Full:
+                        self.logger.warning("Stage %s is full (%d), holding items back", self.name, self._depth)
+                if held:
+                    self._overflow.append(item)
+        self._metrics.incr(self._label + ".in", _count(item))
+        if not self._throttled and self._queue.qsize() >= self._high_watermark:
+            with self._lock:
+                if self._throttled:
+                    return
+                self._throttled = True
+            self.logger.info("Stage %s reached high watermark (%d), throttling", self.name, self._high_watermark)
+            if self._on_full and hasattr(self._on_full, '__call__'):
+                self._on_full()
+
+    def _refill(self):
+        """Moves held back items to the queue as far as there's room"""
+        if not self._overflow:
+            return
+        with self._overflow_lock:
+            while self._overflow:
+                try:
+                    self._queue.put_nowait(self._overflow[0])
+                except Queue.Full:
+                    break
+                self._overflow.popleft()
+
+    def _check_drain(self):
+        if self._throttled and self._queue.qsize() <= self._low_watermark:
+            with self._lock:
+                if not self._throttled:
+                    return
+                self._throttled = False
+            self.logger.info("Stage %s drained to low watermark (%d), resuming", self.name, self._low_watermark)
+            if self._on_drain and hasattr(self._on_drain, '__call__'):
+                self._on_drain()
+
+    def run(self):
+        self.logger.info("Starting stage %s", self.name)
+        while True:
+            try:
+                item = self._queue.get(True, self._idle_timeout)
+            except Queue.Empty:
+                self._refill()
+                self._check_drain()
+                if self._on_idle and hasattr(self._on_idle, '__call__'):
+                    self._on_idle()
+                continue
+            self._refill()
+            if item is _STOP:
+                with self._overflow_lock:
+                    if self._overflow or not self._queue.empty():
+                        #held back items came in before stop, some may have
+                        #been moved to the queue behind it, keep them ahead
+                        self._overflow.append(_STOP)
+                        continue
+                break
+            start = time.time()
+            try:
+                self._handler(item)
+            except Exception:
+                self._metrics.incr(self._label + ".errors")
+                self.logger.exception("Stage %s failed processing item", self.name)
+            self._metrics.observe(self._label + ".latency", time.time() - start)
+            self._metrics.incr(self._label + ".done", _count(item))
+            self._check_drain()
+        self.logger.info("Stage %s stopped", self.name)
+
+    def stop(self, timeout=None):
+        """Stops the stage after everything already queued is handled"""
+        if self.stopped:
+            return
+        self.stopped = True
+        self._queue.put(_STOP)
+        if self.is_alive():
+            self.join(timeout)
+
+class KeyedPool(object):
+    """Runs "workers" copies of a filter, each on it's own Stage.
+
+    Events are routed by hashing the filter's partition key (see
+    "partition_key" on filters) so everything sharing a key, e.g. header and
+    data lines of one file, is handled in order by the same worker. Events
+    without a key are spread round robin. To the rest of the directive the
+    pool looks like a filter (process, set_memory, unset_memory, stop) and
+    like a stage (put).
+    """
+    def __init__(self, name=None, factory=None, workers=2, depth=1000, on_full=None, on_drain=None, on_checkpoint=None, metrics=NULL, logger=None):
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self.name = name
+        self._on_full = on_full
+        self._on_drain = on_drain
+        self._throttled = 0
+        self._lock = threading.Lock()
+        self._next = 0
+        self._filters = []
+        self._stages = []
+        for i in range(0, workers):
+            _filter = factory()
+            self._filters.append(_filter)
+            self._stages.append(Stage(name="%s:%d" % (name, i), handler=dispatcher(_filter, forward=on_checkpoint), depth=depth, on_full=self._stage_full, on_drain=self._stage_drained, metrics=metrics, label="filter", logger=self.logger))
+        metrics.gauge("filter.queue", self.qsize)
+        for stage in self._stages:
+            stage.start()
+
+    def qsize(self):
+        return sum([stage.qsize() for stage in self._stages])
+
+    def _stage_full(self):
+        with self._lock:
+            self._throttled += 1
+            first = self._throttled == 1
+        if first and self._on_full and hasattr(self._on_full, '__call__'):
+            self._on_full()
+
+    def _stage_drained(self):
+        with self._lock:
+            self._throttled -= 1
+            last = self._throttled == 0
+        if last and self._on_drain and hasattr(self._on_drain, '__call__'):
+            self._on_drain()
+
+    def route(self, data):
+        """Index of the worker that handles the event"""
+        key = self._filters[0].partition_key(data)
+        if key is None:
+            self._next = (self._next + 1) % len(self._stages)
+            return self._next
+        return partition(key, len(self._stages))
+
+    def put(self, data, block=True):
+        if isinstance(data, Checkpoint):
+            data.fork(len(self._stages))
+            for stage in self._stages:
+                stage.put(data, block)
+        elif isinstance(data, Batch):
+            batches = {}
+            for event in data:
+                batches.setdefault(self.route(event), Batch()).append(event)
+            for index in batches:
+                self._stages[index].put(batches[index], block)
+        else:
+            self._stages[self.route(data)].put(data, block)
+
+    def process(self, data):
+        self.put(data)
+
+    def process_batch(self, data):
+        self.put(Batch(data))
+
+    def set_memory(self, key, data):
+        for _filter in self._filters:
+            _filter.set_memory(key, data)
+
+    def unset_memory(self, key):
+        for _filter in self._filters:
+            if hasattr(_filter, "unset_memory"):
+                _filter.unset_memory(key)
+
+    def stop(self, timeout=None):
+        for stage in self._stages:
+            stage.stop(timeout)
+        for _filter in self._filters:
+            if hasattr(_filter, "stop"):
+                _filter.stop()
+
+class _CoordinatorProxy(object):
+    """Coordinator as seen from a worker process, writes and watches are
+    forwarded to the parent which owns the real coordinator. Reads return
+    nothing right away, the parent looks the node up and the value reaches
+    the worker through set_memory (as it does when the parent's watch
+    fires)."""
+    def __init__(self, outbox, index):
+        self._outbox = outbox
+        self._index = index
+        self._watched = set()
+
+    def set(self, node, data):
+        self._outbox.put(("coordinator", "set", (node, data)))
+
+    def update(self, node, data):
+        self._outbox.put(("coordinator", "update", (node, data)))
+
+    def update_many(self, updates):
+        self._outbox.put(("coordinator", "update_many", (updates,)))
+
+    def watch_node(self, node):
+        if node not in self._watched:
+            self._watched.add(node)
+            self._outbox.put(("coordinator", "watch_node", (node,)))
+
+    def get(self, node):
+        self._outbox.put(("get", self._index, node))
+        return None
+
+def _process_worker(_filter, config, index, inbox, outbox, encode=False):
+    """Worker process loop, keeps it's own filter and header memory"""
+    results = []
+    metrics = Metrics()
+    instance = _filter(config=config, on_filter=results.append, on_filter_batch=results.extend, coordinator=_CoordinatorProxy(outbox, index), metrics=metrics)
+    logger = logging.getLogger(__name__)
+    while True:
+        message = inbox.get()
+        if message[0] == "events":
+            if hasattr(instance, "process_batch"):
+                try:
+                    instance.process_batch(message[1])
+                except Exception:
+                    logger.exception("Filter worker failed processing batch")
+            else:
+                for data in message[1]:
+                    try:
+                        instance.process(data)
+                    except Exception:
+                        logger.exception("Filter worker failed processing event")
+            if results and encode:
+                outbox.put(("lines", codec.get("json_lines").encode(results)))
+                del results[:]
+            elif results:
+                outbox.put(("events", results[:]))
+                del results[:]
+            counters = metrics.drain()
+            if counters:
+                outbox.put(("metrics", counters))
+        elif message[0] == "checkpoint":
+            outbox.put(message)
+        elif message[0] == "set":
+            instance.set_memory(message[1], message[2])
+        elif message[0] == "unset":
+            if hasattr(instance, "unset_memory"):
+                instance.unset_memory(message[1])
+        elif message[0] == "stop":
+            if hasattr(instance, "stop"):
+                instance.stop()
+            break
+
+class ProcessPool(object):
+    """Runs "workers" copies of a filter in separate processes to get past
+    the GIL.
+
+    Events are routed like in KeyedPool and shipped to the workers in batches
+    of "batch_size" (or whatever accumulated in "batch_timeout" seconds).
+    Every worker keeps it's own header memory, coordination updates are
+    broadcast to all of them and their coordinator writes and lookups go
+    through the parent. Filtered events are handed to "on_filter" from a
+    collector thread.
+
+    With "encode" workers send their events as one JSON lines body and the
+    parent hands them on as RawEvents, for outputs that write JSON anyway
+    (es, ampq) this takes unpickling and encoding off the parent.
+
+    A worker that dies is started again on the same inbox, checkpoints in
+    flight at the time fail since the events it was holding are gone.
+    """
+    def __init__(self, name=None, _filter=None, config={}, workers=2, depth=1000, batch_size=100, batch_timeout=0.05, on_filter=None, on_filter_batch=None, on_checkpoint=None, coordinator=None, on_full=None, on_drain=None, encode=False, metrics=NULL, logger=None):
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self.name = name
+        self._metrics = metrics
+        self._encode = encode
+        self._on_filter = on_filter
+        self._on_filter_batch = on_filter_batch
+        self._on_checkpoint = on_checkpoint
+        self._checkpoints = {}
+        self._shares = {}
+        self._checkpoint_id = 0
+        self._coordinator = coordinator
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._stopping = False
+        self._lost = False
+        #routing only, no coordinator and no header memory to speak of
+        self._router = _filter(config=dict(config, memory_size=0, memory_prefetch=False, memory_write_window=0))
+        self._next = 0
+        self._pending = [[] for i in range(0, workers)]
+        self._pending_since = None
+        self._filter = _filter
+        self._config = config
+        self._inboxes = []
+        self._workers = []
+        self._outbox = multiprocessing.Queue()
+        for i in range(0, workers):
+            self._inboxes.append(multiprocessing.Queue(max(2, depth / batch_size)))
+            self._workers.append(self._worker(i))
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, name=name + ":collector")
+        self._collector.daemon = True
+        self._collector.start()
+        self._stage = Stage(name=name, handler=self._dispatch, depth=depth, on_full=on_full, on_drain=on_drain, on_idle=self.flush, idle_timeout=batch_timeout, metrics=metrics, label="dispatch", logger=self.logger)
+        self._stage.start()
+
+    def _worker(self, index):
+        worker = multiprocessing.Process(target=_process_worker, name="%s:%d" % (self.name, index), args=(self._filter, self._config, index, self._inboxes[index], self._outbox, self._encode))
+        worker.daemon = True
+        return worker
+
+    def _check_workers(self):
+        """Starts workers that died again, runs on the dispatching stage"""
+        if self._stopping:
+            return
+        for index in range(0, len(self._workers)):
+            worker = self._workers[index]
+            if worker.is_alive():
+                continue
+            self._metrics.incr("filter.worker_restarts")
+            self.logger.error("Filter worker %s died (exit code %s), starting it again", worker.name, worker.exitcode)
+            for checkpoint in self._checkpoints.values():
+                checkpoint.fail()
+            #and so does the next one, it's behind the lost events too
+            self._lost = True
+            self._workers[index] = self._worker(index)
+            self._workers[index].start()
+
+    def _put(self, index, message):
+        """Puts message in a worker's inbox, waiting for room as long as the
+        worker is alive"""
+        while True:
+            try:
+                self._inboxes[index].put(message, True, 1)
+                return
+            except Queue.Full:
+                self._check_workers()
+
+    def _route(self, data):
+        key = self._router.partition_key(data)
+        if key is None:
+            self._next = (self._next + 1) % len(self._workers)
+            return self._next
+        return partition(key, len(self._workers))
+
+    def _dispatch(self, data):
+        if isinstance(data, Checkpoint):
+            self.flush()
+            if self._lost:
+                self._lost = False
+                data.fail()
+                return
+            self._checkpoint_id += 1
+            self._checkpoints[self._checkpoint_id] = data
+            data.fork(len(self._inboxes))
+            for index in range(0, len(self._inboxes)):
+                self._put(index, ("checkpoint", self._checkpoint_id))
+            return
+        if isinstance(data, Batch):
+            for event in data:
+                index = self._route(event)
+                self._pending[index].append(event)
+                if len(self._pending[index]) >= self._batch_size:
+                    self._send(index)
+        else:
+            index = self._route(data)
+            self._pending[index].append(data)
+            if len(self._pending[index]) >= self._batch_size:
+                self._send(index)
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if time.time() - self._pending_since >= self._batch_timeout:
+            self.flush()
+
+    def _send(self, index):
+        batch = self._pending[index]
+        self._pending[index] = []
+        self._put(index, ("events", batch))
+
+    def flush(self):
+        """Ships every pending batch, runs on the dispatching stage"""
+        self._check_workers()
+        for index in range(0, len(self._pending)):
+            if self._pending[index]:
+                self._send(index)
+        self._pending_since = None
+
+    def _collect(self):
+        lines = codec.get("raw_lines")
+        while True:
+            message = self._outbox.get()
+            if message[0] == "lines":
+                message = ("events", lines.decode(message[1]))
+            if message[0] == "events":
+                if self._on_filter_batch and hasattr(self._on_filter_batch, '__call__'):
+                    self._on_filter_batch(message[1])
+                elif self._on_filter and hasattr(self._on_filter, '__call__'):
+                    for data in message[1]:
+                        self._on_filter(data)
+            elif message[0] == "checkpoint":
+                checkpoint = self._checkpoints[message[1]]
+                if self._on_checkpoint and hasattr(self._on_checkpoint, '__call__'):
+                    self._on_checkpoint(checkpoint)
+                else:
+                    checkpoint.commit()
+                self._shares[message[1]] = self._shares.get(message[1], 0) + 1
+                if self._shares[message[1]] == len(self._inboxes):
+                    del self._checkpoints[message[1]]
+                    del self._shares[message[1]]
+            elif message[0] == "metrics":
+                self._metrics.merge(message[1])
+            elif message[0] == "coordinator":
+                if self._coordinator != None:
+                    try:
+                        getattr(self._coordinator, message[1])(*message[2])
+                    except Exception:
+                        self.logger.exception("Failed forwarding %s from filter worker", message[1])
+            elif message[0] == "get":
+                if self._coordinator != None and not self._stopping:
+                    try:
+                        value = self._coordinator.get(message[2])
+                    except Exception:
+                        self.logger.exception("Failed looking up %s for filter worker", message[2])
+                        value = None
+                    if value:
+                        self._inboxes[message[1]].put(("set", message[2], value))
+            elif message[0] == "stop":
+                break
+
+    def put(self, data, block=True):
+        self._stage.put(data, block)
+
+    def process(self, data):
+        self.put(data)
+
+    def process_batch(self, data):
+        self.put(Batch(data))
+
+    def set_memory(self, key, data):
+        for inbox in self._inboxes:
+            inbox.put(("set", key, data))
+
+    def unset_memory(self, key):
+        for inbox in self._inboxes:
+            inbox.put(("unset", key))
+
+    def stop(self, timeout=None):
+        self._stage.stop(timeout)
+        self.flush()
+        #workers don't read lookups answered after this, nor get restarted
+        self._stopping = True
+        for index in range(0, len(self._inboxes)):
+            while self._workers[index].is_alive():
+                try:
+                    self._inboxes[index].put(("stop",), True, 1)
+                    break
+                except Queue.Full:
+                    pass
+        for worker in self._workers:
+            worker.join(timeout)
+        self._outbox.put(("stop",))
+        self._collector.join(timeout)
@@ -0,0 +1,136 @@
+"""Disk backed queue outputs fall back to while their sink is down, kept
+in "directory" as segment files of "<length>\\n<bytes>\\n" records"""
+import os
+import logging
+import threading
+
+class Spool(object):
+    """Thread safe, one reader and any number of writers"""
+    def __init__(self, directory, max_bytes=1073741824, segment_bytes=67108864, fsync=False, metrics=None, label="output.spool", logger=None):
+        log = logging.getLogger(__name__)
+        self.logger = logger or log
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = self._segments()
+        self._head = (segments[0] if segments else 0, 0)
+        self._load_head()
+        self._tail = segments[-1] if segments else self._head[0]
+        self._writer = None
+        self._reader = None
+        self._bytes = 0
+        for segment in segments:
+            if segment >= self._head[0]:
+                self._bytes += os.path.getsize(self._path(segment))
+        self._bytes -= self._head[1]
+        if metrics is not None:
+            metrics.gauge(label + ".bytes", lambda: self._bytes)
+            metrics.gauge(label + ".fill", lambda: float(self._bytes) / self._max_bytes)
+        if self._bytes > 0:
+            self.logger.info("Spool %s holds %d bytes to replay", directory, self._bytes)
+
+    def _path(self, segment):
+        return os.path.join(self._directory, "%012d.seg" % segment)
+
+    def _segments(self):
+        return sorted([int(name[:-4]) for name in os.listdir(self._directory) if name.endswith(".seg")])
+
+    def _load_head(self):
+        path = os.path.join(self._directory, "head")
+        if os.path.exists(path):
+            with open(path) as head_file:
+                segment, offset = head_file.read().split()
+            self._head = (int(segment), int(offset))
+
+    def _save_head(self):
+        path = os.path.join(self._directory, "head")
+        with open(path + ".tmp", "w") as head_file:
+            head_file.write("%d %d" % self._head)
+        os.rename(path + ".tmp", path)
+
+    def empty(self):
+        return self._bytes <= 0
+
+    def size(self):
+        return self._bytes
+
+    def put(self, records):
+        """Appends records, returns False (writing nothing) when they would
+        take the spool over "max_bytes\""""
+        chunks = ["%d\n%s\n" % (len(record), record) for record in records]
+        size = sum([len(chunk) for chunk in chunks])
+        with self._lock:
+            if self._bytes + size > self._max_bytes:
+                return False
+            if self._writer is None:
+                self._writer = open(self._path(self._tail), "ab")
+            elif self._writer.tell() >= self._segment_bytes:
+                self._writer.close()
+                self._tail += 1
+                self._writer = open(self._path(self._tail), "ab")
+            self._writer.write("".join(chunks))
+            self._writer.flush()
+            if self._fsync:
+                os.fsync(self._writer.fileno())
+            self._bytes += size
+        return True
+
+    def read(self, count):
+        """Returns up to count records from the head and the position after
+        each of them, they stay in the spool until ack(position)"""
+        records = []
+        positions = []
+        with self._lock:
+            segment, offset = self._head
+            while len(records) < count and self._bytes > 0:
+                if self._reader is None or self._reader[0] != segment:
+                    if self._reader is not None:
+                        self._reader[1].close()
+                    if not os.path.exists(self._path(segment)):
+                        break
+                    self._reader = (segment, open(self._path(segment), "rb"))
+                reader = self._reader[1]
+                reader.seek(offset)
+                header = reader.readline()
+                if not header:
+                    if segment >= self._tail:
+                        break
+                    segment, offset = segment + 1, 0
+                    continue
+                length = int(header)
+                records.append(reader.read(length))
+                reader.read(1)
+                offset = reader.tell()
+                positions.append((segment, offset))
+        return records, positions
+
+    def ack(self, position):
+        """Drops everything before position, deleting segments read through"""
+        with self._lock:
+            segment, offset = position
+            consumed = 0
+            for done in range(self._head[0], segment):
+                path = self._path(done)
+                if os.path.exists(path):
+                    consumed += os.path.getsize(path)
+                    if self._reader is not None and self._reader[0] == done:
+                        self._reader[1].close()
+                        self._reader = None
+                    os.remove(path)
+            consumed += offset - self._head[1]
+            self._bytes -= consumed
+            self._head = position
+            self._save_head()
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._reader is not None:
+                self._reader[1].close()
+                self._reader = None
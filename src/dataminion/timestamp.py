@@ -0,0 +1,125 @@
+"""Timestamp conversions shared by the filters, the same strings datetime
+gives with the date, hour and minute part cached"""
+import re
+import calendar
+import math
+from datetime import datetime
+
+#caches are dropped as a whole when they grow past this
+CACHE_SIZE = 4096
+
+ISO = "iso"
+EPOCH_MILLIS = "epoch_millis"
+FORMATS = (ISO, EPOCH_MILLIS)
+
+_PERFMON_FORMAT = '%m/%d/%Y %H:%M:%S.%f'
+_PERFMON_TAIL = re.compile(r"[0-5][0-9]\.[0-9]{1,6}\Z")
+_W3C = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?Z\Z")
+_SECONDS = ["%02d" % second for second in range(0, 60)]
+#graphite timestamps the cache takes, years 1900 to 9999 like strftime
+_EPOCH_MIN = -2208988800.0
+_EPOCH_MAX = 253402300800.0
+
+#"MM/DD/YYYY HH:MM:": ("YYYY-MM-DDTHH:MM:", epoch seconds of the minute)
+_perfmon = {}
+#epoch minute: "YYYY-MM-DDTHH:MM:"
+_graphite = {}
+#"+HHMM": seconds
+_offsets = {}
+
+def _perfmon_minute(prefix):
+    if len(_perfmon) >= CACHE_SIZE:
+        _perfmon.clear()
+    parsed = datetime.strptime(prefix + "00.0", _PERFMON_FORMAT)
+    _perfmon[prefix] = (parsed.strftime('%Y-%m-%dT%H:%M:'), calendar.timegm(parsed.timetuple()))
+    return _perfmon[prefix]
+
+def _perfmon_split(value):
+    """Returns the cached minute of a perfmon timestamp and the rest of it
+    ("SS.ffffff"), None when it's not in the usual layout"""
+    if len(value) < 21 or value[19] != "." or value[16] != ":" or value[13] != ":" or value[10] != " " or not _PERFMON_TAIL.match(value, 17):
+        return None
+    prefix = value[:17]
+    minute = _perfmon.get(prefix)
+    if minute is None:
+        try:
+            minute = _perfmon_minute(prefix)
+        except ValueError:
+            return None
+    return minute, value[17:]
+
+def perfmon(value, offset):
+    """Same as datetime.strptime(value, '%m/%d/%Y %H:%M:%S.%f').strftime(
+    '%Y-%m-%dT%H:%M:%S.%f') + offset"""
+    split = _perfmon_split(value)
+    if split is None:
+        return datetime.strptime(value, _PERFMON_FORMAT).strftime('%Y-%m-%dT%H:%M:%S.%f') + offset
+    (iso, epoch), tail = split
+    return iso + tail[:3] + tail[3:].ljust(6, "0") + offset
+
+def _offset(offset):
+    seconds = _offsets.get(offset)
+    if seconds is None:
+        seconds = (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60) * (-1 if offset[0] == "-" else 1)
+        _offsets[offset] = seconds
+    return seconds
+
+def perfmon_millis(value, offset):
+    """Epoch milliseconds of a perfmon timestamp taken in the "+HHMM" offset"""
+    split = _perfmon_split(value)
+    if split is None:
+        parsed = datetime.strptime(value, _PERFMON_FORMAT)
+        return (calendar.timegm(parsed.timetuple()) - _offset(offset)) * 1000 + parsed.microsecond // 1000
+    (iso, epoch), tail = split
+    return (epoch + int(tail[:2]) - _offset(offset)) * 1000 + int(tail[3:6].ljust(3, "0"))
+
+def _epoch_split(timestamp):
+    """Whole seconds and microseconds of an epoch float, rounded the way
+    datetime.utcfromtimestamp does"""
+    seconds = int(timestamp)
+    microseconds = timestamp - seconds
+    microseconds *= 1e6
+    if microseconds >= 0.0:
+        microseconds = int(math.floor(microseconds + 0.5))
+    else:
+        microseconds = int(math.ceil(microseconds - 0.5))
+    if microseconds < 0:
+        seconds -= 1
+        microseconds += 1000000
+    if microseconds == 1000000:
+        seconds += 1
+        microseconds = 0
+    return seconds, microseconds
+
+def graphite(timestamp):
+    """Same as datetime.utcfromtimestamp(timestamp).strftime(
+    '%Y-%m-%dT%H:%M:%S.%f+0000') for an epoch float"""
+    if not (_EPOCH_MIN <= timestamp < _EPOCH_MAX):
+        return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%f+0000')
+    seconds, microseconds = _epoch_split(timestamp)
+    minute = seconds // 60
+    prefix = _graphite.get(minute)
+    if prefix is None:
+        if len(_graphite) >= CACHE_SIZE:
+            _graphite.clear()
+        prefix = datetime.utcfromtimestamp(minute * 60).strftime('%Y-%m-%dT%H:%M:')
+        _graphite[minute] = prefix
+    return "%s%s.%06d+0000" % (prefix, _SECONDS[seconds - minute * 60], microseconds)
+
+def epoch_millis(timestamp):
+    """Epoch milliseconds of an epoch float"""
+    seconds, microseconds = _epoch_split(timestamp)
+    return seconds * 1000 + microseconds // 1000
+
+def w3c_millis(stamp):
+    """Epoch milliseconds of the "YYYY-MM-DDTHH:MM:SS[.f]Z" timestamps iis and
+    tmg rows make, raises ValueError for anything else"""
+    match = _W3C.match(stamp)
+    if match is None:
+        raise ValueError("Unknown timestamp %s" % stamp)
+    year, month, day, hour, minute, second, fraction = match.groups()
+    parsed = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    millis = calendar.timegm(parsed.timetuple()) * 1000
+    if fraction:
+        millis += int(fraction[:3].ljust(3, "0"))
+    return millis
@@ -0,0 +1,134 @@
+"""Synthetic event streams shaped like what the windows and graphite
+shippers put on the brokers, one generator per sourcetype handled by
+MouraoMagic and Harbour. Every file starts with it's header lines."""
+import random
+
+PERFMON_OBJECTS = (
+    ("Processor", ("_Total", "0", "1", "2", "3"), ("% Processor Time", "% User Time", "% Privileged Time", "Interrupts/sec")),
+    ("Memory", ("",), ("Available MBytes", "Pages/sec", "Committed Bytes", "Cache Faults/sec")),
+    ("PhysicalDisk", ("_Total", "0 C:", "1 D:"), ("% Disk Time", "Avg. Disk Queue Length", "Disk Reads/sec", "Disk Writes/sec")),
+    ("Network Interface", ("Intel[R] 82574L", "isatap.lan"), ("Bytes Received/sec", "Bytes Sent/sec", "Packets/sec")),
+    ("Process", ("w3wp", "sqlservr", "svchost", "lsass"), ("% Processor Time", "Working Set", "Handle Count", "Thread Count", "IO Data Bytes/sec")),
+)
+
+IIS_FIELDS = "date time s-sitename s-computername s-ip cs-method cs-uri-stem cs-uri-query s-port cs-username c-ip cs-version cs(User-Agent) cs(Referer) sc-status sc-substatus sc-win32-status sc-bytes cs-bytes time-taken"
+
+TMG_FIELDS = ("c-ip", "cs-username", "c-agent", "sc-authenticated", "date", "time", "s-svcname", "s-computername", "cs-referred", "r-host", "r-ip", "r-port", "time-taken", "cs-bytes", "sc-bytes", "cs-protocol", "cs-transport", "s-operation", "cs-uri", "cs-mime-type", "s-object-source", "sc-status", "s-cache-info", "rule", "FilterInfo", "cs-Network", "sc-Network", "error-info", "action", "AuthenticationServer", "NIS-scan-result", "NIS-signature", "ThreatName", "MalwareInspectionAction", "MalwareInspectionResult", "MalwareInspectionDuration", "internal-service-info", "bytes-sent", "bytes-received")
+
+URIS = ("/", "/index.html", "/api/v1/orders", "/api/v1/customers/42", "/static/app.js", "/static/site.css", "/login.aspx", "/default.aspx")
+AGENTS = ("Mozilla/5.0+(Windows+NT+6.1;+WOW64;+Trident/7.0;+rv:11.0)+like+Gecko", "Mozilla/5.0+(Windows+NT+10.0;+Win64;+x64)+AppleWebKit/537.36", "curl/7.47.0")
+
+def _perfmon_columns(hostname, counters):
+    columns = []
+    while len(columns) < counters:
+        for obj, instances, names in PERFMON_OBJECTS:
+            for instance in instances:
+                for name in names:
+                    if instance:
+                        columns.append("\\\\%s\\%s(%s)\\%s" % (hostname, obj, instance, name))
+                    else:
+                        columns.append("\\\\%s\\%s\\%s" % (hostname, obj, name))
+    return columns[:counters]
+
+def perfmon(events=10000, hosts=4, files=1, counters=200, serviceid="bench", seed=1):
+    """Perfmon CSV: a PDH header per file followed by rows of "counters"
+    quoted values, "events" messages in total"""
+    rng = random.Random(seed)
+    streams = []
+    for h in range(0, hosts):
+        hostname = "WIN-HOST%03d" % h
+        for f in range(0, files):
+            filename = "C:\\PerfLogs\\Admin\\System\\%s_%06d.csv" % (hostname, f)
+            header = ['"(PDH-CSV 4.0) (GMT Standard Time)(0)"'] + ['"%s"' % column for column in _perfmon_columns(hostname, counters)]
+            streams.append((hostname, filename, ",".join(header)))
+    for i in range(0, events):
+        hostname, filename, header = streams[i % len(streams)]
+        row = i / len(streams)
+        if row == 0:
+            message = header
+        else:
+            seconds = row * 15
+            stamp = "01/%02d/2016 %02d:%02d:%02d.%03d" % (1 + seconds / 86400 % 28, seconds / 3600 % 24, seconds / 60 % 60, seconds % 60, rng.randint(0, 999))
+            values = ['"%s"' % stamp]
+            for c in range(0, counters):
+                if c % 37 == 36:
+                    values.append('" "')
+                else:
+                    values.append('"%.6f"' % (rng.random() * 100))
+            message = ",".join(values)
+        yield {"sourcetype": "perfmon", "hostname": hostname, "filename": filename, "serviceid": serviceid, "perfmon_msg": message}
+
+def iis(events=10000, hosts=4, files=1, serviceid="bench", seed=1):
+    """IIS W3C logs: #Software/#Version/#Date/#Fields header per file then
+    space separated request lines"""
+    rng = random.Random(seed)
+    streams = []
+    for h in range(0, hosts):
+        hostname = "WEB%03d" % h
+        for f in range(0, files):
+            streams.append((hostname, "C:\\inetpub\\logs\\LogFiles\\W3SVC1\\u_ex16010%d.log" % f))
+    preamble = ["#Software: Microsoft Internet Information Services 8.5", "#Version: 1.0", "#Date: 2016-01-02 00:00:00", "#Fields: " + IIS_FIELDS]
+    for i in range(0, events):
+        hostname, filename = streams[i % len(streams)]
+        row = i / len(streams)
+        if row < len(preamble):
+            message = preamble[row]
+        else:
+            seconds = row
+            status = rng.choice((200, 200, 200, 200, 304, 302, 404, 500))
+            message = " ".join([
+                "2016-01-02", "%02d:%02d:%02d" % (seconds / 3600 % 24, seconds / 60 % 60, seconds % 60),
+                "W3SVC1", hostname, "10.0.0.%d" % (rng.randint(1, 254)), rng.choice(("GET", "GET", "POST")),
+                rng.choice(URIS), rng.choice(("-", "id=1", "q=dataminion&page=2")), "443", "-",
+                "192.168.%d.%d" % (rng.randint(0, 255), rng.randint(1, 254)), "HTTP/1.1", rng.choice(AGENTS), "-",
+                str(status), "0", "0", str(rng.randint(200, 90000)), str(rng.randint(100, 2000)), str(rng.randint(0, 3000))])
+        yield {"sourcetype": "iis", "hostname": hostname, "filename": filename, "serviceid": serviceid, "iis_raw_msg": message}
+
+def tmg(events=10000, hosts=2, files=1, serviceid="bench", seed=1):
+    """Forefront TMG W3C logs: tab separated, #Fields header per file"""
+    rng = random.Random(seed)
+    streams = []
+    for h in range(0, hosts):
+        hostname = "TMG%03d" % h
+        for f in range(0, files):
+            streams.append((hostname, "C:\\Program Files\\Microsoft Forefront Threat Management Gateway\\Logs\\ISALOG_2016010%d_WEB_000.w3c" % f))
+    preamble = ["#Software: Microsoft Forefront Threat Management Gateway", "#Version: 1.0", "#Date: 2016-01-02 00:00:00", "#Fields: " + "\t".join(TMG_FIELDS)]
+    for i in range(0, events):
+        hostname, filename = streams[i % len(streams)]
+        row = i / len(streams)
+        if row < len(preamble):
+            message = preamble[row]
+        else:
+            seconds = row
+            values = {
+                "date": "2016-01-02", "time": "%02d:%02d:%02d" % (seconds / 3600 % 24, seconds / 60 % 60, seconds % 60),
+                "c-ip": "10.1.%d.%d" % (rng.randint(0, 255), rng.randint(1, 254)), "cs-username": "CORP\\user%d" % rng.randint(1, 500),
+                "c-agent": rng.choice(AGENTS), "s-computername": hostname, "r-port": "443", "time-taken": str(rng.randint(0, 5000)),
+                "cs-bytes": str(rng.randint(100, 4000)), "sc-bytes": str(rng.randint(200, 500000)), "cs-uri": "https://example.com" + rng.choice(URIS),
+                "sc-status": str(rng.choice((200, 200, 302, 404))), "MalwareInspectionDuration": "0", "internal-service-info": "0",
+                "bytes-sent": str(rng.randint(100, 4000)), "bytes-received": str(rng.randint(200, 500000))}
+            message = "\t".join([values.get(field, "-") for field in TMG_FIELDS])
+        yield {"sourcetype": "tmg", "hostname": hostname, "filename": filename, "serviceid": serviceid, "tmg_raw_msg": message}
+
+def graphite(events=10000, hosts=50, metrics=20, serviceid="bench", seed=1):
+    """Graphite plaintext lines with a couple of tags"""
+    rng = random.Random(seed)
+    names = ["servers.load.%d" % m for m in range(0, metrics)]
+    for i in range(0, events):
+        host = "host%03d" % (i % hosts)
+        line = "%s.%s %s %.3f dc=lis role=web" % (host, names[i % metrics], ("%.4f" % (rng.random() * 10)) if i % 50 else "unknown", 1451692800 + i / 10.0)
+        yield {"sourcetype": "graphite", "serviceid": serviceid, "message": line}
+
+GENERATORS = {
+    "perfmon": perfmon,
+    "iis": iis,
+    "tmg": tmg,
+    "graphite": graphite
+}
+
+FILTERS = {
+    "perfmon": "dataminion.filter.windowslogs.MouraoMagic",
+    "iis": "dataminion.filter.windowslogs.MouraoMagic",
+    "tmg": "dataminion.filter.windowslogs.MouraoMagic",
+    "graphite": "dataminion.filter.nexus.Harbour"
+}
@@ -0,0 +1,84 @@
+import json
+import unittest
+from dataminion import codec
+
+EVENTS = [{"a": 1, "text": u"caf\xe9"}, {"b": [1.1, None, True], "line": "x\ny"}]
+
+class CodecTest(unittest.TestCase):
+    def test_round_trips(self):
+        for name in ("json", "json_lines", "json+gzip", "json_lines+zlib", "json_lines+deflate"):
+            c = codec.get(name)
+            self.assertEqual(c.decode(c.encode(EVENTS)), EVENTS, name)
+            self.assertEqual(c.decode(c.encode(EVENTS[0:1])), EVENTS[0:1], name)
+
+    def test_plain(self):
+        c = codec.get("plain+gzip")
+        self.assertEqual(c.decode(c.encode(["a line"])), ["a line"])
+        self.assertEqual(c.decode(c.encode(["a", "b"])), ["a\nb"])
+
+    def test_content_encoding_wins_when_known(self):
+        c = codec.get("json")
+        body = codec.get("json+gzip").encode(EVENTS)
+        self.assertEqual(c.decode(body, "gzip"), EVENTS)
+        gzipped = codec.get("json+gzip")
+        self.assertEqual(gzipped.decode(body, "utf-8"), EVENTS)
+        self.assertEqual(gzipped.decode(body, None), EVENTS)
+
+    def test_unknown_codecs(self):
+        self.assertRaises(ValueError, codec.get, "xml")
+        self.assertRaises(ValueError, codec.get, "json+rar")
+
+    def test_get_shares_codecs(self):
+        self.assertTrue(codec.get("json_lines") is codec.get("json_lines"))
+
+    def test_dumps_like_the_stdlib(self):
+        for event in EVENTS + [{"f": 0.1 + 0.2, "n": 10 ** 20, "s": "\x00\"\\"}, [], "text"]:
+            self.assertEqual(codec.dumps(event), json.dumps(event))
+
+class RawTest(unittest.TestCase):
+    def test_raw(self):
+        c = codec.get("raw")
+        events = c.decode('{"a": 1}')
+        self.assertEqual(events, ['{"a": 1}'])
+        self.assertTrue(isinstance(events[0], codec.RawEvent))
+        self.assertEqual(c.encode(events), '{"a": 1}')
+        self.assertEqual(json.loads(c.encode(events + ['{"b": 2}'])), [{"a": 1}, {"b": 2}])
+
+    def test_raw_lines(self):
+        c = codec.get("raw_lines+gzip")
+        events = c.decode(codec.get("json_lines+gzip").encode(EVENTS))
+        self.assertEqual([json.loads(event) for event in events], EVENTS)
+        self.assertEqual(c.decode(c.encode(events)), events)
+
+    def test_splice(self):
+        spliced = codec.fields({"env": "prod"})
+        self.assertEqual(spliced, ',"env":"prod"')
+        self.assertEqual(json.loads(codec.splice('{"a": 1} ', spliced)), {"a": 1, "env": "prod"})
+        self.assertEqual(json.loads(codec.splice('{ }', spliced)), {"env": "prod"})
+        self.assertEqual(json.loads(codec.splice('{"env": "dev"}', spliced)), {"env": "prod"})
+        self.assertEqual(codec.splice('[1]', spliced), '[1]')
+        self.assertEqual(codec.splice('{"a": 1}', ""), '{"a": 1}')
+
+class FramingTest(unittest.TestCase):
+    def test_framed(self):
+        self.assertTrue(codec.get("json_lines").framed)
+        self.assertTrue(codec.get("raw_lines+gzip").framed)
+        self.assertFalse(codec.get("json").framed)
+        self.assertFalse(codec.get("plain").framed)
+
+    def test_framed_content_type_is_split(self):
+        body = codec.get("json_lines").encode(EVENTS)
+        self.assertEqual(codec.get("json").decode(body, None, "application/x-ndjson"), EVENTS)
+        events = codec.get("raw").decode(body, None, "application/x-ndjson")
+        self.assertEqual(len(events), 2)
+        self.assertTrue(isinstance(events[0], codec.RawEvent))
+
+    def test_raw_events_are_framed_once(self):
+        raw = codec.RawEvent('{"a":\n 1}')
+        body = codec.get("json_lines").encode([raw, {"b": 2}])
+        self.assertEqual(codec.get("json_lines").decode(body), [{"a": 1}, {"b": 2}])
+        body = codec.get("raw_lines").encode([raw, codec.RawEvent('{"b": 2}')])
+        self.assertEqual(codec.get("json_lines").decode(body), [{"a": 1}, {"b": 2}])
+
+if __name__ == "__main__":
+    unittest.main()
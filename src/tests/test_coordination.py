@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from dataminion.coordination import Memory, File, Subscriptions
+
+class MemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.updates = []
+        self.coordinator = self._coordinator()
+        self.coordinator.add_on_update_callback(lambda node, data: self.updates.append((node, data)))
+
+    def _coordinator(self):
+        return Memory(coordinator={})
+
+    def test_get(self):
+        self.assertEqual(self.coordinator.get("/a/b"), None)
+        self.coordinator.update("/a/b", {"x": 1})
+        self.assertEqual(self.coordinator.get("/a/b"), {"x": 1})
+        self.coordinator.set("/a/c", "not json")
+        self.assertEqual(self.coordinator.get("/a/c"), "not json")
+        #parents are created
+        self.assertEqual(self.coordinator.get("/a"), "")
+
+    def test_watch_fires_when_set_up_and_on_change(self):
+        self.coordinator.watch_node("/w")
+        self.coordinator.update("/w", {"x": 1})
+        self.coordinator.update("/other", {"x": 2})
+        self.assertEqual(self.updates, [("/w", "{}"), ("/w", '{"x": 1}')])
+
+    def test_recursive_watch_picks_up_children(self):
+        self.coordinator.update("/r/a", "1")
+        self.coordinator.watch_node_recursive("/r")
+        self.coordinator.update("/r/b", "2")
+        self.assertEqual(sorted(self.updates), [("/r", ""), ("/r/a", "1"), ("/r/b", "2")])
+
+    def test_delete(self):
+        self.coordinator.update("/d/a", "1")
+        self.coordinator.watch_node("/d/a")
+        self.coordinator.delete("/d")
+        self.assertEqual(self.coordinator.get("/d/a"), None)
+        self.assertEqual(self.coordinator.get("/d"), None)
+        self.assertEqual(self.updates[-1], ("/d/a", None))
+
+class FileTest(MemoryTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        MemoryTest.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _coordinator(self):
+        return File(coordinator={"directory": self.directory})
+
+    def test_nodes_persist(self):
+        self.coordinator.update("/p/a", {"x": 1})
+        self.coordinator.update("/p/b", "2")
+        self.coordinator.delete("/p/b")
+        again = self._coordinator()
+        self.assertEqual(again.get("/p/a"), {"x": 1})
+        self.assertEqual(again.get("/p/b"), None)
+
+    def test_refresh_picks_up_changes_on_disk(self):
+        self.coordinator.update("/f/a", "1")
+        self.coordinator.update("/f/b", "2")
+        self.coordinator.watch_node("/f/a")
+        self.coordinator.watch_node("/f/b")
+        path = os.path.join(self.directory, "f", "a", File.DATA)
+        with open(path, "w") as data_file:
+            data_file.write("changed")
+        os.utime(path, (0, 0))
+        shutil.rmtree(os.path.join(self.directory, "f", "b"))
+        self.coordinator.refresh()
+        self.assertEqual(self.coordinator.get("/f/a"), "changed")
+        self.assertEqual(self.coordinator.get("/f/b"), None)
+        self.assertEqual(self.updates[-2:], [("/f/a", "changed"), ("/f/b", None)])
+
+class SubscriptionsTest(unittest.TestCase):
+    def test_match(self):
+        subscriptions = Subscriptions()
+        subscriptions.subscribe("/a/b", "node")
+        subscriptions.subscribe("/a/", "a")
+        subscriptions.subscribe("/a/b/", "below b")
+        subscriptions.subscribe(None, "all")
+        self.assertEqual(subscriptions.match("/a/b"), set(["node", "a", "all"]))
+        self.assertEqual(subscriptions.match("/a/b/c"), set(["a", "below b", "all"]))
+        self.assertEqual(subscriptions.match("/a/bc"), set(["a", "all"]))
+        self.assertEqual(subscriptions.match("/x"), set(["all"]))
+
+    def test_match_without_subscriptions(self):
+        self.assertEqual(Subscriptions().match("/a/b"), set())
+
+if __name__ == "__main__":
+    unittest.main()
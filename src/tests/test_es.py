@@ -0,0 +1,38 @@
+import unittest
+
+try:
+    from dataminion.output.es import BulkController
+except ImportError:
+    BulkController = None
+
+@unittest.skipIf(BulkController is None, "needs the elasticsearch module")
+class BulkControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = BulkController(size=1000, min_size=100, max_size=1200, concurrency=2, max_concurrency=3, target_latency=1.0, increase=100, decrease=0.5)
+
+    def test_fast_bulks_grow_size_and_senders(self):
+        self.controller.record(0.2, False)
+        self.assertEqual((self.controller.size, self.controller.concurrency), (1100, 3))
+        self.controller.record(0.2, False)
+        self.controller.record(0.2, False)
+        self.assertEqual((self.controller.size, self.controller.concurrency), (1200, 3))
+
+    def test_bulks_under_target_only_grow_size(self):
+        self.controller.record(0.8, False)
+        self.assertEqual((self.controller.size, self.controller.concurrency), (1100, 2))
+
+    def test_slow_bulks_shrink_size(self):
+        self.controller.record(1.5, False)
+        self.assertEqual((self.controller.size, self.controller.concurrency), (500, 2))
+        for i in range(0, 5):
+            self.controller.record(1.5, False)
+        self.assertEqual(self.controller.size, 100)
+
+    def test_rejections_shrink_size_and_senders(self):
+        self.controller.record(0.1, True)
+        self.assertEqual((self.controller.size, self.controller.concurrency), (500, 1))
+        self.controller.record(0.1, True)
+        self.assertEqual((self.controller.size, self.controller.concurrency), (250, 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import time
+import unittest
+from dataminion.headers import HeaderMemory, HeaderWriter
+
+def _wait(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+class _Coordinator(object):
+    def __init__(self, nodes=None):
+        self.nodes = nodes or {}
+        self.gets = []
+        self.watched = []
+
+    def watch_node(self, node):
+        self.watched.append(node)
+
+    def get(self, node):
+        self.gets.append(node)
+        return self.nodes.get(node)
+
+class HeaderMemoryTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        memory = HeaderMemory(size=2, on_evict=evicted.append)
+        memory.set("a", 1)
+        memory.set("b", 2)
+        memory.get("a")
+        memory.set("c", 3)
+        self.assertEqual(evicted, ["b"])
+        self.assertEqual(sorted(memory.keys()), ["a", "c"])
+        self.assertFalse("b" in memory)
+
+    def test_looks_up_and_watches_once(self):
+        coordinator = _Coordinator({"/a": "header"})
+        memory = HeaderMemory(coordinator=coordinator, prefetch=False)
+        self.assertEqual(memory.get("/a"), "header")
+        self.assertEqual(memory.get("/a"), "header")
+        self.assertEqual(coordinator.gets, ["/a"])
+        self.assertEqual(coordinator.watched, ["/a"])
+
+    def test_ttl(self):
+        coordinator = _Coordinator({"/a": "old"})
+        memory = HeaderMemory(coordinator=coordinator, ttl=0.05, prefetch=False)
+        self.assertEqual(memory.get("/a"), "old")
+        coordinator.nodes["/a"] = "new"
+        time.sleep(0.1)
+        self.assertEqual(memory.get("/a"), "new")
+        self.assertEqual(coordinator.gets, ["/a", "/a"])
+
+    def test_negative_cache(self):
+        coordinator = _Coordinator()
+        memory = HeaderMemory(coordinator=coordinator, negative_ttl=0.05, prefetch=False)
+        self.assertEqual(memory.get("/a"), None)
+        self.assertEqual(memory.get("/a"), None)
+        self.assertEqual(coordinator.gets, ["/a"])
+        self.assertFalse("/a" in memory)
+        self.assertEqual(memory.keys(), [])
+        coordinator.nodes["/a"] = "header"
+        time.sleep(0.1)
+        self.assertEqual(memory.get("/a"), "header")
+
+    def test_set_replaces_a_missing_entry(self):
+        memory = HeaderMemory(coordinator=_Coordinator(), prefetch=False)
+        memory.get("/a")
+        memory.set("/a", "header")
+        self.assertEqual(memory.get("/a"), "header")
+        memory.unset("/a")
+        self.assertFalse("/a" in memory)
+
+    def test_prefetch(self):
+        coordinator = _Coordinator({"/a": "header"})
+        memory = HeaderMemory(coordinator=coordinator)
+        self.assertEqual(memory.get("/a"), None)
+        self.assertTrue(_wait(lambda: "/a" in memory))
+        self.assertEqual(memory.get("/a"), "header")
+        self.assertEqual(coordinator.gets, ["/a"])
+
+    def test_stale_header_is_served_while_refreshed(self):
+        coordinator = _Coordinator({"/a": "old"})
+        memory = HeaderMemory(coordinator=coordinator, ttl=0.05)
+        memory.set("/a", "old")
+        coordinator.nodes["/a"] = "new"
+        time.sleep(0.1)
+        self.assertEqual(memory.get("/a"), "old")
+        self.assertTrue(_wait(lambda: memory.get("/a") == "new"))
+
+class _Writable(object):
+    def __init__(self, fail=False):
+        self.writes = []
+        self._fail = fail
+
+    def update_many(self, updates):
+        if self._fail:
+            raise IOError("down")
+        self.writes.append(list(updates))
+
+class HeaderWriterTest(unittest.TestCase):
+    def test_writes_right_away_without_window(self):
+        coordinator = _Writable()
+        writer = HeaderWriter(coordinator=coordinator, window=0)
+        writer.set("/a", {"x": 1})
+        writer.set("/b", "2")
+        self.assertEqual(coordinator.writes, [[("/a", {"x": 1})], [("/b", "2")]])
+
+    def test_skips_what_the_coordinator_holds(self):
+        coordinator = _Writable()
+        writer = HeaderWriter(coordinator=coordinator, window=0)
+        writer.set("/a", {"x": 1, "y": 2})
+        writer.set("/a", {"y": 2, "x": 1})
+        writer.known("/b", u"known")
+        writer.set("/b", "known")
+        self.assertEqual(coordinator.writes, [[("/a", {"x": 1, "y": 2})]])
+
+    def test_coalesces_within_the_window(self):
+        coordinator = _Writable()
+        writer = HeaderWriter(coordinator=coordinator, window=0.05)
+        writer.set("/a", "1")
+        writer.set("/a", "2")
+        writer.set("/b", "3")
+        self.assertEqual(coordinator.writes, [])
+        self.assertTrue(_wait(lambda: coordinator.writes))
+        self.assertEqual(coordinator.writes, [[("/a", "2"), ("/b", "3")]])
+
+    def test_stop_flushes(self):
+        coordinator = _Writable()
+        writer = HeaderWriter(coordinator=coordinator, window=60)
+        writer.set("/a", "1")
+        writer.stop()
+        writer.set("/b", "2")
+        self.assertEqual(coordinator.writes, [[("/a", "1")], [("/b", "2")]])
+
+    def test_failed_writes_are_tried_again(self):
+        coordinator = _Writable(fail=True)
+        writer = HeaderWriter(coordinator=coordinator, window=0)
+        writer.set("/a", "1")
+        coordinator._fail = False
+        writer.set("/a", "1")
+        self.assertEqual(coordinator.writes, [[("/a", "1")]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from dataminion.metrics import Histogram, Metrics, Registry
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        for i in range(0, 99):
+            histogram.observe(0.001)
+        histogram.observe(2)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 2)
+        self.assertEqual(histogram.percentile(50), 0.001)
+        self.assertEqual(histogram.percentile(100), 2)
+
+class MetricsTest(unittest.TestCase):
+    def test_drain_and_merge(self):
+        worker = Metrics()
+        worker.incr("filter.in", 3)
+        worker.incr("filter.out")
+        metrics = Metrics()
+        metrics.incr("filter.in")
+        metrics.merge(worker.drain())
+        self.assertEqual(worker.counters(), {})
+        self.assertEqual(metrics.counters(), {"filter.in": 4, "filter.out": 1})
+
+    def test_snapshot_reads_gauges(self):
+        metrics = Metrics()
+        metrics.gauge("stage.queue", lambda: 7)
+        metrics.gauge("broken", lambda: 1 / 0)
+        metrics.observe("stage.latency", 0.01)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["gauges"], {"stage.queue": 7, "broken": None})
+        self.assertEqual(snapshot["histograms"]["stage.latency"]["count"], 1)
+
+class RegistryTest(unittest.TestCase):
+    def test_rates_since_start(self):
+        registry = Registry()
+        registry._started -= 10
+        registry.directive("/d").incr("output.done", 100)
+        snapshot = registry.snapshot()
+        self.assertAlmostEqual(snapshot["directives"]["/d"]["rates"]["output.done"], 10, places=1)
+
+    def test_rates_since_previous(self):
+        registry = Registry()
+        registry._started -= 100
+        metrics = registry.directive("/d")
+        metrics.incr("output.done", 1000)
+        previous = registry.snapshot()
+        previous["time"] -= 10
+        metrics.incr("output.done", 50)
+        snapshot = registry.snapshot(previous)
+        self.assertAlmostEqual(snapshot["directives"]["/d"]["rates"]["output.done"], 5, places=1)
+        #consumers with their own previous snapshot don't skew each other
+        self.assertAlmostEqual(registry.snapshot()["directives"]["/d"]["rates"]["output.done"], 10.5, places=1)
+
+    def test_remove(self):
+        registry = Registry()
+        registry.directive("/d")
+        registry.remove("/d")
+        self.assertEqual(registry.snapshot()["directives"], {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,288 @@
+import os
+import json
+import threading
+import time
+import unittest
+from dataminion import headers
+from dataminion.codec import RawEvent
+from dataminion.filter.dummy import Passthrough
+from dataminion.pipeline import Stage, KeyedPool, ProcessPool, Batch, Checkpoint, dispatch, dispatcher, partition
+
+def _wait(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.02)
+    return condition()
+
+class StageTest(unittest.TestCase):
+    def test_handles_items_in_order(self):
+        handled = []
+        stage = Stage(name="test", handler=handled.append, depth=10)
+        stage.start()
+        for i in range(0, 100):
+            stage.put(i)
+        stage.stop()
+        self.assertEqual(handled, range(0, 100))
+
+    def test_watermarks(self):
+        release = threading.Event()
+        calls = []
+        def handler(item):
+            release.wait()
+        stage = Stage(name="test", handler=handler, depth=8, high_watermark=6, low_watermark=2, on_full=lambda: calls.append("full"), on_drain=lambda: calls.append("drain"))
+        stage.start()
+        for i in range(0, 7):
+            stage.put(i)
+        self.assertEqual(calls, ["full"])
+        release.set()
+        stage.stop()
+        self.assertEqual(calls, ["full", "drain"])
+
+    def test_put_without_blocking_holds_items_back(self):
+        release = threading.Event()
+        handled = []
+        def handler(item):
+            release.wait()
+            handled.append(item)
+        stage = Stage(name="test", handler=handler, depth=2)
+        stage.start()
+        start = time.time()
+        for i in range(0, 50):
+            stage.put(i, False)
+        self.assertLess(time.time() - start, 1)
+        self.assertGreaterEqual(stage.qsize(), 49)
+        release.set()
+        stage.stop()
+        self.assertEqual(handled, range(0, 50))
+
+    def test_handler_errors_dont_stop_the_stage(self):
+        handled = []
+        def handler(item):
+            if item == 1:
+                raise ValueError(item)
+            handled.append(item)
+        stage = Stage(name="test", handler=handler, depth=10)
+        stage.start()
+        for i in range(0, 3):
+            stage.put(i)
+        stage.stop()
+        self.assertEqual(handled, [0, 2])
+
+class _KeyFilter(object):
+    """Records (worker, event) of what it processes, keyed on key"""
+    def __init__(self, handled):
+        self._handled = handled
+
+    def partition_key(self, data):
+        return data.get("key")
+
+    def process(self, data):
+        self._handled.append((id(self), data))
+
+class KeyedPoolTest(unittest.TestCase):
+    def test_partition_is_stable(self):
+        self.assertEqual(partition("/a/b", 4), partition(u"/a/b", 4))
+        for key in ("a", "b", "c", "/some/file"):
+            self.assertTrue(0 <= partition(key, 3) < 3)
+            self.assertEqual(partition(key, 3), partition(key, 3))
+
+    def test_events_of_a_key_go_in_order_to_one_worker(self):
+        handled = []
+        pool = KeyedPool(name="test", factory=lambda: _KeyFilter(handled), workers=4, depth=10)
+        for i in range(0, 200):
+            pool.put({"key": "k%d" % (i % 7), "n": i})
+        pool.stop()
+        self.assertEqual(len(handled), 200)
+        workers = {}
+        order = {}
+        for worker, data in handled:
+            workers.setdefault(data["key"], set()).add(worker)
+            order.setdefault(data["key"], []).append(data["n"])
+        for key in workers:
+            self.assertEqual(len(workers[key]), 1)
+            self.assertEqual(order[key], sorted(order[key]))
+
+    def test_events_without_key_are_spread(self):
+        handled = []
+        pool = KeyedPool(name="test", factory=lambda: _KeyFilter(handled), workers=3, depth=10)
+        for i in range(0, 30):
+            pool.put({"n": i})
+        pool.stop()
+        self.assertEqual(len(set([worker for worker, data in handled])), 3)
+
+class _Single(object):
+    def __init__(self):
+        self.calls = []
+
+    def process(self, data):
+        self.calls.append(("process", data))
+
+class _Batching(_Single):
+    def process_batch(self, data):
+        self.calls.append(("process_batch", list(data)))
+
+class _Output(_Single):
+    def commit(self, checkpoint):
+        self.calls.append(("commit", checkpoint))
+
+class DispatchTest(unittest.TestCase):
+    def _check(self, fn):
+        single = _Single()
+        fn(single, Batch([1, 2]))
+        fn(single, 3)
+        self.assertEqual(single.calls, [("process", 1), ("process", 2), ("process", 3)])
+        batching = _Batching()
+        fn(batching, Batch([1, 2]))
+        fn(batching, 3)
+        self.assertEqual(batching.calls, [("process_batch", [1, 2]), ("process", 3)])
+
+    def test_dispatch(self):
+        self._check(dispatch)
+
+    def test_dispatcher(self):
+        self._check(lambda target, item: dispatcher(target)(item))
+
+    def test_checkpoints(self):
+        forwarded = []
+        checkpoint = Checkpoint()
+        dispatch(_Single(), checkpoint, forwarded.append)
+        self.assertEqual(forwarded, [checkpoint])
+        output = _Output()
+        dispatcher(output)(checkpoint)
+        self.assertEqual(output.calls, [("commit", checkpoint)])
+        committed = []
+        dispatch(_Single(), Checkpoint(on_commit=lambda: committed.append(1)))
+        self.assertEqual(committed, [1])
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.checkpoint = Checkpoint(on_commit=lambda: self.calls.append("commit"), on_fail=lambda: self.calls.append("fail"))
+
+    def test_commits(self):
+        self.checkpoint.commit()
+        self.assertEqual(self.calls, ["commit"])
+
+    def test_commits_after_the_last_share(self):
+        self.checkpoint.fork(3)
+        self.checkpoint.commit()
+        self.checkpoint.commit()
+        self.assertEqual(self.calls, [])
+        self.checkpoint.commit()
+        self.assertEqual(self.calls, ["commit"])
+
+    def test_fails_once_and_never_commits(self):
+        self.checkpoint.fork(3)
+        self.checkpoint.fail()
+        self.checkpoint.fail()
+        self.checkpoint.commit()
+        self.assertEqual(self.calls, ["fail"])
+
+class _Crashy(Passthrough):
+    """Raises on boom and kills it's process on die"""
+    def process_batch(self, data):
+        if "boom" in data:
+            raise ValueError("boom")
+        if "die" in data:
+            os._exit(3)
+        Passthrough.process_batch(self, data)
+
+class _Headers(Passthrough):
+    """Tags events with the header stored at their "node", looked up
+    through the worker's prefetch thread"""
+    def _initialize(self):
+        self._memory = headers.HeaderMemory(coordinator=self._coordinator)
+
+    def process(self, data):
+        self.send_data((data, self._memory.get(data)))
+
+    def process_batch(self, data):
+        for event in data:
+            self.process(event)
+
+    def set_memory(self, key, data):
+        self._memory.set(key, data)
+
+class _Coordinator(object):
+    def __init__(self, nodes):
+        self._nodes = nodes
+        self.watched = []
+
+    def watch_node(self, node):
+        self.watched.append(node)
+
+    def get(self, node):
+        return self._nodes.get(node)
+
+class ProcessPoolTest(unittest.TestCase):
+    def test_processes_events(self):
+        out = []
+        pool = ProcessPool(name="test", _filter=Passthrough, workers=2, batch_size=10, on_filter=out.append)
+        for i in range(0, 100):
+            pool.process(i)
+        pool.process_batch(range(100, 150))
+        pool.stop()
+        self.assertEqual(sorted(out), range(0, 150))
+
+    def test_checkpoint_commits_after_every_worker(self):
+        committed = []
+        pool = ProcessPool(name="test", _filter=Passthrough, workers=3, batch_size=10)
+        pool.process_batch(range(0, 30))
+        pool.put(Checkpoint(on_commit=lambda: committed.append(1)))
+        self.assertTrue(_wait(lambda: committed))
+        pool.stop()
+        self.assertEqual(committed, [1])
+
+    def test_lookups_go_through_the_parent(self):
+        #started before the workers fork, they need their own
+        headers.prefetcher()
+        out = []
+        coordinator = _Coordinator({"/h/a": "header a"})
+        pool = ProcessPool(name="test", _filter=_Headers, workers=1, batch_size=1, on_filter=out.append, coordinator=coordinator)
+        pool.process("/h/a")
+        self.assertTrue(_wait(lambda: out))
+        self.assertEqual(out, [("/h/a", None)])
+        def found():
+            pool.process("/h/a")
+            time.sleep(0.1)
+            return ("/h/a", "header a") in out
+        self.assertTrue(_wait(found))
+        pool.stop()
+        self.assertEqual(coordinator.watched, ["/h/a"])
+
+    def test_worker_survives_failing_batches(self):
+        out = []
+        pool = ProcessPool(name="test", _filter=_Crashy, workers=1, batch_size=2, on_filter=out.append)
+        pool.process_batch(["boom", "a"])
+        pool.process_batch(["b", "c"])
+        pool.stop()
+        self.assertEqual(out, ["b", "c"])
+
+    def test_dead_worker_is_restarted_and_checkpoint_fails(self):
+        out = []
+        committed = []
+        failed = []
+        pool = ProcessPool(name="test", _filter=_Crashy, workers=1, depth=4, batch_size=2, on_filter=out.append)
+        pool.process_batch(["die", "x"])
+        pool.put(Checkpoint(on_commit=lambda: committed.append(1), on_fail=lambda: failed.append(1)))
+        for i in range(0, 10):
+            pool.process_batch(["a%d" % i, "b%d" % i])
+        self.assertTrue(_wait(lambda: len(out) == 20))
+        pool.stop()
+        self.assertEqual(failed, [1])
+        self.assertEqual(committed, [])
+        self.assertNotIn("x", out)
+
+    def test_encode_hands_on_raw_events(self):
+        out = []
+        pool = ProcessPool(name="test", _filter=Passthrough, workers=2, batch_size=5, on_filter=out.append, encode=True)
+        pool.process_batch([{"n": i, "line": "a\nb"} for i in range(0, 20)])
+        pool.stop()
+        self.assertEqual(len(out), 20)
+        for event in out:
+            self.assertTrue(isinstance(event, RawEvent))
+        self.assertEqual(sorted([json.loads(event)["n"] for event in out]), range(0, 20))
+        self.assertEqual(json.loads(out[0])["line"], "a\nb")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from dataminion.spool import Spool
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _spool(self, **kwargs):
+        return Spool(self.directory, segment_bytes=64, **kwargs)
+
+    def _segments(self):
+        return [name for name in os.listdir(self.directory) if name.endswith(".seg")]
+
+    def test_reads_across_segments(self):
+        spool = self._spool()
+        records = ["record %d\nwith a newline" % i for i in range(0, 20)]
+        for i in range(0, 20, 2):
+            self.assertTrue(spool.put(records[i:i + 2]))
+        self.assertTrue(len(self._segments()) > 1)
+        read = []
+        while not spool.empty():
+            batch, positions = spool.read(3)
+            read.extend(batch)
+            spool.ack(positions[-1])
+        self.assertEqual(read, records)
+        self.assertEqual(spool.size(), 0)
+        self.assertEqual(len(self._segments()), 1)
+        spool.close()
+
+    def test_unacked_records_are_read_again(self):
+        spool = self._spool()
+        spool.put(["a", "b", "c"])
+        records, positions = spool.read(2)
+        self.assertEqual(records, ["a", "b"])
+        self.assertEqual(spool.read(10)[0], ["a", "b", "c"])
+        spool.ack(positions[0])
+        self.assertEqual(spool.read(10)[0], ["b", "c"])
+        spool.close()
+
+    def test_rejects_records_over_max_bytes(self):
+        spool = self._spool(max_bytes=20)
+        self.assertTrue(spool.put(["12345"]))
+        self.assertFalse(spool.put(["1234567890"]))
+        self.assertEqual(spool.read(10)[0], ["12345"])
+        spool.close()
+
+    def test_head_survives_reopening(self):
+        spool = self._spool()
+        spool.put(["record %d" % i for i in range(0, 20)])
+        spool.put(["last"])
+        records, positions = spool.read(15)
+        spool.ack(positions[-1])
+        size = spool.size()
+        spool.close()
+        spool = self._spool()
+        self.assertEqual(spool.size(), size)
+        self.assertEqual(spool.read(10)[0], ["record %d" % i for i in range(15, 20)] + ["last"])
+        spool.put(["more"])
+        self.assertEqual(spool.read(10)[0][-1], "more")
+        spool.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import calendar
+import unittest
+from datetime import datetime, timedelta
+from dataminion import timestamp
+
+PERFMON = ["01/02/2016 03:04:05.678", "12/31/1999 23:59:59.999999", "02/29/2016 00:00:00.0", "07/04/2020 12:30:45.12"]
+EPOCHS = [0.0, 1451703845.678, 1451703845.9999996, 946684799.999999, -1.5, 1e-7, 1600000000.0005]
+
+def _millis(parsed):
+    return calendar.timegm(parsed.timetuple()) * 1000 + parsed.microsecond // 1000
+
+class TimestampTest(unittest.TestCase):
+    def test_perfmon(self):
+        for value in PERFMON:
+            expected = datetime.strptime(value, '%m/%d/%Y %H:%M:%S.%f').strftime('%Y-%m-%dT%H:%M:%S.%f') + "+0100"
+            self.assertEqual(timestamp.perfmon(value, "+0100"), expected)
+            #and again from the cache
+            self.assertEqual(timestamp.perfmon(value, "+0100"), expected)
+
+    def test_perfmon_outside_the_usual_layout(self):
+        self.assertEqual(timestamp.perfmon("1/2/2016 3:04:05.6", ""), "2016-01-02T03:04:05.600000")
+        self.assertRaises(ValueError, timestamp.perfmon, "not a timestamp", "")
+
+    def test_perfmon_millis(self):
+        for value in PERFMON + ["1/2/2016 3:04:05.6"]:
+            parsed = datetime.strptime(value, '%m/%d/%Y %H:%M:%S.%f')
+            self.assertEqual(timestamp.perfmon_millis(value, "+0000"), _millis(parsed))
+            self.assertEqual(timestamp.perfmon_millis(value, "+0130"), _millis(parsed - timedelta(hours=1, minutes=30)))
+            self.assertEqual(timestamp.perfmon_millis(value, "-0500"), _millis(parsed + timedelta(hours=5)))
+
+    def test_graphite(self):
+        for value in EPOCHS + [253402300800.0]:
+            try:
+                expected = datetime.utcfromtimestamp(value).strftime('%Y-%m-%dT%H:%M:%S.%f+0000')
+            except ValueError:
+                self.assertRaises(ValueError, timestamp.graphite, value)
+                continue
+            self.assertEqual(timestamp.graphite(value), expected)
+
+    def test_epoch_millis(self):
+        for value in EPOCHS:
+            self.assertEqual(timestamp.epoch_millis(value), _millis(datetime.utcfromtimestamp(value)))
+
+    def test_w3c_millis(self):
+        for value in ("2016-01-02T03:04:05.0Z", "2016-01-02T03:04:05.6Z", "2016-01-02T03:04:05.678912Z"):
+            self.assertEqual(timestamp.w3c_millis(value), _millis(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')))
+        self.assertEqual(timestamp.w3c_millis("2016-01-02T03:04:05Z"), timestamp.w3c_millis("2016-01-02T03:04:05.0Z"))
+        self.assertRaises(ValueError, timestamp.w3c_millis, "2016-01-02 03:04:05")
+
+if __name__ == "__main__":
+    unittest.main()